@@ -5,106 +5,696 @@ Histogram Traffic Generator for Lab 9
 This script generates HTTP traffic to Prometheus to create histogram data
 for the prometheus_http_request_duration_seconds metrics.
 
+Requests are issued open-loop: arrivals are scheduled at the target rate
+no matter how long responses take, and a pool of workers sends them over
+keep-alive connections. The achieved rate therefore tracks --rps instead
+of dropping as Prometheus slows down.
+
+With --processes N the target rate is split across N worker processes,
+one per CPU core, and their counters are combined into one progress line
+and one summary.
+
+Every request's latency is recorded in two fixed-size log-bucketed
+histograms: the service time on the wire, and the latency from the
+request's scheduled arrival, which adds the time it spent in the backlog
+and waiting for a connection. Failed and timed-out requests are recorded
+too (timeouts at the timeout value), so a struggling server can't hide
+its slowest requests (coordinated omission). Client-side p50/p90/p95/p99
+of both are printed at the end. The script then asks Prometheus for
+histogram_quantile() over prometheus_http_request_duration_seconds_bucket
+for the same window and shows how far the server's bucketed estimate is
+from the measured service times.
+
+With --replay FILE the synthetic endpoint mix is replaced by the queries
+recorded in a Prometheus query log (query_log_file, JSON lines) or a
+capture file. Queries are re-issued with their original relative timing,
+optionally sped up with --speed, and their time ranges are shifted so they
+cover the same window relative to the moment they are replayed.
+
 Usage:
     python histogram_traffic_generator.py [--url URL] [--duration SECONDS] [--rps REQUESTS_PER_SECOND]
+                                          [--workers N] [--connections N] [--processes N]
+    python histogram_traffic_generator.py --replay FILE [--speed FACTOR] [--duration SECONDS]
 
 Examples:
     python histogram_traffic_generator.py
     python histogram_traffic_generator.py --url http://localhost:9090 --duration 300 --rps 5
+    python histogram_traffic_generator.py --rps 2000 --workers 256 --connections 64
+    python histogram_traffic_generator.py --rps 20000 --processes 8
+    python histogram_traffic_generator.py --replay /prometheus/query.log --speed 10
 """
 
 import argparse
+import asyncio
+import gzip
+import json
+import math
+import multiprocessing
+import os
 import random
+import re
+import ssl
 import time
 import sys
-from urllib.request import urlopen, Request
+from datetime import datetime, timedelta, timezone
 from urllib.error import URLError, HTTPError
-from urllib.parse import quote
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+from urllib.request import urlopen, Request
+
+USER_AGENT = 'PromQL-Labs-Traffic-Generator/1.0'
+REQUEST_TIMEOUT = 10
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+QUERY_PATH = '/api/v1/query'
+QUERY_RANGE_PATH = '/api/v1/query_range'
+_RFC3339_RE = re.compile(r'^(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$')
+
+class LatencyHistogram:
+    """Fixed-memory latency histogram with logarithmic buckets (HDR-style).
+
+    Bucket bounds grow by 1% from 1 microsecond to 1000 seconds, so any
+    recorded latency is reproduced within 1% using about 2,100 counters,
+    however many requests are recorded.
+    """
+
+    MIN_SECONDS = 1e-6
+    MAX_SECONDS = 1000.0
+    GROWTH = 1.01
+    BUCKETS = int(math.ceil(math.log(MAX_SECONDS / MIN_SECONDS, GROWTH))) + 2
+    _LOG_GROWTH = math.log(GROWTH)
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * self.BUCKETS
+
+    def record(self, seconds):
+        if seconds <= self.MIN_SECONDS:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, 1 + int(math.log(seconds / self.MIN_SECONDS) / self._LOG_GROWTH))
+        self.counts[index] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Return the latency in seconds below which a fraction q of requests fall"""
+        total = self.total
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index == 0:
+                    return self.MIN_SECONDS
+                # Geometric midpoint of the bucket
+                return self.MIN_SECONDS * self.GROWTH ** (index - 0.5)
+        return self.MAX_SECONDS
+
+class Stats:
+    """Request counters shared by the scheduler, the workers and the progress line."""
+
+    FIELDS = ('request_count', 'success_count', 'fail_count', 'dropped_count')
+    # Length of the flat snapshot used to pass stats between processes
+    SNAPSHOT_SIZE = len(FIELDS) + 2 * LatencyHistogram.BUCKETS
+
+    def __init__(self):
+        self.request_count = 0
+        self.success_count = 0
+        self.fail_count = 0
+        self.dropped_count = 0  # Arrivals shed because the backlog was full
+        self.latency = LatencyHistogram()  # Service time, comparable with the server histogram
+        self.queued_latency = LatencyHistogram()  # From the scheduled arrival, as a user would see it
+
+    def snapshot(self):
+        """Counters followed by both latency histograms, as one flat list"""
+        return ([getattr(self, name) for name in self.FIELDS] + self.latency.counts
+                + self.queued_latency.counts)
+
+    @classmethod
+    def combine(cls, snapshots):
+        """Build one Stats from per-process snapshots"""
+        total = cls()
+        for shard in snapshots:
+            for name, value in zip(cls.FIELDS, shard):
+                setattr(total, name, getattr(total, name) + value)
+            latency = shard[len(cls.FIELDS):len(cls.FIELDS) + LatencyHistogram.BUCKETS]
+            queued = shard[len(cls.FIELDS) + LatencyHistogram.BUCKETS:]
+            total.latency.counts = [a + b for a, b in zip(total.latency.counts, latency)]
+            total.queued_latency.counts = [a + b for a, b in zip(total.queued_latency.counts, queued)]
+        return total
+
+def parse_timestamp(value):
+    """Convert a Unix timestamp or an RFC3339 string to Unix seconds"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = _RFC3339_RE.match(value.strip())
+    if not match:
+        raise ValueError(f"unrecognized timestamp: {value!r}")
+    base, fraction, zone = match.groups()
+    moment = datetime.strptime(base.replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S')
+    offset = timedelta(0)
+    if zone and zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        offset = sign * timedelta(hours=int(zone[:2]), minutes=int(zone[2:]))
+    seconds = moment.replace(tzinfo=timezone(offset)).timestamp()
+    return seconds + (float(f"0.{fraction}") if fraction else 0.0)
+
+class ShiftedQuery:
+    """A query whose time parameters are re-anchored to the moment it is sent.
+
+    Offsets are in seconds relative to the send time, so a range query
+    recorded as "the last hour" keeps asking for the last hour however
+    long the run lasts. A missing time_offset sends an instant query
+    without a time parameter (evaluated at the server's now).
+    """
+
+    def __init__(self, api_path, query, time_offset=None, start_offset=None, end_offset=None, step=None):
+        self.api_path = api_path
+        self.query = query
+        self.time_offset = time_offset
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        self.step = step
+
+    def path(self, now):
+        params = {'query': self.query}
+        if self.api_path == QUERY_RANGE_PATH:
+            params['start'] = f"{now + self.start_offset:.3f}"
+            params['end'] = f"{now + self.end_offset:.3f}"
+            params['step'] = f"{self.step:g}"
+        elif self.time_offset is not None:
+            params['time'] = f"{now + self.time_offset:.3f}"
+        return f"{self.api_path}?{urlencode(params)}"
+
+def endpoint_path(endpoint):
+    """Request path for a static endpoint string or a ShiftedQuery"""
+    return endpoint if isinstance(endpoint, str) else endpoint.path(time.time())
+
+def parse_step(value):
+    """Query step in seconds from a number or a Prometheus duration like 30s or 1m"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'y': 31536000}
+        parts = re.findall(r'(\d+)(ms|s|m|h|d|w|y)', str(value))
+        if not parts or ''.join(n + u for n, u in parts) != str(value):
+            raise ValueError(f"unrecognized step: {value!r}")
+        return sum(int(n) * units[u] for n, u in parts)
+
+def query_log_entry(entry):
+    """Turn one Prometheus query log line into (arrival time, ShiftedQuery)
+
+    Prometheus logs instant queries with start == end and step 0; newer
+    versions also record the HTTP path, which is used when present.
+    """
+    params = entry['params']
+    logged_at = parse_timestamp(entry['ts'])
+    start = parse_timestamp(params['start']) if params.get('start') else logged_at
+    end = parse_timestamp(params['end']) if params.get('end') else start
+    step = parse_step(params.get('step') or 0)
+    api_path = entry.get('httpRequest', {}).get('path', '')
+    if not api_path.endswith(('/query', '/query_range')):
+        api_path = QUERY_RANGE_PATH if step > 0 and end > start else QUERY_PATH
+    if api_path.endswith('/query_range'):
+        endpoint = ShiftedQuery(QUERY_RANGE_PATH, params['query'], start_offset=start - logged_at,
+                                end_offset=end - logged_at, step=step)
+    else:
+        endpoint = ShiftedQuery(QUERY_PATH, params['query'], time_offset=end - logged_at)
+    return logged_at, endpoint
+
+def capture_entry(entry):
+    """Turn one capture line ({"ts": ..., "path": "/api/v1/...?..."}) into (arrival time, endpoint)
+
+    Query API requests become ShiftedQuery objects; anything else (label
+    values, targets, status pages) is replayed as a static path.
+    """
+    logged_at = parse_timestamp(entry['ts'])
+    url = urlsplit(entry['path'])
+    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+    if url.path.endswith('/query_range') and 'query' in params:
+        endpoint = ShiftedQuery(QUERY_RANGE_PATH, params['query'],
+                                start_offset=parse_timestamp(params['start']) - logged_at,
+                                end_offset=parse_timestamp(params['end']) - logged_at,
+                                step=parse_step(params['step']))
+    elif url.path.endswith('/query') and 'query' in params:
+        time_offset = parse_timestamp(params['time']) - logged_at if 'time' in params else None
+        endpoint = ShiftedQuery(QUERY_PATH, params['query'], time_offset=time_offset)
+    else:
+        endpoint = entry['path']
+    return logged_at, endpoint
+
+def load_replay_log(path):
+    """Read a query log or capture file and return [(seconds since first entry, endpoint)]"""
+    opener = gzip.open if path.endswith('.gz') else open
+    entries = []
+    skipped = 0
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                if 'params' in entry:
+                    entries.append(query_log_entry(entry))
+                else:
+                    entries.append(capture_entry(entry))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                skipped += 1
+    if skipped:
+        print(f"⚠️ Skipped {skipped} unreadable lines in {path}")
+    entries.sort(key=lambda item: item[0])
+    if not entries:
+        return []
+    first = entries[0][0]
+    return [(logged_at - first, endpoint) for logged_at, endpoint in entries]
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    async def get(self, host_header, path):
+        """Send a GET request and return the status code once the body is consumed"""
+        self.writer.write(
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host_header}\r\n"
+            f"User-Agent: {USER_AGENT}\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: keep-alive\r\n\r\n".encode('latin-1')
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # Consume the response body so the connection can be reused
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)  # Chunk data plus CRLF
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+            self.reusable = False
+        if headers.get('connection', '').lower() == 'close':
+            self.reusable = False
+        return status
+
+    def close(self):
+        self.writer.close()
+
+class ConnectionPool:
+    """A bounded pool of keep-alive connections to one Prometheus server."""
+
+    def __init__(self, url, size):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.host_header = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def get(self, endpoint, timeout):
+        """Send a request on a pooled connection.
+
+        Returns the status code (None if the request failed) and the
+        request's service time in seconds, which excludes any wait for a
+        free connection. The timeout starts once a connection slot is held;
+        a timed-out request reports the timeout as its service time.
+        """
+        async with self.slots:
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(self._send(endpoint), timeout)
+            except asyncio.TimeoutError:
+                return None, timeout
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                status = None
+            return status, time.perf_counter() - started
+
+    async def _send(self, endpoint):
+        connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            connection = Connection(reader, writer)
+        try:
+            status = await connection.get(self.host_header, self.base_path + endpoint)
+        except BaseException:
+            connection.close()
+            raise
+        if connection.reusable:
+            self.idle.append(connection)
+        else:
+            connection.close()
+        return status
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+async def worker(pool, backlog, stats):
+    """Send scheduled requests until the scheduler signals the end with None
+
+    Backlog items are (scheduled arrival on the monotonic clock, endpoint).
+    """
+    while True:
+        item = await backlog.get()
+        if item is None:
+            return
+        scheduled, endpoint = item
+        status, seconds = await pool.get(endpoint_path(endpoint), REQUEST_TIMEOUT)
+        stats.latency.record(seconds)
+        stats.queued_latency.record(max(seconds, time.monotonic() - scheduled))
+        if status is not None and status < 400:
+            stats.success_count += 1
+        else:
+            stats.fail_count += 1
+        stats.request_count += 1
+
+class SyntheticWorkload:
+    """Random picks from a fixed endpoint mix at a constant arrival rate."""
+
+    def __init__(self, endpoints, rps):
+        self.endpoints = endpoints
+        self.rate = rps
+
+    def split(self, shards):
+        return [SyntheticWorkload(self.endpoints, self.rate / shards) for _ in range(shards)]
+
+    async def schedule(self, duration, backlog, stats):
+        """Open-loop scheduler: enqueue arrivals at the target rate, independent of responses"""
+        start_time = time.monotonic()
+        end_time = start_time + duration
+        issued = 0
+        while True:
+            now = time.monotonic()
+            if now >= end_time:
+                return
+            # Enqueue every arrival that is due, so timer jitter never lowers the rate
+            due = int((now - start_time) * self.rate) + 1 - issued
+            for arrival in range(issued, issued + due):
+                if backlog.full():
+                    stats.dropped_count += 1
+                else:
+                    backlog.put_nowait((start_time + arrival / self.rate, random.choice(self.endpoints)))
+            issued += due
+            next_arrival = start_time + issued / self.rate
+            await asyncio.sleep(max(0.0, min(next_arrival, end_time) - time.monotonic()))
+
+class ReplayWorkload:
+    """Recorded queries re-issued with their original relative timing.
+
+    speed scales the gaps between arrivals (10 replays ten times faster);
+    speed 0 sends the queries back to back as fast as the workers allow.
+    """
+
+    def __init__(self, entries, speed):
+        self.entries = entries
+        self.speed = speed
+        span = entries[-1][0] if entries else 0
+        self.length = span / speed if speed > 0 else None
+        self.rate = len(entries) / self.length if self.length else None
+
+    def split(self, shards):
+        # Round-robin keeps each shard's arrivals spread over the whole log
+        return [ReplayWorkload(self.entries[i::shards], self.speed) for i in range(shards)]
+
+    async def schedule(self, duration, backlog, stats):
+        start_time = time.monotonic()
+        end_time = start_time + duration
+        for offset, endpoint in self.entries:
+            if self.speed > 0:
+                arrival = start_time + offset / self.speed
+                if arrival >= end_time:
+                    return
+                delay = arrival - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if backlog.full():
+                    stats.dropped_count += 1
+                else:
+                    backlog.put_nowait((arrival, endpoint))
+            else:
+                if time.monotonic() >= end_time:
+                    return
+                # Closed loop: wait for a free slot instead of dropping; there is
+                # no schedule to fall behind, so queueing starts once it is enqueued
+                await backlog.put((time.monotonic(), endpoint))
+
+def print_progress(stats, elapsed, duration):
+    """Redraw the progress line"""
+    remaining = max(0, int(duration - elapsed))
+    rate = stats.request_count / elapsed if elapsed > 0 else 0
+    status = "✅" if stats.fail_count == 0 else "⚠️"
+    sys.stdout.write(f"\r{status} Requests: {stats.request_count} | Success: {stats.success_count} | "
+                     f"Failed: {stats.fail_count} | Rate: {rate:.1f}/s | Time remaining: {remaining}s   ")
+    sys.stdout.flush()
+
+async def report_progress(stats, duration, shared=None):
+    """Twice a second, redraw the progress line or publish counters to the parent process"""
+    start_time = time.monotonic()
+    while True:
+        if shared is None:
+            print_progress(stats, time.monotonic() - start_time, duration)
+        else:
+            shared[:] = stats.snapshot()
+        await asyncio.sleep(0.5)
+
+async def generate_traffic(prometheus_url, workload, duration, workers, connections, stats, shared=None):
+    pool = ConnectionPool(prometheus_url, connections)
+    # Bound the backlog so an overloaded server can't make memory grow without limit
+    backlog = asyncio.Queue(maxsize=max(workers * 10, int((workload.rate or 0) * 2)))
+    tasks = [asyncio.create_task(worker(pool, backlog, stats)) for _ in range(workers)]
+    progress = asyncio.create_task(report_progress(stats, duration, shared))
+    try:
+        await workload.schedule(duration, backlog, stats)
+        for _ in tasks:
+            await backlog.put(None)
+        # Let in-flight requests finish, but don't wait on a stuck server forever
+        await asyncio.wait(tasks, timeout=REQUEST_TIMEOUT)
+    finally:
+        for task in tasks + [progress]:
+            task.cancel()
+        pool.close()
+        if shared is not None:
+            shared[:] = stats.snapshot()
+
+def run_shard(shared, prometheus_url, workload, duration, workers, connections):
+    """Entry point of one worker process in --processes mode"""
+    stats = Stats()
+    try:
+        asyncio.run(generate_traffic(prometheus_url, workload, duration, workers, connections,
+                                     stats, shared))
+    except KeyboardInterrupt:
+        # Ctrl+C reaches every process in the group; the parent prints the summary
+        shared[:] = stats.snapshot()
+
+def run_processes(processes, prometheus_url, workload, duration, workers, connections):
+    """Split the workload across worker processes and combine their counters"""
+    counters = [multiprocessing.Array('q', Stats.SNAPSHOT_SIZE, lock=False) for _ in range(processes)]
+    shards = [
+        multiprocessing.Process(target=run_shard, daemon=True,
+                                args=(shared, prometheus_url, shard_workload, duration, workers, connections))
+        for shared, shard_workload in zip(counters, workload.split(processes))
+    ]
+    for shard in shards:
+        shard.start()
+    start_time = time.monotonic()
+    try:
+        while any(shard.is_alive() for shard in shards):
+            print_progress(Stats.combine(counters), time.monotonic() - start_time, duration)
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("\n\n⏹️  Stopped by user")
+    finally:
+        for shard in shards:
+            shard.join(timeout=REQUEST_TIMEOUT)
+    return Stats.combine(counters)
+
+def server_quantile(prometheus_url, q, window_seconds):
+    """Ask Prometheus for its bucketed estimate of the request latency quantile"""
+    query = (f"histogram_quantile({q}, sum by (le) "
+             f"(increase(prometheus_http_request_duration_seconds_bucket[{window_seconds}s])))")
+    url = f"{prometheus_url}/api/v1/query?{urlencode({'query': query})}"
+    req = Request(url, headers={'User-Agent': USER_AGENT})
+    with urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+        result = json.load(response).get('data', {}).get('result', [])
+    if not result:
+        return None
+    value = float(result[0]['value'][1])
+    return None if math.isnan(value) else value
+
+def print_client_quantiles(stats):
+    """Print client-side service time and latency including queueing, per quantile"""
+    print("⏱️  Client-side latency (measured, ±1%):")
+    print(f"   {'Quantile':<10}{'Service':>12}{'With queueing':>16}")
+    for q in QUANTILES:
+        print(f"   {'p' + format(q * 100, 'g'):<10}{stats.latency.quantile(q) * 1000:>10.2f}ms"
+              f"{stats.queued_latency.quantile(q) * 1000:>14.2f}ms")
+    print("   Service time runs from sending the request to the end of the response;")
+    print("   with queueing adds the wait since its scheduled arrival. Failed requests")
+    print("   are included, timeouts at the timeout value.")
+    print()
+
+def compare_with_server(prometheus_url, stats, elapsed, scrape_wait):
+    """Print client-measured quantiles next to Prometheus's histogram_quantile estimate"""
+    print_client_quantiles(stats)
+
+    if scrape_wait > 0:
+        print(f"Waiting {scrape_wait}s so Prometheus scrapes its own request metrics...")
+        time.sleep(scrape_wait)
+    window_seconds = int(math.ceil(elapsed + scrape_wait))
+
+    print(f"📐 Server estimate vs measured service time (histogram_quantile over the last {window_seconds}s):")
+    print(f"   {'Quantile':<10}{'Client':>12}{'Server':>12}{'Difference':>22}")
+    for q in QUANTILES:
+        client = stats.latency.quantile(q)
+        try:
+            server = server_quantile(prometheus_url, q, window_seconds)
+        except (URLError, HTTPError, OSError, ValueError) as e:
+            print(f"   ⚠️ Could not query Prometheus: {e}")
+            return
+        if server is None:
+            print(f"   {'p' + format(q * 100, 'g'):<10}{client * 1000:>10.2f}ms{'no data':>12}")
+            continue
+        delta = server - client
+        print(f"   {'p' + format(q * 100, 'g'):<10}{client * 1000:>10.2f}ms{server * 1000:>10.2f}ms"
+              f"{delta * 1000:>+12.2f}ms ({delta / client * 100:+.0f}%)")
+    print("   Server values are interpolated inside the histogram's buckets, so coarse")
+    print("   bucket layouts show up here as large differences.")
+    print("   The server histogram also counts any other traffic Prometheus received.")
+    print()
 
 def main():
     parser = argparse.ArgumentParser(description='Generate HTTP traffic for Prometheus histogram data')
     parser.add_argument('--url', default='http://localhost:9090', help='Prometheus URL (default: http://localhost:9090)')
-    parser.add_argument('--duration', type=int, default=300, help='Duration in seconds (default: 300)')
+    parser.add_argument('--duration', type=int, default=None,
+                        help='Duration in seconds (default: 300, or the length of the replayed log)')
     parser.add_argument('--rps', type=float, default=5, help='Requests per second (default: 5)')
+    parser.add_argument('--workers', type=int, default=64,
+                        help='Maximum requests in flight at once (default: 64)')
+    parser.add_argument('--connections', type=int, default=None,
+                        help='Keep-alive connections to Prometheus (default: same as --workers)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes to split the rate across; 0 means one per CPU core (default: 1). '
+                             '--workers and --connections apply to each process')
+    parser.add_argument('--no-compare', action='store_true',
+                        help='Skip the comparison with the server-side histogram_quantile estimate')
+    parser.add_argument('--scrape-wait', type=int, default=15,
+                        help='Seconds to wait for Prometheus to scrape itself before comparing (default: 15)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Replay a Prometheus query log (query_log_file) or capture file instead of '
+                             'the built-in endpoint mix; .gz files are supported')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='Replay speed-up factor, e.g. 10 for ten times faster; 0 replays as fast as '
+                             'possible (default: 1)')
     args = parser.parse_args()
 
     prometheus_url = args.url.rstrip('/')
-    duration = args.duration
     rps = args.rps
+    workers = max(1, args.workers)
+    connections = max(1, args.connections or workers)
+    processes = args.processes if args.processes > 0 else (os.cpu_count() or 1)
+
+    if args.replay:
+        entries = load_replay_log(args.replay)
+        if not entries:
+            print(f"❌ No replayable queries found in {args.replay}")
+            sys.exit(1)
+        workload = ReplayWorkload(entries, max(0.0, args.speed))
+        duration = args.duration or (int(math.ceil(workload.length)) + 1 if workload.length is not None else 300)
+        rps = workload.rate
+    else:
+        # Various query endpoints to hit (creates varied latency distribution)
+        endpoints = [
+            "/api/v1/query?query=up",
+            "/api/v1/query?query=node_cpu_seconds_total",
+            "/api/v1/query?query=" + quote("sum(rate(node_cpu_seconds_total[5m]))"),
+            "/api/v1/query?query=" + quote("prometheus_http_request_duration_seconds_bucket"),
+            "/api/v1/query?query=" + quote("histogram_quantile(0.95,sum(rate(prometheus_http_request_duration_seconds_bucket[5m]))by(le))"),
+            "/api/v1/label/__name__/values",
+            "/api/v1/targets",
+            "/api/v1/status/config",
+            "/-/healthy",
+        ]
+
+        # Add some range queries with different time ranges for varied latency;
+        # their start/end are computed when each request is sent so they never go stale
+        for hours_ago in [1, 2, 6]:
+            endpoints.append(ShiftedQuery(QUERY_RANGE_PATH, 'up', start_offset=-hours_ago * 3600,
+                                          end_offset=0, step=60))
+        workload = SyntheticWorkload(endpoints, rps)
+        duration = args.duration or 300
 
     print("🚀 Histogram Traffic Generator")
     print("=" * 40)
     print(f"Prometheus URL: {prometheus_url}")
     print(f"Duration: {duration}s")
-    print(f"Requests/second: {rps}")
+    if args.replay:
+        print(f"Replaying: {args.replay} ({len(workload.entries)} queries, "
+              f"{'as fast as possible' if workload.speed == 0 else f'{workload.speed:g}x speed'})")
+    else:
+        print(f"Requests/second: {rps}")
+    print(f"Workers: {workers} | Connections: {connections}" +
+          (f" | Processes: {processes} (per process)" if processes > 1 else ""))
     print()
     print("Generating traffic to create histogram data...")
     print("Press Ctrl+C to stop early")
     print()
 
-    # Various query endpoints to hit (creates varied latency distribution)
-    endpoints = [
-        "/api/v1/query?query=up",
-        "/api/v1/query?query=node_cpu_seconds_total",
-        "/api/v1/query?query=" + quote("sum(rate(node_cpu_seconds_total[5m]))"),
-        "/api/v1/query?query=" + quote("prometheus_http_request_duration_seconds_bucket"),
-        "/api/v1/query?query=" + quote("histogram_quantile(0.95,sum(rate(prometheus_http_request_duration_seconds_bucket[5m]))by(le))"),
-        "/api/v1/label/__name__/values",
-        "/api/v1/targets",
-        "/api/v1/status/config",
-        "/-/healthy",
-    ]
-
-    # Add some range queries with different time ranges for varied latency
-    now = int(time.time())
-    for hours_ago in [1, 2, 6]:
-        start = now - (hours_ago * 3600)
-        endpoints.append(f"/api/v1/query_range?query=up&start={start}&end={now}&step=60")
-
-    sleep_interval = 1.0 / rps
+    stats = Stats()
     start_time = time.time()
-    end_time = start_time + duration
-    
-    request_count = 0
-    success_count = 0
-    fail_count = 0
-
     try:
-        while time.time() < end_time:
-            # Pick a random endpoint
-            endpoint = random.choice(endpoints)
-            url = f"{prometheus_url}{endpoint}"
-            
-            try:
-                req = Request(url, headers={'User-Agent': 'PromQL-Labs-Traffic-Generator/1.0'})
-                with urlopen(req, timeout=10) as response:
-                    _ = response.read()  # Consume response
-                    success_count += 1
-            except (URLError, HTTPError) as e:
-                fail_count += 1
-            
-            request_count += 1
-            
-            # Update progress
-            elapsed = int(time.time() - start_time)
-            remaining = duration - elapsed
-            status = "✅" if fail_count == 0 else "⚠️"
-            sys.stdout.write(f"\r{status} Requests: {request_count} | Success: {success_count} | Failed: {fail_count} | Time remaining: {remaining}s   ")
-            sys.stdout.flush()
-            
-            time.sleep(sleep_interval)
-            
+        if processes > 1:
+            stats = run_processes(processes, prometheus_url, workload, duration, workers, connections)
+        else:
+            asyncio.run(generate_traffic(prometheus_url, workload, duration, workers, connections, stats))
     except KeyboardInterrupt:
         print("\n\n⏹️  Stopped by user")
+    elapsed = time.time() - start_time
 
     print("\n")
     print("=" * 40)
     print("📊 Traffic Generation Complete!")
     print("=" * 40)
-    print(f"Total requests: {request_count}")
-    print(f"Successful: {success_count}")
-    print(f"Failed: {fail_count}")
+    print(f"Total requests: {stats.request_count}")
+    print(f"Successful: {stats.success_count}")
+    print(f"Failed: {stats.fail_count}")
+    if stats.dropped_count:
+        print(f"Dropped (backlog full, server too slow): {stats.dropped_count}")
+    target = f"{rps:.1f}" if rps else "as fast as possible"
+    print(f"Achieved rate: {stats.request_count / elapsed:.1f} req/s (target: {target})")
     print()
+    if stats.latency.total:
+        if args.no_compare:
+            print_client_quantiles(stats)
+        else:
+            compare_with_server(prometheus_url, stats, elapsed, args.scrape_wait)
     print("You can now run histogram queries in Lab 9!")
     print("Try: histogram_quantile(0.95, sum(rate(prometheus_http_request_duration_seconds_bucket[5m])) by (le))")
 
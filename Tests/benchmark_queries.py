@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Benchmark the lab query catalog against a Prometheus server.
+
+Every query in queries.all_queries is run for a number of warm iterations
+and the p50/p95/p99 client latency is reported per query and per lab list.
+Results can be saved as a baseline; later runs compare against it and fail
+when a query gets slower than the allowed threshold (for example after a
+Prometheus upgrade).
+
+Usage:
+    python benchmark_queries.py [--iterations N] [--warmup N] [--save-baseline FILE]
+    python benchmark_queries.py --baseline FILE [--threshold PERCENT] [--min-delta-ms MS]
+"""
+
+import argparse
+import json
+import sys
+from datetime import datetime
+from queries import queries_by_lab
+from test_queries import (check_prerequisites, create_session, fetch_build_info, is_failure, load_config,
+                          test_prom_query)
+
+PERCENTILES = (50, 95, 99)
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(samples):
+    """Latency summary (ms) for a list of wall-time samples"""
+    summary = {f"p{p}": round(percentile(samples, p), 3) for p in PERCENTILES} if samples else {}
+    summary['count'] = len(samples)
+    return summary
+
+def run_benchmark(prometheus_url, instance_name, session, iterations, warmup):
+    """Run the catalog `warmup + iterations` times and collect wall times per query"""
+    samples = {}
+    errors = {}
+    for iteration in range(warmup + iterations):
+        measuring = iteration >= warmup
+        label = f"iteration {iteration - warmup + 1}/{iterations}" if measuring else f"warm-up {iteration + 1}/{warmup}"
+        sys.stdout.write(f"\r⏱️  {label}   ")
+        sys.stdout.flush()
+        for lab, lab_queries in queries_by_lab.items():
+            for query_info in lab_queries:
+                key = f"{lab}: {query_info['name']}"
+                outcome = test_prom_query(
+                    name=query_info['name'],
+                    query=query_info['query'],
+                    expected_type=query_info['expected_type'],
+                    prometheus_url=prometheus_url,
+                    instance_name=instance_name,
+                    session=session
+                )
+                if not measuring:
+                    continue
+                if is_failure(outcome['result']):
+                    errors[key] = outcome['result']
+                elif outcome['metrics']['wall_ms'] is not None:
+                    samples.setdefault(key, []).append(outcome['metrics']['wall_ms'])
+    print("\n")
+    return samples, errors
+
+def build_report(samples, iterations, prometheus_url, version):
+    """Summarize samples per query and per lab list"""
+    report = {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "prometheus_url": prometheus_url,
+        "prometheus_version": version,
+        "iterations": iterations,
+        "queries": {},
+        "labs": {}
+    }
+    for lab in queries_by_lab:
+        lab_samples = []
+        for key, values in samples.items():
+            if key.startswith(f"{lab}: "):
+                report["queries"][key] = summarize(values)
+                lab_samples.extend(values)
+        report["labs"][lab] = summarize(lab_samples)
+    return report
+
+def print_table(title, rows):
+    """Print a latency table sorted by p95, slowest first"""
+    print(f"===== {title} =====")
+    print(f"{'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}  Name")
+    for name, summary in sorted(rows.items(), key=lambda item: item[1].get('p95', 0), reverse=True):
+        if summary['count']:
+            print(f"{summary['p50']:>10.1f} {summary['p95']:>10.1f} {summary['p99']:>10.1f}  {name}")
+    print()
+
+def compare_to_baseline(report, baseline, threshold, min_delta_ms, stat):
+    """Return the queries whose latency regressed past the threshold"""
+    regressions = []
+    for key, current in report["queries"].items():
+        previous = baseline.get("queries", {}).get(key)
+        if not previous or stat not in previous or stat not in current:
+            continue
+        delta = current[stat] - previous[stat]
+        change = (delta / previous[stat] * 100) if previous[stat] else 0
+        if change > threshold and delta > min_delta_ms:
+            regressions.append((key, previous[stat], current[stat], change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lab query catalog and detect latency regressions')
+    parser.add_argument('--iterations', type=int, default=10, help='Measured iterations per query (default: 10)')
+    parser.add_argument('--warmup', type=int, default=2, help='Warm-up iterations to discard (default: 2)')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Write the results to a baseline file')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='Allowed slowdown versus the baseline, in percent (default: 20)')
+    parser.add_argument('--min-delta-ms', type=float, default=2,
+                        help='Ignore slowdowns smaller than this many ms, to skip noise (default: 2)')
+    parser.add_argument('--stat', choices=[f"p{p}" for p in PERCENTILES], default='p95',
+                        help='Percentile compared against the baseline (default: p95)')
+    args = parser.parse_args()
+
+    config = load_config()
+    prometheus_url = config['prometheus_url']
+    session = create_session()
+    check_prerequisites(prometheus_url, session)
+    version = fetch_build_info(prometheus_url, session).get('version')
+
+    print(f"\n===== Benchmarking Lab Queries (Prometheus {version or 'unknown version'}) =====\n")
+    samples, errors = run_benchmark(prometheus_url, config['instance_name'], session,
+                                    args.iterations, args.warmup)
+    report = build_report(samples, args.iterations, prometheus_url, version)
+
+    print_table("Latency per Lab List", report["labs"])
+    print_table("Latency per Query", report["queries"])
+
+    exit_code = 0
+    if errors:
+        print(f"❌ {len(errors)} queries failed during the benchmark:")
+        for key, result in errors.items():
+            print(f"   {key} - {result}")
+        exit_code = 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print(f"\nComparing {args.stat} with baseline from {baseline.get('created')} "
+              f"(Prometheus {baseline.get('prometheus_version') or 'unknown version'})")
+        regressions = compare_to_baseline(report, baseline, args.threshold, args.min_delta_ms, args.stat)
+        if regressions:
+            print(f"❌ {len(regressions)} queries regressed by more than {args.threshold}%:")
+            for key, before, after, change in sorted(regressions, key=lambda r: r[3], reverse=True):
+                print(f"   {key}: {before:.1f} ms -> {after:.1f} ms (+{change:.0f}%)")
+            exit_code = 1
+        else:
+            print(f"✅ No query regressed by more than {args.threshold}%")
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
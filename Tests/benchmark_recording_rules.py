@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Measure what the lab recording rules buy at read time and cost at evaluation time.
+
+For each entry in RECORDING_RULES (test_recording_rules.py) the recorded
+series and its `alternative` expression are timed as an instant query and
+as range queries over several lengths. The cost of evaluating the rule is
+read from prometheus_rule_group_last_duration_seconds, and the report
+shows the read-time speedup next to that cost, plus how many reads per
+evaluation interval it takes for the rule to pay for itself.
+
+Usage:
+    python benchmark_recording_rules.py [--iterations N] [--warmup N] [--ranges 1h,6h,24h] [--step SECONDS]
+                                        [--output FILE]
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from benchmark_queries import percentile
+from promql_parser import PromQLSyntaxError, format_string, parse_duration
+from test_queries import check_prerequisites, create_session, fetch_build_info, load_config
+from test_recording_rules import RECORDING_RULES
+
+def time_request(session, url, params):
+    """Return the wall time of one query in ms, or None if it failed"""
+    started = time.perf_counter()
+    try:
+        response = session.get(url, params=params, timeout=60)
+        response.content  # Include the body transfer in the measurement
+    except Exception:
+        return None
+    if response.status_code != 200 or response.json().get('status') != 'success':
+        return None
+    return (time.perf_counter() - started) * 1000
+
+def query_variants(ranges, step, now):
+    """(label, API path, params without the query) for the instant and range variants"""
+    variants = [("instant", "/api/v1/query", {'time': now})]
+    for label, seconds in ranges:
+        variants.append((f"range {label}", "/api/v1/query_range",
+                         {'start': now - seconds, 'end': now, 'step': step}))
+    return variants
+
+def benchmark_rule(rule, prometheus_url, session, variants, iterations, warmup):
+    """Time the recorded series and the raw expression for every variant"""
+    rows = []
+    for label, path, params in variants:
+        timings = {'recorded': [], 'raw': []}
+        for iteration in range(warmup + iterations):
+            # Alternate the two so cache warm-up and background load hit both alike
+            for kind, query in (('recorded', rule['query']), ('raw', rule['alternative'])):
+                wall_ms = time_request(session, f"{prometheus_url}{path}", dict(params, query=query))
+                if iteration >= warmup and wall_ms is not None:
+                    timings[kind].append(wall_ms)
+        recorded = percentile(timings['recorded'], 50)
+        raw = percentile(timings['raw'], 50)
+        rows.append({
+            "variant": label,
+            "recorded_p50_ms": round(recorded, 3) if recorded is not None else None,
+            "raw_p50_ms": round(raw, 3) if raw is not None else None,
+            "speedup": round(raw / recorded, 2) if recorded and raw is not None else None
+        })
+    return rows
+
+def instant_query(prometheus_url, session, query):
+    """Return the result vector of an instant query ([] on failure)"""
+    try:
+        response = session.get(f"{prometheus_url}/api/v1/query", params={'query': query}, timeout=10)
+        return response.json().get('data', {}).get('result', [])
+    except Exception:
+        return []
+
+def fetch_rule_groups(prometheus_url, session):
+    """Map each recording rule name to its (rule file, group name) using /api/v1/rules"""
+    try:
+        response = session.get(f"{prometheus_url}/api/v1/rules", params={'type': 'record'}, timeout=10)
+        groups = response.json().get('data', {}).get('groups', [])
+    except Exception:
+        return {}
+    return {rule['name']: (group.get('file', ''), group['name'])
+            for group in groups for rule in group.get('rules', [])}
+
+def evaluation_cost(prometheus_url, session, group):
+    """Last evaluation duration (ms) and interval (s) of a (rule file, group name).
+
+    The rule_group label is "<rule file>;<group name>", so the group is
+    matched exactly.
+    """
+    selector = f'{{rule_group={format_string(";".join(group))}}}'
+    duration = instant_query(prometheus_url, session, f"max(prometheus_rule_group_last_duration_seconds{selector})")
+    interval = instant_query(prometheus_url, session, f"max(prometheus_rule_group_interval_seconds{selector})")
+    if not duration:
+        return None, None
+    return (float(duration[0]['value'][1]) * 1000,
+            float(interval[0]['value'][1]) if interval else None)
+
+def break_even_reads(eval_ms, row):
+    """Reads per evaluation interval needed before precomputing saves time overall"""
+    if eval_ms is None or row['raw_p50_ms'] is None or row['recorded_p50_ms'] is None:
+        return None
+    saved = row['raw_p50_ms'] - row['recorded_p50_ms']
+    return round(eval_ms / saved, 2) if saved > 0 else None
+
+def cell(value, spec, suffix=''):
+    """Format a table cell, showing '-' for missing values"""
+    return format(value, spec) + suffix if value is not None else '-'
+
+def print_report(results):
+    print(f"{'Variant':<14} {'Raw ms':>9} {'Rule ms':>9} {'Speedup':>8} {'Eval ms':>9} {'Every':>7} {'Break-even':>12}")
+    for result in results:
+        print(f"\n{result['name']}")
+        if result['group'] is None:
+            print("   ⚠️ Rule is not loaded in Prometheus; evaluation cost unknown")
+        for row in result['rows']:
+            print(f"{row['variant']:<14} {cell(row['raw_p50_ms'], '.2f'):>9} {cell(row['recorded_p50_ms'], '.2f'):>9} "
+                  f"{cell(row['speedup'], '.1f', 'x'):>8} {cell(result['eval_ms'], '.2f'):>9} "
+                  f"{cell(result['interval_s'], 'g', 's'):>7} {cell(row['break_even_reads'], 'g', ' reads'):>12}")
+    print()
+    print("Break-even: reads per evaluation interval after which the rule costs less")
+    print("than evaluating the raw expression on every read.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark recorded series against their raw expressions')
+    parser.add_argument('--iterations', type=int, default=10, help='Measured iterations per query (default: 10)')
+    parser.add_argument('--warmup', type=int, default=2, help='Warm-up iterations to discard (default: 2)')
+    parser.add_argument('--ranges', default='1h,6h,24h',
+                        help='Comma-separated range query lengths (default: 1h,6h,24h)')
+    parser.add_argument('--step', type=float, default=60, help='Range query step in seconds (default: 60)')
+    parser.add_argument('--output', metavar='FILE', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    try:
+        ranges = [(label.strip(), parse_duration(label.strip()) / 1000) for label in args.ranges.split(',')]
+    except PromQLSyntaxError as e:
+        print(f"❌ {e}")
+        return 1
+
+    config = load_config()
+    prometheus_url = config['prometheus_url']
+    session = create_session()
+    check_prerequisites(prometheus_url, session)
+    version = fetch_build_info(prometheus_url, session).get('version')
+    rule_groups = fetch_rule_groups(prometheus_url, session)
+
+    print(f"\n===== Benchmarking Recording Rules (Prometheus {version or 'unknown version'}) =====\n")
+    variants = query_variants(ranges, args.step, datetime.now().timestamp())
+    results = []
+    for rule in RECORDING_RULES:
+        sys.stdout.write(f"\r⏱️  {rule['name']}   ")
+        sys.stdout.flush()
+        group = rule_groups.get(rule['name'])
+        eval_ms, interval_s = evaluation_cost(prometheus_url, session, group) if group else (None, None)
+        group_file, group = group if group else (None, None)
+        rows = benchmark_rule(rule, prometheus_url, session, variants, args.iterations, args.warmup)
+        for row in rows:
+            row['break_even_reads'] = break_even_reads(eval_ms, row)
+        results.append({"name": rule['name'], "group": group, "group_file": group_file, "eval_ms": eval_ms,
+                        "interval_s": interval_s, "rows": rows})
+    print("\r" + " " * 60 + "\r", end="")
+
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"created": datetime.now().isoformat(timespec='seconds'),
+                       "prometheus_url": prometheus_url,
+                       "prometheus_version": version,
+                       "iterations": args.iterations,
+                       "rules": results}, f, indent=2)
+        print(f"\nResults saved to: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Sweep the lab queries across fleet sizes to see how they scale.
+
+Every catalog query that is scoped to instance="$INSTANCE" is run
+fleet-wide at increasing instance counts (10, 100, 1k and 10k by
+default), recording latency, peak samples and response size at each
+point. From the two largest points the growth exponent is computed
+(1.0 means linear in the number of instances); queries whose latency or
+peak samples grow faster than --threshold are flagged as super-linear.
+
+By default every point runs offline: a synthetic fleet of that size is
+loaded into the in-process evaluator (promql_eval.py) and the instance
+matcher is dropped. With --live the queries run against the Prometheus
+in config.json, which should scrape a fake fleet at least as large as
+the biggest point (see fake_exporter.py); each point then matches the
+first N instances with instance=~"a|b|...".
+
+Usage:
+    python cardinality_sweep.py [--sizes 10,100,1000,10000] [--cpus N] [--iterations N] [--threshold X]
+                                [--live] [--output FILE]
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+from datetime import datetime
+from benchmark_queries import percentile
+from instance_batch import batched_query
+from promql_parser import INSTANCE_PLACEHOLDER, PromQLSyntaxError, canonicalize, generalize, parse
+from queries import queries_by_lab
+from synthetic_fleet import instance_names
+from test_queries import check_prerequisites, create_session, load_config, server_stats
+
+DEFAULT_SIZES = '10,100,1000,10000'
+
+def sweep_queries():
+    """(lab, query info, parsed query) for every query scoped to $INSTANCE"""
+    selected = []
+    for lab, lab_queries in queries_by_lab.items():
+        for query_info in lab_queries:
+            if INSTANCE_PLACEHOLDER not in query_info['query']:
+                continue
+            try:
+                node = parse(query_info['query'].replace('\\"', '"'))
+            except PromQLSyntaxError:
+                continue
+            selected.append((lab, query_info, node))
+    return selected
+
+def scoped_query(node, instances=None):
+    """Render a query fleet-wide, or for a list of instances with one regex matcher"""
+    if instances is not None:
+        return batched_query(node, instances)
+    copy = parse(canonicalize(node))
+    generalize(copy)
+    return canonicalize(copy)
+
+def measure(session, prometheus_url, query, eval_time, iterations):
+    """Median wall time (ms), peak samples and response bytes of a query, or an error string"""
+    timings = []
+    stats = {}
+    for _ in range(iterations):
+        # POST, since instance regexes for large points do not fit in a URL
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{prometheus_url}/api/v1/query",
+                                    data={'query': query, 'time': eval_time, 'stats': 'all'}, timeout=120)
+            body = response.content
+            data = response.json()
+        except Exception as e:
+            return {'error': str(e)}
+        if data.get('status') != 'success':
+            return {'error': data.get('error', f"HTTP {response.status_code}")}
+        timings.append((time.perf_counter() - started) * 1000)
+        stats = server_stats(data)
+        stats['response_bytes'] = len(body)
+        stats['series'] = len(data['data']['result']) if data['data']['resultType'] in ('vector', 'matrix') else 1
+    return {
+        'wall_ms': round(percentile(timings, 50), 3),
+        'peak_samples': stats.get('peak_samples'),
+        'response_bytes': stats['response_bytes'],
+        'series': stats['series'],
+    }
+
+def growth_exponent(points, key):
+    """Slope of log(value) over log(instances) between the two largest points"""
+    usable = [(p['instances'], p[key]) for p in points if p.get(key)]
+    if len(usable) < 2:
+        return None
+    (n1, v1), (n2, v2) = usable[-2], usable[-1]
+    if n2 == n1:
+        return None
+    return round(math.log(v2 / v1) / math.log(n2 / n1), 2)
+
+def offline_points(sizes, cpus):
+    """Yield (size, prometheus_url, eval_time, instances=None) with an evaluator per fleet size"""
+    from promql_eval import Engine, build_lab_tsdb, catalog_history, start_eval_server
+    history = catalog_history([query_info for _, query_info, _ in sweep_queries()])
+    for size in sizes:
+        started = time.perf_counter()
+        tsdb, eval_time = build_lab_tsdb(instances=size, cpus=cpus, history=history, interval=60)
+        server, url = start_eval_server(Engine(tsdb))
+        print(f"🖥️  {size} instances: {tsdb.series_count} series (built in {time.perf_counter() - started:.1f}s)")
+        yield size, url, eval_time, None
+        server.shutdown()
+        server.server_close()
+
+def live_points(sizes, prometheus_url, first_instance):
+    """Yield (size, prometheus_url, eval_time, instances) against one live Prometheus"""
+    eval_time = round(time.time(), 3)
+    for size in sizes:
+        print(f"🖥️  {size} instances")
+        yield size, prometheus_url, eval_time, instance_names(size, first_instance)
+
+def print_table(results, sizes, threshold):
+    header = " ".join(f"{size:>16}" for size in sizes)
+    print(f"{'Query':<50} {header} {'Exp lat':>8} {'Exp smp':>8}")
+    print(f"{'':<50} " + " ".join(f"{'ms / samples':>16}" for _ in sizes))
+    for result in results:
+        cells = []
+        for point in result['points']:
+            if 'error' in point:
+                cells.append(f"{'error':>16}")
+            else:
+                cells.append(f"{point['wall_ms']:>7.1f} {point['peak_samples'] or 0:>8}")
+        exponents = [result['latency_exponent'], result['samples_exponent']]
+        flag = " ⚠️ super-linear" if result['super_linear'] else ""
+        exponent_cells = " ".join(f"{e:>8.2f}" if e is not None else f"{'-':>8}" for e in exponents)
+        print(f"{result['name'][:50]:<50} {' '.join(cells)} {exponent_cells}{flag}")
+    flagged = [r for r in results if r['super_linear']]
+    print()
+    print(f"Exponent: growth between the two largest points (1.0 = linear, > {threshold} is flagged)")
+    if flagged:
+        print(f"⚠️ {len(flagged)} super-linear queries:")
+        for result in flagged:
+            print(f"   {result['lab']}: {result['name']}")
+    else:
+        print("✅ No query grows faster than linear in the number of instances")
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how the lab queries scale with the number of instances')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'Comma-separated instance counts (default: {DEFAULT_SIZES})')
+    parser.add_argument('--cpus', type=int, default=2, help='CPUs per synthetic instance offline (default: 2)')
+    parser.add_argument('--iterations', type=int, default=3, help='Runs per query and point (default: 3)')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Growth exponent above which a query counts as super-linear (default: 1.2)')
+    parser.add_argument('--live', action='store_true',
+                        help='Run against the Prometheus in config.json instead of the offline evaluator')
+    parser.add_argument('--output', metavar='FILE', help='Write the sweep results as JSON')
+    args = parser.parse_args()
+
+    try:
+        sizes = sorted({int(size) for size in args.sizes.split(',')})
+    except ValueError:
+        print(f"❌ Invalid --sizes: {args.sizes}")
+        return 1
+
+    config = load_config()
+    session = create_session()
+    selected = sweep_queries()
+    if args.live:
+        check_prerequisites(config['prometheus_url'], session)
+        points = live_points(sizes, config['prometheus_url'], config['instance_name'])
+    else:
+        points = offline_points(sizes, args.cpus)
+
+    print(f"\n===== Cardinality Sweep: {len(selected)} queries at {', '.join(map(str, sizes))} instances =====\n")
+    results = [{"name": query_info['name'], "lab": lab, "points": []} for lab, query_info, _ in selected]
+    for size, prometheus_url, eval_time, instances in points:
+        for result, (_, query_info, node) in zip(results, selected):
+            sys.stdout.write(f"\r⏱️  {size} instances: {query_info['name'][:50]:<50}")
+            sys.stdout.flush()
+            point = measure(session, prometheus_url, scoped_query(node, instances), eval_time, args.iterations)
+            point['instances'] = size
+            result['points'].append(point)
+        print("\r" + " " * 90 + "\r", end="")
+
+    for result in results:
+        result['latency_exponent'] = growth_exponent(result['points'], 'wall_ms')
+        result['samples_exponent'] = growth_exponent(result['points'], 'peak_samples')
+        result['super_linear'] = any(e is not None and e > args.threshold
+                                     for e in (result['latency_exponent'], result['samples_exponent']))
+    print()
+    print_table(results, sizes, args.threshold)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"created": datetime.now().isoformat(timespec='seconds'),
+                       "mode": "live" if args.live else "offline",
+                       "sizes": sizes,
+                       "threshold": args.threshold,
+                       "queries": results}, f, indent=2)
+        print(f"\nResults saved to: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Record/replay support for the PromQL test scripts.
+
+In record mode every /api/v1/query response is captured from a live
+Prometheus and saved to a compact cassette file. In replay mode the
+cassette is served by a small in-process HTTP stand-in so the test
+scripts can run offline in milliseconds.
+
+Responses are keyed by the normalized query plus the evaluation time, so
+a replay lookup is a single dict access no matter how big the catalog is.
+Recording pins one evaluation time for the run; replay sends the same
+time back so every lookup lands on a recorded key. Queries recorded at a
+later time (e.g. a --wait-ready batch that became ready later) are
+remembered in query_times, and replay at the pinned time finds them there.
+"""
+
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CASSETTE_VERSION = 1
+QUERY_PATH = '/api/v1/query'
+
+def normalize_query(query):
+    """Collapse whitespace so formatting differences map to the same key"""
+    return ' '.join(query.split())
+
+def cassette_key(query, eval_time):
+    """Build the lookup key for a query evaluated at eval_time"""
+    return f"{float(eval_time):.3f} {normalize_query(query)}"
+
+class Cassette:
+    """A set of recorded Prometheus query responses."""
+
+    def __init__(self, eval_time=None, meta=None, entries=None, query_times=None):
+        # Round to milliseconds so the pinned time survives a trip through a URL
+        self.eval_time = round(eval_time if eval_time is not None else time.time(), 3)
+        # Free-form details about the recording, e.g. the Prometheus URL and instance
+        self.meta = meta if meta is not None else {}
+        self.entries = entries if entries is not None else {}
+        # Normalized query -> evaluation time, for queries not recorded at eval_time
+        self.query_times = query_times if query_times is not None else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Load a cassette written by save()"""
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version in {path}: {data.get('version')}")
+        return cls(eval_time=data['eval_time'], meta=data.get('meta'), entries=data['entries'],
+                   query_times=data.get('query_times'))
+
+    def save(self, path):
+        """Write the cassette as compact JSON (gzipped if the path ends in .gz)"""
+        data = {
+            'version': CASSETTE_VERSION,
+            'eval_time': self.eval_time,
+            'meta': self.meta,
+            'entries': self.entries,
+            'query_times': self.query_times
+        }
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'), sort_keys=True)
+
+    def add(self, query, eval_time, status_code, body):
+        """Record one response body (already decoded from JSON)"""
+        with self._lock:
+            self.entries[cassette_key(query, eval_time)] = {'code': status_code, 'body': body}
+            if float(eval_time) != self.eval_time:
+                self.query_times[normalize_query(query)] = float(eval_time)
+
+    def lookup(self, query, eval_time):
+        """Return the recorded entry for a query, or None on a cassette miss"""
+        entry = self.entries.get(cassette_key(query, eval_time))
+        if entry is None and float(eval_time) == self.eval_time:
+            recorded_at = self.query_times.get(normalize_query(query))
+            if recorded_at is not None:
+                entry = self.entries.get(cassette_key(query, recorded_at))
+        return entry
+
+    def record_response(self, response, *args, **kwargs):
+        """requests response hook that stores /api/v1/query responses"""
+        url = urlparse(response.request.url)
+        if url.path.rstrip('/').endswith(QUERY_PATH):
+            params = parse_qs(url.query)
+            form = response.request.body
+            if form:
+                params.update(parse_qs(form.decode() if isinstance(form, bytes) else form))
+            query = params.get('query', [''])[0]
+            eval_time = params.get('time', [self.eval_time])[0]
+            try:
+                body = response.json()
+            except ValueError:
+                body = {'status': 'error', 'errorType': 'bad_data', 'error': response.text}
+            self.add(query, eval_time, response.status_code, body)
+        return response
+
+    def attach(self, session):
+        """Record every response that goes through a requests session"""
+        session.hooks['response'].append(self.record_response)
+        return session
+
+def _make_handler(cassette):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass  # Keep the test output readable
+
+        def _send(self, code, payload):
+            if isinstance(payload, str):
+                body, content_type = payload.encode(), 'text/plain; charset=utf-8'
+            else:
+                body, content_type = json.dumps(payload, separators=(',', ':')).encode(), 'application/json'
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, params):
+            path = urlparse(self.path).path
+            if path == '/-/healthy' or path == '/-/ready':
+                self._send(200, 'Prometheus Server is Healthy.')
+                return
+            if path.rstrip('/') != QUERY_PATH:
+                self._send(404, {'status': 'error', 'errorType': 'not_found',
+                                 'error': f'{path} is not recorded in the cassette'})
+                return
+            query = params.get('query', [''])[0]
+            eval_time = params.get('time', [cassette.eval_time])[0]
+            entry = cassette.lookup(query, eval_time)
+            if entry is None:
+                self._send(404, {'status': 'error', 'errorType': 'cassette_miss',
+                                 'error': f'no recorded response for query: {normalize_query(query)}'})
+            else:
+                self._send(entry['code'], entry['body'])
+
+        def do_GET(self):
+            self._handle(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            params = parse_qs(urlparse(self.path).query)
+            params.update(parse_qs(self.rfile.read(length).decode()))
+            self._handle(params)
+
+    return ReplayHandler
+
+def start_replay_server(cassette, host='127.0.0.1', port=0):
+    """Serve a cassette from a background thread and return (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), _make_handler(cassette))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -5,11 +5,16 @@ This script scans all markdown files for ```promql blocks and compares them
 with the queries in the test suite.
 """
 
+import argparse
+import hashlib
 import os
 import sys
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import json
+from check_query_types import infer_type
+from promql_parser import PromQLSyntaxError, canonical_query, parse
 from queries import all_queries
 
 # Find the root directory (the one containing this script)
@@ -20,6 +25,11 @@ root_dir = os.path.dirname(script_dir)
 # This pattern matches ```promql followed by any content until the next ```
 promql_pattern = re.compile(r'```promql\s*([\s\S]*?)\s*```')
 
+# Per-file cache of extracted queries, keyed by content hash
+default_cache_path = os.path.join(script_dir, '.query_coverage_cache.json')
+CACHE_VERSION = 1
+PARALLEL_MIN_FILES = 8
+
 # Directories to scan for markdown files
 dirs_to_scan = [
     os.path.join(root_dir, "Beginner"),
@@ -28,37 +38,31 @@ dirs_to_scan = [
 ]
 
 def clean_query(query):
-    """Clean and normalize a PromQL query for comparison."""
+    """Normalize a PromQL query to its canonical form for comparison.
+
+    Queries are parsed and rendered back with sorted label matchers,
+    normalized durations and by/without placement, so two queries match
+    only if they are the same expression. A query that does not parse is
+    returned whitespace-collapsed and will be reported as untested.
+    """
     # Handle example markers 
     if query.strip().startswith('>'):
         return query.strip()
         
-    # Remove comments
-    query = re.sub(r'#.*$', '', query, flags=re.MULTILINE)
-    # Remove whitespace
-    query = re.sub(r'\s+', ' ', query).strip()
-    # Remove redundant spaces around operators and parentheses
-    query = re.sub(r'\s*([=<>!~(){},:])\s*', r'\1', query)
-    # Standardize spaces after commas
-    query = re.sub(r',\s*', r',', query)
-    # Normalize quotes (replace single quotes with double quotes)
-    query = re.sub(r"'([^']*)'", r'"\1"', query)
     # Normalize instance references for comparison
-    query = query.replace('"localhost:9100"', '"$INSTANCE"')
     query = query.replace('localhost:9100', '$INSTANCE')
-    
-    # Normalize time windows (important for subqueries)
-    query = re.sub(r'\[(\d+)m:', r'[5m:', query)  # Normalize outer window in subqueries
-    query = re.sub(r'\[(\d+)m\]', r'[5m]', query)  # Normalize time windows to 5m
-    
-    # Normalize boolean comparison operators
-    query = re.sub(r'>bool', r'> bool', query)
-    query = re.sub(r'<bool', r'< bool', query)
-    
-    # Remove extra spaces between function name and parenthesis
-    query = re.sub(r'(\w+)\s+\(', r'\1(', query)
-    
-    return query
+    try:
+        return canonical_query(query)
+    except PromQLSyntaxError:
+        return ' '.join(query.split())
+
+def syntax_error(query):
+    """Return the parse or type error for a query, or None if it is valid PromQL."""
+    try:
+        infer_type(parse(query))
+        return None
+    except PromQLSyntaxError as e:
+        return str(e)
 
 def extract_queries_from_file(file_path):
     """Extract all PromQL queries from a markdown file."""
@@ -118,19 +122,113 @@ def get_test_queries():
         "clean_query": clean_query(q["query"])
     } for q in all_queries]
 
-def find_all_lab_queries():
-    """Find all PromQL queries in the lab markdown files."""
-    all_lab_queries = []
-    
+def list_lab_files():
+    """List the lab markdown files to scan, in a stable order."""
+    files = []
     for dir_path in dirs_to_scan:
-        for file in os.listdir(dir_path):
+        for file in sorted(os.listdir(dir_path)):
             # Skip quiz files - they contain illustrative examples not meant to be run
             if file.endswith('.md') and not file.startswith('Quiz_'):
-                file_path = os.path.join(dir_path, file)
-                all_lab_queries.extend(extract_queries_from_file(file_path))
-    
+                files.append(os.path.join(dir_path, file))
+    return files
+
+def normalizer_fingerprint():
+    """Hash of the code that extracts and cleans queries.
+
+    Cached results are only valid for the parser and cleaning rules that
+    produced them, so any change to either file invalidates the cache.
+    """
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    for source in (os.path.abspath(__file__), os.path.join(script_dir, 'promql_parser.py')):
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def load_cache(path, fingerprint):
+    """Load the scan cache, or return an empty one if it is missing or stale."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get("fingerprint") == fingerprint:
+            return cache["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+def save_cache(path, fingerprint, files):
+    """Write the scan cache atomically so an interrupted run can't corrupt it."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"fingerprint": fingerprint, "files": files}, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def find_all_lab_queries(cache_path=None, jobs=None):
+    """Find all PromQL queries in the lab markdown files.
+
+    With a cache_path, results are cached per file keyed by the file's
+    content hash. Only new or changed files are parsed, in parallel
+    worker processes when there are several of them.
+    """
+    files = list_lab_files()
+    if cache_path is None:
+        return [query for file_path in files for query in extract_queries_from_file(file_path)]
+
+    fingerprint = normalizer_fingerprint()
+    cache = load_cache(cache_path, fingerprint)
+    entries = {}
+    misses = []
+    for file_path in files:
+        key = os.path.relpath(file_path, root_dir)
+        with open(file_path, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        cached = cache.get(key)
+        if cached and cached["sha1"] == content_hash:
+            entries[key] = cached
+        else:
+            entries[key] = {"sha1": content_hash, "queries": None}
+            misses.append(file_path)
+
+    # Starting worker processes only pays off for more than a handful of files
+    if len(misses) >= PARALLEL_MIN_FILES and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            parsed = list(executor.map(extract_queries_from_file, misses))
+    else:
+        parsed = [extract_queries_from_file(file_path) for file_path in misses]
+    for file_path, queries in zip(misses, parsed):
+        entries[os.path.relpath(file_path, root_dir)]["queries"] = [
+            {"raw_query": q["raw_query"], "clean_query": q["clean_query"]} for q in queries
+        ]
+
+    print(f"  ({len(files) - len(misses)} files from cache, {len(misses)} parsed)")
+    if misses or set(cache) != set(entries):
+        save_cache(cache_path, fingerprint, entries)
+
+    all_lab_queries = []
+    for key, entry in entries.items():
+        file_path = os.path.join(root_dir, key)
+        all_lab_queries.extend(dict(query, file=file_path) for query in entry["queries"])
     return all_lab_queries
 
+# Tokens used for the closest-match hint on untested queries
+metric_pattern = re.compile(r'node_\w+')
+function_pattern = re.compile(r'([a-z_]+)\(')
+
+def query_tokens(query):
+    """Extract the metric names and function names used by a cleaned query."""
+    return set(metric_pattern.findall(query)), set(function_pattern.findall(query))
+
+def closest_test_query(query, test_queries):
+    """Return (score, test query) for the most similar test query, or (0, None)."""
+    tokens = query_tokens(query)
+    best_score = 0
+    best_match = None
+    for test_query in test_queries:
+        score = token_similarity(tokens, query_tokens(test_query["clean_query"]))
+        if score > best_score:
+            best_score = score
+            best_match = test_query["clean_query"]
+    return best_score, best_match
+
 def find_untested_queries(lab_queries, test_queries):
     """Find queries in the labs that don't have corresponding tests."""
     untested = []
@@ -138,6 +236,9 @@ def find_untested_queries(lab_queries, test_queries):
     
     # Create a list of cleaned test queries for easier comparison
     clean_test_queries = [test_query["clean_query"] for test_query in test_queries]
+    test_names = {}
+    for test_query in test_queries:
+        test_names.setdefault(test_query["clean_query"], test_query["name"])
     
     # Debug information
     print("\nDEBUG: Example test queries (first 5):")
@@ -149,71 +250,12 @@ def find_untested_queries(lab_queries, test_queries):
         if lab_query["clean_query"].startswith('>') or not lab_query["clean_query"].strip():
             continue
             
-        matched = False
-        best_match = None
-        best_score = 0
+        # Both sides are in canonical form, so matching is a single dict lookup
         lab_clean = lab_query["clean_query"]
-        
-        # Try different matching strategies:
-        
-        # 1. Direct comparison
-        if lab_clean in clean_test_queries:
-            matched = True
-            best_match = lab_clean
-            best_score = 100
-        
-        # 2. Try matching after additional normalization
-        if not matched:
-            # Try without specific mode filters - check if there's a more generic test
-            simplified_query = re.sub(r'mode="[^"]*"', 'mode="$MODE"', lab_clean)
-            if simplified_query in clean_test_queries:
-                matched = True
-                best_match = simplified_query
-                best_score = 95
-            
-            # Try matching recording rules with their equivalents
-            if "instance:node_cpu_usage:percent" in lab_clean:
-                # Match with equivalent CPU usage calculation
-                for idx, test_query in enumerate(clean_test_queries):
-                    if "100 * (1 - (" in test_query and "mode=\"idle\"" in test_query:
-                        matched = True
-                        best_match = test_query
-                        best_score = 90
-                        break
-        
-        # 3. For complex queries, try partial matching with key elements
-        if not matched and (
-            "max_over_time" in lab_clean or 
-            "offset" in lab_clean or
-            "floor(" in lab_clean or
-            "clamp_max" in lab_clean
-        ):
-            # For these complex queries, look for test queries that contain the same key functions/operations
-            for test_query in clean_test_queries:
-                functions_in_lab = set(re.findall(r'([a-z_]+)\(', lab_clean))
-                if all(func in test_query for func in functions_in_lab):
-                    matched = True
-                    best_match = test_query
-                    best_score = 85
-                    break
-        
-        # 4. Use similarity matching for anything still not matched
-        if not matched:
-            for test_query in clean_test_queries:
-                similarity = query_similarity(lab_clean, test_query)
-                if similarity > 80 and similarity > best_score:  # High similarity threshold
-                    matched = True
-                    best_match = test_query
-                    best_score = similarity
-        
-        if not matched:
-            untested.append(lab_query)
+        if lab_clean in test_names:
+            matched_queries[lab_clean] = test_names[lab_clean]
         else:
-            # Store match information for debugging
-            matched_queries[lab_clean] = {
-                "test_query": best_match,
-                "score": best_score
-            }
+            untested.append(lab_query)
     
     # Print match statistics for debugging
     if matched_queries:
@@ -221,14 +263,10 @@ def find_untested_queries(lab_queries, test_queries):
         
     return untested
 
-def query_similarity(query1, query2):
-    """Calculate a similarity score between two queries (0-100)."""
-    # Extract core metrics and functions
-    metrics1 = set(re.findall(r'node_\w+', query1))
-    metrics2 = set(re.findall(r'node_\w+', query2))
-    
-    functions1 = set(re.findall(r'([a-z_]+)\(', query1))
-    functions2 = set(re.findall(r'([a-z_]+)\(', query2))
+def token_similarity(tokens1, tokens2):
+    """Calculate a similarity score (0-100) from two (metrics, functions) token pairs."""
+    metrics1, functions1 = tokens1
+    metrics2, functions2 = tokens2
     
     # Calculate metrics and functions overlap
     metrics_overlap = len(metrics1.intersection(metrics2)) / max(1, len(metrics1.union(metrics2))) * 50
@@ -238,8 +276,17 @@ def query_similarity(query1, query2):
 
 def main():
     """Main function to compare lab queries with test queries."""
+    parser = argparse.ArgumentParser(description='Check that every lab PromQL query has a test')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Re-scan every markdown file instead of using the scan cache')
+    parser.add_argument('--cache-file', default=default_cache_path,
+                        help='Where to keep the per-file scan cache (default: Tests/.query_coverage_cache.json)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Worker processes for parsing changed files (default: one per CPU)')
+    args = parser.parse_args()
+
     print("Scanning labs for PromQL queries...")
-    lab_queries = find_all_lab_queries()
+    lab_queries = find_all_lab_queries(None if args.no_cache else args.cache_file, args.jobs)
     
     # Filter out example queries marked with '>' and empty queries
     real_lab_queries = [q for q in lab_queries if not q["clean_query"].startswith('>') and q["clean_query"].strip()]
@@ -263,15 +310,12 @@ def main():
             print(f"\n{idx}. Query in {relative_path}:")
             print(f"   Raw: {query['raw_query']}")
             print(f"   Cleaned: {query['clean_query']}")
+            error = syntax_error(query["raw_query"])
+            if error:
+                print(f"   Invalid PromQL: {error}")
             
             # Show the closest matching test query for debugging
-            closest_match = None
-            best_score = 0
-            for test_query in get_test_queries():
-                score = query_similarity(query["clean_query"], test_query["clean_query"])
-                if score > best_score:
-                    best_score = score
-                    closest_match = test_query["clean_query"]
+            best_score, closest_match = closest_test_query(query["clean_query"], test_queries)
             
             if closest_match and best_score > 50:
                 print(f"   Best match ({best_score:.0f}% similarity): {closest_match}")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Check the query catalog for syntax and type errors without a Prometheus server.
+
+Every query in queries.all_queries is parsed (promql_parser.py) and its
+result type is inferred from the expression tree with the same rules
+Prometheus applies before evaluating: range functions need a range
+vector, aggregations an instant vector, set operators two vectors, and so
+on. The inferred type is compared with the entry's expected_type, using
+the resultType names of the HTTP API (vector, matrix, scalar, string).
+
+test_queries.py runs the same check before sending each query, so a
+broken entry is reported without a round trip to the server.
+
+Usage:
+    python check_query_types.py [--verbose]
+"""
+
+import argparse
+import sys
+import time
+from promql_parser import (AggregateExpr, BinaryExpr, Call, COMPARISON_OPS, MatrixSelector, NumberLiteral,
+                           PromQLSyntaxError, SET_OPS, StringLiteral, SubqueryExpr, UnaryExpr, VectorSelector,
+                           parse, strip_parens)
+
+VECTOR, MATRIX, SCALAR, STRING = 'vector', 'matrix', 'scalar', 'string'
+# How Prometheus names the types in its error messages
+TYPE_NAMES = {VECTOR: 'instant vector', MATRIX: 'range vector', SCALAR: 'scalar', STRING: 'string'}
+
+# name -> (argument types, variadic, return type), as in Prometheus's function table:
+# variadic 0 = exactly these arguments, n > 0 = the last n may be left out, -1 = the last one repeats
+_MATH = ('abs', 'ceil', 'floor', 'exp', 'ln', 'log2', 'log10', 'sqrt', 'sgn', 'deg', 'rad',
+         'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'asinh', 'acosh', 'atanh',
+         'sort', 'sort_desc', 'timestamp', 'absent', 'histogram_count', 'histogram_sum',
+         'histogram_avg', 'histogram_stddev', 'histogram_stdvar')
+_RANGE = ('rate', 'irate', 'increase', 'delta', 'idelta', 'deriv', 'changes', 'resets', 'absent_over_time',
+          'avg_over_time', 'min_over_time', 'max_over_time', 'sum_over_time', 'count_over_time',
+          'stddev_over_time', 'stdvar_over_time', 'last_over_time', 'present_over_time', 'mad_over_time')
+_CALENDAR = ('day_of_month', 'day_of_week', 'day_of_year', 'days_in_month', 'hour', 'minute', 'month', 'year')
+FUNCTIONS = {
+    **{name: ((VECTOR,), 0, VECTOR) for name in _MATH},
+    **{name: ((MATRIX,), 0, VECTOR) for name in _RANGE},
+    **{name: ((VECTOR,), 1, VECTOR) for name in _CALENDAR},
+    'clamp': ((VECTOR, SCALAR, SCALAR), 0, VECTOR),
+    'clamp_min': ((VECTOR, SCALAR), 0, VECTOR),
+    'clamp_max': ((VECTOR, SCALAR), 0, VECTOR),
+    'round': ((VECTOR, SCALAR), 1, VECTOR),
+    'quantile_over_time': ((SCALAR, MATRIX), 0, VECTOR),
+    'predict_linear': ((MATRIX, SCALAR), 0, VECTOR),
+    'holt_winters': ((MATRIX, SCALAR, SCALAR), 0, VECTOR),
+    'double_exponential_smoothing': ((MATRIX, SCALAR, SCALAR), 0, VECTOR),
+    'histogram_quantile': ((SCALAR, VECTOR), 0, VECTOR),
+    'histogram_fraction': ((SCALAR, SCALAR, VECTOR), 0, VECTOR),
+    'label_replace': ((VECTOR, STRING, STRING, STRING, STRING), 0, VECTOR),
+    'label_join': ((VECTOR, STRING, STRING, STRING), -1, VECTOR),
+    'sort_by_label': ((VECTOR, STRING), -1, VECTOR),
+    'sort_by_label_desc': ((VECTOR, STRING), -1, VECTOR),
+    'scalar': ((VECTOR,), 0, SCALAR),
+    'vector': ((SCALAR,), 0, VECTOR),
+    'time': ((), 0, SCALAR),
+    'pi': ((), 0, SCALAR),
+}
+# Aggregations that take a parameter, and its type
+AGGREGATION_PARAMS = {'topk': SCALAR, 'bottomk': SCALAR, 'quantile': SCALAR, 'limitk': SCALAR,
+                      'limit_ratio': SCALAR, 'count_values': STRING}
+
+class PromQLTypeError(PromQLSyntaxError):
+    """Raised when a query parses but Prometheus would reject its types."""
+
+def _expect(value_type, allowed, context):
+    if value_type not in allowed:
+        wanted = ' or '.join(TYPE_NAMES[t] for t in allowed)
+        raise PromQLTypeError(f"expected type {wanted} in {context}, got {TYPE_NAMES[value_type]}")
+
+def _check_call(node):
+    signature = FUNCTIONS.get(node.func)
+    if signature is None:
+        raise PromQLTypeError(f"unknown function {node.func!r}")
+    arg_types, variadic, return_type = signature
+    count = len(node.args)
+    if variadic == 0:
+        valid = count == len(arg_types)
+    elif variadic > 0:
+        valid = len(arg_types) - variadic <= count <= len(arg_types)
+    else:
+        valid = count >= len(arg_types)
+    if not valid:
+        raise PromQLTypeError(f"wrong number of arguments in call to {node.func}(): got {count}")
+    for i, arg in enumerate(node.args):
+        expected = arg_types[min(i, len(arg_types) - 1)]
+        _expect(infer_type(arg), (expected,), f"call to function {node.func!r}")
+    return return_type
+
+def _check_binary(node):
+    lhs, rhs = infer_type(node.lhs), infer_type(node.rhs)
+    for side in (lhs, rhs):
+        _expect(side, (SCALAR, VECTOR), "binary expression")
+    if node.return_bool and node.op not in COMPARISON_OPS:
+        raise PromQLTypeError("bool modifier can only be used on comparison operators")
+    if node.op in SET_OPS and (lhs != VECTOR or rhs != VECTOR):
+        raise PromQLTypeError(f"set operator {node.op!r} not allowed in binary scalar expression")
+    if lhs == SCALAR and rhs == SCALAR:
+        if node.op in COMPARISON_OPS and not node.return_bool:
+            raise PromQLTypeError("comparisons between scalars must use BOOL modifier")
+        return SCALAR
+    if node.matching is not None and (node.matching.has_labels or node.matching.card != 'one-to-one') \
+            and (lhs != VECTOR or rhs != VECTOR):
+        raise PromQLTypeError("vector matching only allowed between instant vectors")
+    return VECTOR
+
+def infer_type(node):
+    """Result type of an expression tree (vector, matrix, scalar or string); raises PromQLTypeError"""
+    node = strip_parens(node)
+    if isinstance(node, NumberLiteral):
+        return SCALAR
+    if isinstance(node, StringLiteral):
+        return STRING
+    if isinstance(node, VectorSelector):
+        return VECTOR
+    if isinstance(node, MatrixSelector):
+        return MATRIX
+    if isinstance(node, SubqueryExpr):
+        _expect(infer_type(node.expr), (VECTOR,), "subquery")
+        return MATRIX
+    if isinstance(node, Call):
+        return _check_call(node)
+    if isinstance(node, AggregateExpr):
+        param_type = AGGREGATION_PARAMS.get(node.op)
+        if param_type is not None:
+            if node.param is None:
+                raise PromQLTypeError(f"no parameter given to aggregation {node.op!r}")
+            _expect(infer_type(node.param), (param_type,), f"aggregation parameter of {node.op!r}")
+        _expect(infer_type(node.expr), (VECTOR,), "aggregation expression")
+        return VECTOR
+    if isinstance(node, UnaryExpr):
+        inner = infer_type(node.expr)
+        _expect(inner, (SCALAR, VECTOR), "unary expression")
+        return inner
+    if isinstance(node, BinaryExpr):
+        return _check_binary(node)
+    raise PromQLTypeError(f"cannot type {type(node).__name__}")
+
+def check_query(query):
+    """Return (inferred type, None) for a valid query, or (None, error message)"""
+    try:
+        return infer_type(parse(query.replace('\\"', '"'))), None
+    except PromQLTypeError as e:
+        return None, f"type error: {e}"
+    except PromQLSyntaxError as e:
+        return None, f"syntax error: {e}"
+
+def check_catalog(queries):
+    """(query info, inferred type, problem or None) for every catalog entry"""
+    checked = []
+    for query_info in queries:
+        inferred, error = check_query(query_info['query'])
+        if error is None and inferred != query_info['expected_type']:
+            error = f"TYPE MISMATCH (inferred {inferred}, expected {query_info['expected_type']})"
+        checked.append((query_info, inferred, error))
+    return checked
+
+def main():
+    from queries import all_queries
+
+    parser = argparse.ArgumentParser(description='Check the query catalog for syntax and type errors offline')
+    parser.add_argument('--verbose', action='store_true', help='Print the inferred type of every query')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    checked = check_catalog(all_queries)
+    elapsed = (time.perf_counter() - started) * 1000
+
+    problems = [(query_info, error) for query_info, _, error in checked if error]
+    if args.verbose:
+        for query_info, inferred, error in checked:
+            print(f"{'❌' if error else '✅'} {inferred or '-':<7} {query_info['name']}")
+    for query_info, error in problems:
+        print(f"❌ {query_info['name']}: {error}")
+        print(f"   Query: {query_info['query']}")
+    if problems:
+        print(f"\n{len(problems)} of {len(checked)} catalog queries are invalid ({elapsed:.0f} ms)")
+        return 1
+    print(f"✅ All {len(checked)} catalog queries parse and return their expected type ({elapsed:.0f} ms)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+A fake node_exporter fleet for scale testing the lab queries.
+
+One process serves every virtual instance of a synthetic_fleet.Fleet:
+
+    /metrics/<instance>   one instance, like a real node_exporter
+                          (Prometheus adds the instance and job labels)
+    /metrics              the whole fleet with instance and job labels,
+                          for a single scrape job with honor_labels: true
+
+--scrape-config writes a Prometheus scrape job that scrapes each virtual
+instance as its own target, so `up`, `instance` and the target count
+look like a real fleet of that size.
+
+Label sets never change, so each series' text prefix is rendered once;
+a scrape only computes the values for the current time (vectorized, and
+shared by all scrapes within --resolution seconds) and joins them to the
+prefixes.
+
+--backfill writes the same data as an OpenMetrics file instead, for
+`promtool tsdb create-blocks-from openmetrics`.
+
+Usage:
+    python fake_exporter.py [--instances N] [--cpus N] [--port PORT] [--scrape-config FILE]
+    python fake_exporter.py --backfill FILE [--instances N] [--cpus N] [--hours H] [--interval SECONDS]
+
+Examples:
+    python fake_exporter.py --instances 5000 --cpus 64 --scrape-config fleet.yml
+    python fake_exporter.py --instances 100 --backfill fleet.om --hours 6
+"""
+
+import argparse
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+import numpy as np
+from synthetic_fleet import DEFAULT_INSTANCE, Fleet
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Labels Prometheus attaches from the target; a real exporter does not expose them
+TARGET_LABELS = ('instance', 'job')
+# Families Prometheus produces itself or scrapes from other targets
+NOT_EXPORTED = ('up', 'prometheus_http_request_duration_seconds')
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def series_prefixes(family, with_target_labels):
+    """'name{labels} ' for every series of a family, in series order"""
+    names = family.sample_names if family.sample_names is not None else [family.name] * len(family)
+    # Each distinct value of a label column is rendered once and picked per series
+    columns = []
+    for key, values in family.labels.items():
+        if with_target_labels or key not in TARGET_LABELS:
+            unique, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+            rendered = [f'{key}="{escape_label_value(str(value))}"' if value != '' else None for value in unique]
+            columns.append([rendered[j] for j in inverse])
+    prefixes = []
+    for i in range(len(family)):
+        labels = ','.join(column[i] for column in columns if column[i] is not None)
+        prefixes.append(f"{names[i]}{{{labels}}} " if labels else f"{names[i]} ")
+    return prefixes
+
+def format_values(values):
+    """Render sample values for the text format (repr round-trips float64 exactly)"""
+    return [repr(v) if v == v else 'NaN' for v in values.tolist()]
+
+class FleetExporter:
+    """Renders the text exposition of a fleet, per instance or for the whole fleet."""
+
+    def __init__(self, fleet, resolution=1.0):
+        self.fleet = fleet
+        self.resolution = resolution
+        self.families = [f for f in fleet.families if f.name not in NOT_EXPORTED]
+        self.instance_index = {name: i for i, name in enumerate(fleet.instances)}
+        self._lock = threading.Lock()
+        self._values = (None, None)
+        self._full_prefixes = None
+        # Per family: series ordered by instance, where each instance's rows start, and their prefixes
+        self._layout = []
+        for family in self.families:
+            instances = np.fromiter((self.instance_index[str(i)] for i in family.labels['instance']),
+                                    dtype=np.int64, count=len(family))
+            order = np.argsort(instances, kind='stable')
+            starts = np.searchsorted(instances[order], np.arange(len(fleet.instances) + 1))
+            prefixes = series_prefixes(family, with_target_labels=False)
+            self._layout.append((order, starts, [prefixes[i] for i in order]))
+
+    def values(self, now=None):
+        """Current values of every family, computed once per resolution tick"""
+        now = time.time() if now is None else now
+        tick = np.floor(now / self.resolution) * self.resolution
+        with self._lock:
+            cached_tick, values = self._values
+            if cached_tick != tick:
+                values = [family.values_at([tick])[:, 0] for family in self.families]
+                self._values = (tick, values)
+        return values
+
+    def _header(self, family):
+        return f"# HELP {family.name} {family.help}\n# TYPE {family.name} {family.type}\n"
+
+    def render_instance(self, instance, now=None):
+        """Text exposition for one virtual instance, or None if it is not in the fleet"""
+        index = self.instance_index.get(instance)
+        if index is None:
+            return None
+        parts = []
+        for family, values, (order, starts, prefixes) in zip(self.families, self.values(now), self._layout):
+            rows = slice(starts[index], starts[index + 1])
+            parts.append(self._header(family))
+            parts.append(''.join(map('{}{}\n'.format, prefixes[rows], format_values(values[order[rows]]))))
+        return ''.join(parts)
+
+    def render_fleet(self, now=None):
+        """Text exposition for every instance, with instance and job labels"""
+        if self._full_prefixes is None:
+            self._full_prefixes = [series_prefixes(family, with_target_labels=True) for family in self.families]
+        parts = []
+        for family, values, prefixes in zip(self.families, self.values(now), self._full_prefixes):
+            parts.append(self._header(family))
+            parts.append(''.join(map('{}{}\n'.format, prefixes, format_values(values))))
+        return ''.join(parts)
+
+def write_backfill(fleet, path, start, end, interval, extra_families=()):
+    """Write the fleet from start to end as an OpenMetrics file for promtool.
+
+    OpenMetrics wants each family's samples together and each series'
+    samples in time order, so the file is written family by family and
+    series by series. Timestamps are in seconds. extra_families (e.g.
+    precomputed recording rule series) are written after the fleet; NaN
+    values mark missing samples and are left out.
+    """
+    timestamps = np.arange(start, end + interval / 2, interval)
+    stamps = [f" {t:.0f}\n" for t in timestamps]
+    samples = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for family in list(fleet.families) + list(extra_families):
+            # OpenMetrics counter families are named without the _total suffix
+            name = family.name[:-len('_total')] if family.type == 'counter' else family.name
+            f.write(f"# HELP {name} {family.help}\n# TYPE {name} {family.type}\n")
+            prefixes = series_prefixes(family, with_target_labels=True)
+            values = family.values_at(timestamps)
+            for prefix, row in zip(prefixes, values):
+                f.write(''.join(prefix + value + stamp for value, stamp in zip(format_values(row), stamps)
+                                if value != 'NaN'))
+            samples += int(np.count_nonzero(~np.isnan(values)))
+        f.write("# EOF\n")
+    return samples
+
+def scrape_config(fleet, address, job='node', scrape_interval='15s'):
+    """A Prometheus scrape job with one target per virtual instance"""
+    lines = [
+        f"  - job_name: {job}",
+        f"    scrape_interval: {scrape_interval}",
+        "    static_configs:",
+        "      - targets:",
+    ]
+    lines += [f"          - '{instance}'" for instance in fleet.instances]
+    lines += [
+        "    relabel_configs:",
+        "      # Keep the virtual name as the instance, then scrape it from the fake exporter",
+        "      - source_labels: [__address__]",
+        "        target_label: instance",
+        "      - source_labels: [__address__]",
+        "        target_label: __metrics_path__",
+        "        replacement: /metrics/$1",
+        "      - target_label: __address__",
+        f"        replacement: {address}",
+    ]
+    return "\n".join(lines) + "\n"
+
+def _make_handler(exporter):
+    class ExporterHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass  # Thousands of scrapes a minute would drown the console
+
+        def _send(self, code, text, content_type=CONTENT_TYPE):
+            body = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = unquote(urlparse(self.path).path).rstrip('/')
+            if path == '/metrics':
+                self._send(200, exporter.render_fleet())
+            elif path.startswith('/metrics/'):
+                body = exporter.render_instance(path[len('/metrics/'):])
+                if body is None:
+                    self._send(404, f"unknown instance {path[len('/metrics/'):]}\n", 'text/plain')
+                else:
+                    self._send(200, body)
+            else:
+                self._send(200, f"Fake node_exporter fleet: {len(exporter.fleet.instances)} instances, "
+                                f"{exporter.fleet.cpus} CPUs each\nScrape /metrics or /metrics/<instance>\n",
+                           'text/plain')
+
+    return ExporterHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve or backfill a synthetic node_exporter fleet')
+    parser.add_argument('--instances', type=int, default=100, help='Virtual instances (default: 100)')
+    parser.add_argument('--cpus', type=int, default=4, help='CPUs per instance (default: 4)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the fleet (default: 42)')
+    parser.add_argument('--first-instance', default=DEFAULT_INSTANCE,
+                        help=f'Name of the first instance, matching config.json (default: {DEFAULT_INSTANCE})')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=9101, help='Port to listen on (default: 9101)')
+    parser.add_argument('--resolution', type=float, default=1.0,
+                        help='Scrapes within this many seconds share computed values (default: 1)')
+    parser.add_argument('--scrape-config', metavar='FILE',
+                        help='Write a Prometheus scrape job with one target per instance')
+    parser.add_argument('--backfill', metavar='FILE', help='Write an OpenMetrics backfill file instead of serving')
+    parser.add_argument('--hours', type=float, default=6, help='Hours of history to backfill (default: 6)')
+    parser.add_argument('--interval', type=float, default=15, help='Backfill sample interval in seconds (default: 15)')
+    parser.add_argument('--end', type=float, default=None, help='Backfill end as a Unix timestamp (default: now)')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    fleet = Fleet(instances=args.instances, cpus=args.cpus, seed=args.seed, first_instance=args.first_instance,
+                  include_prometheus=args.backfill is not None)
+    print(f"🖥️  {len(fleet.instances)} instances x {args.cpus} CPUs: {fleet.series_count} series "
+          f"(built in {time.perf_counter() - started:.1f}s)")
+
+    if args.backfill:
+        end = args.end if args.end is not None else np.floor(time.time() / args.interval) * args.interval
+        start = end - args.hours * 3600
+        started = time.perf_counter()
+        samples = write_backfill(fleet, args.backfill, start, end, args.interval)
+        print(f"✅ Wrote {samples} samples to {args.backfill} in {time.perf_counter() - started:.1f}s")
+        print(f"   promtool tsdb create-blocks-from openmetrics {args.backfill} ./data")
+        return 0
+
+    exporter = FleetExporter(fleet, args.resolution)
+    started = time.perf_counter()
+    body = exporter.render_instance(fleet.instances[0])
+    print(f"⏱️  One instance renders in {(time.perf_counter() - started) * 1000:.1f} ms ({len(body)} bytes)")
+
+    address = f"{args.host}:{args.port}"
+    if args.scrape_config:
+        with open(args.scrape_config, 'w') as f:
+            f.write(scrape_config(fleet, address))
+        print(f"📝 Scrape job written to {args.scrape_config} (add it under scrape_configs:)")
+
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(exporter))
+    server.daemon_threads = True
+    print(f"🚀 Serving http://{address}/metrics/<instance> (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️  Stopped")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Run a catalog query for many instances with one request where that is safe.
+
+A query scoped with instance="$INSTANCE" can be sent once with
+instance=~"a|b|c" and the result split on the instance label, as long as
+every output series still comes from exactly one instance and still
+carries its instance label. instance_plan() walks the expression tree and
+decides:
+
+    batched       one regex request, split per instance on the client
+    shared        no $INSTANCE at all: one request, the same result for every instance
+    per-instance  anything else, e.g. sum(x{instance="$INSTANCE"}) without by (instance),
+                  absent(), scalar(), on() matching that ignores instance, or $INSTANCE
+                  used in a regex or label_replace argument
+
+Usage (to see how the catalog would be planned):
+    python instance_batch.py
+"""
+
+import re
+import sys
+from check_query_types import SCALAR, infer_type
+from promql_parser import (AggregateExpr, BinaryExpr, Call, INSTANCE_PLACEHOLDER, LabelMatcher, MatrixSelector,
+                           NumberLiteral, PromQLSyntaxError, StringLiteral, SubqueryExpr, UnaryExpr, VectorSelector,
+                           canonicalize, parse, strip_parens, walk)
+
+BATCHED, SHARED, PER_INSTANCE = 'batched', 'shared', 'per-instance'
+# How a subexpression depends on the instance
+CONSTANT, PARTITIONED = 'constant', 'partitioned'
+# Functions whose result cannot be split by instance once their input spans several
+MERGING_FUNCTIONS = {'absent', 'absent_over_time', 'scalar'}
+
+class NotBatchable(Exception):
+    """Raised with the reason a query has to run once per instance."""
+
+def _is_placeholder(matcher):
+    return matcher.name == 'instance' and matcher.op == '=' and matcher.value == INSTANCE_PLACEHOLDER
+
+def _selector_scope(selector):
+    if any(_is_placeholder(m) for m in selector.matchers):
+        return PARTITIONED
+    return CONSTANT
+
+def _keeps_instance(matching):
+    """True if vector matching pairs series of the same instance only"""
+    if matching is None or not matching.has_labels:
+        return True
+    return matching.on == ('instance' in matching.labels)
+
+def _binary_scope(node):
+    lhs, rhs = instance_scope(node.lhs), instance_scope(node.rhs)
+    if lhs == CONSTANT and rhs == CONSTANT:
+        return CONSTANT
+    if SCALAR in (infer_type(node.lhs), infer_type(node.rhs)):
+        return PARTITIONED  # The scalar side is constant: a partitioned scalar is rejected earlier
+    if node.op == 'or' and CONSTANT in (lhs, rhs):
+        raise NotBatchable("'or' with a side that is not scoped to the instance")
+    if node.op == 'unless' and lhs == CONSTANT:
+        raise NotBatchable("'unless' on a left side that is not scoped to the instance")
+    if _keeps_instance(node.matching):
+        return PARTITIONED
+    # Matching ignores instance: only safe if the unscoped side is the "one" side or a filter
+    card = node.matching.card
+    if rhs == CONSTANT and (node.op in ('and', 'unless') or card == 'many-to-one'):
+        return PARTITIONED
+    if lhs == CONSTANT and card == 'one-to-many':
+        return PARTITIONED
+    raise NotBatchable(f"vector matching across instances in '{node.op}'")
+
+def instance_scope(node):
+    """CONSTANT if an expression does not depend on $INSTANCE, PARTITIONED if its result splits
+    cleanly by instance; raises NotBatchable otherwise"""
+    node = strip_parens(node)
+    if isinstance(node, (NumberLiteral, StringLiteral)):
+        if isinstance(node, StringLiteral) and INSTANCE_PLACEHOLDER in node.value:
+            raise NotBatchable("$INSTANCE inside a string argument")
+        return CONSTANT
+    if isinstance(node, VectorSelector):
+        return _selector_scope(node)
+    if isinstance(node, MatrixSelector):
+        return _selector_scope(node.vector)
+    if isinstance(node, (SubqueryExpr, UnaryExpr)):
+        return instance_scope(node.expr)
+    if isinstance(node, Call):
+        scopes = [instance_scope(arg) for arg in node.args]
+        if PARTITIONED not in scopes:
+            return CONSTANT
+        if node.func in MERGING_FUNCTIONS:
+            raise NotBatchable(f"{node.func}() over instance-scoped data")
+        if node.func in ('label_replace', 'label_join') and isinstance(strip_parens(node.args[1]), StringLiteral) \
+                and strip_parens(node.args[1]).value == 'instance':
+            raise NotBatchable(f"{node.func}() rewrites the instance label")
+        if any(scope == PARTITIONED and infer_type(arg) == SCALAR for arg, scope in zip(node.args, scopes)):
+            raise NotBatchable(f"instance-scoped scalar argument to {node.func}()")
+        return PARTITIONED
+    if isinstance(node, AggregateExpr):
+        if node.param is not None and instance_scope(node.param) != CONSTANT:
+            raise NotBatchable(f"instance-scoped parameter to {node.op}")
+        if instance_scope(node.expr) == CONSTANT:
+            return CONSTANT
+        keeps = node.has_grouping and node.without != ('instance' in node.grouping)
+        if not keeps:
+            raise NotBatchable(f"{node.op} aggregates across instances")
+        return PARTITIONED
+    if isinstance(node, BinaryExpr):
+        return _binary_scope(node)
+    raise NotBatchable(f"unsupported expression {type(node).__name__}")
+
+def instance_plan(query):
+    """(BATCHED, SHARED or PER_INSTANCE, parsed query or None, reason)"""
+    try:
+        node = parse(query.replace('\\"', '"'))
+    except PromQLSyntaxError as e:
+        return PER_INSTANCE, None, f"does not parse: {e}"
+    for child in walk(node):
+        if isinstance(child, VectorSelector):
+            for matcher in child.matchers:
+                if INSTANCE_PLACEHOLDER in matcher.value and not _is_placeholder(matcher):
+                    return PER_INSTANCE, node, f"$INSTANCE in {matcher.name}{matcher.op}\"{matcher.value}\""
+    try:
+        scope = instance_scope(node)
+        if scope == CONSTANT:
+            return SHARED, node, "not scoped to an instance"
+        if infer_type(node) == SCALAR:
+            return PER_INSTANCE, node, "scalar result"
+    except NotBatchable as e:
+        return PER_INSTANCE, node, str(e)
+    except PromQLSyntaxError as e:
+        return PER_INSTANCE, node, f"type error: {e}"
+    return BATCHED, node, "instance label survives every step"
+
+def batched_query(node, instances):
+    """Render a query with instance="$INSTANCE" replaced by instance=~"a|b|..." for the given instances"""
+    copy = parse(canonicalize(node))
+    regex = '|'.join(re.escape(name) for name in instances)
+    for child in walk(copy):
+        if isinstance(child, VectorSelector):
+            child.matchers = [LabelMatcher('instance', '=~', regex) if _is_placeholder(m) else m
+                              for m in child.matchers]
+    return canonicalize(copy)
+
+def main():
+    from queries import all_queries
+    plans = {BATCHED: [], SHARED: [], PER_INSTANCE: []}
+    for query_info in all_queries:
+        plan, _, reason = instance_plan(query_info['query'])
+        plans[plan].append((query_info['name'], reason))
+    for plan, entries in plans.items():
+        print(f"\n{plan}: {len(entries)} queries")
+        for name, reason in entries:
+            print(f"   {name:<60} {reason}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
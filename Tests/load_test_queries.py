@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Load test a Prometheus server with the lab query catalog.
+
+Virtual users behave like students working through the labs: each one
+picks a query from queries.all_queries, runs it with test_prom_query,
+pauses for the think time and picks the next one. Lab lists can be
+weighted (for example to model a class that is busy with Lab 9).
+
+Users are added in steps. After every step the throughput, error rate and
+p50/p95/p99 latency are reported, and the test stops once Prometheus is
+saturated: errors or latency pass their limits, or adding users no longer
+adds throughput.
+
+Usage:
+    python load_test_queries.py [--start-users N] [--step-users N] [--max-users N] [--step-duration SECONDS]
+                                [--think-time SECONDS] [--weight LAB=WEIGHT ...] [--output FILE]
+
+Examples:
+    python load_test_queries.py
+    python load_test_queries.py --start-users 10 --step-users 10 --max-users 200 --step-duration 60
+    python load_test_queries.py --weight lab9_queries=5 --weight lab10_queries=2
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from benchmark_queries import percentile
+from queries import queries_by_lab
+from test_queries import (check_prerequisites, create_session, fetch_build_info, is_failure, load_config,
+                          test_prom_query)
+
+def parse_weights(values):
+    """Parse repeated LAB=WEIGHT options into a dict (unlisted labs keep weight 1)"""
+    weights = dict.fromkeys(queries_by_lab, 1.0)
+    for value in values or []:
+        lab, _, weight = value.partition('=')
+        if lab not in queries_by_lab:
+            raise ValueError(f"unknown lab list '{lab}' (expected one of: {', '.join(queries_by_lab)})")
+        weights[lab] = float(weight)
+        if weights[lab] < 0:
+            raise ValueError(f"weight for {lab} must not be negative")
+    return weights
+
+def build_workload(weights):
+    """Flatten the catalog into (queries, cumulative weights) for random.choices.
+
+    A lab's weight is shared by its queries, so a lab with many queries
+    does not get picked more often than a lab with a few.
+    """
+    workload = []
+    cum_weights = []
+    total = 0.0
+    for lab, lab_queries in queries_by_lab.items():
+        if not lab_queries or weights[lab] == 0:
+            continue
+        for query_info in lab_queries:
+            total += weights[lab] / len(lab_queries)
+            workload.append(query_info)
+            cum_weights.append(total)
+    if not workload:
+        raise ValueError("all lab lists have weight 0")
+    return workload, cum_weights
+
+class LoadTest:
+    """Closed-loop virtual users that record their results into the current step."""
+
+    def __init__(self, prometheus_url, instance_name, workload, cum_weights, think_time):
+        self.prometheus_url = prometheus_url
+        self.instance_name = instance_name
+        self.workload = workload
+        self.cum_weights = cum_weights
+        self.think_time = think_time
+        self.stop = threading.Event()
+        self.threads = []
+        # (wall_ms, failed) per finished query; swapped out at every step
+        self.samples = []
+
+    @property
+    def users(self):
+        return len(self.threads)
+
+    def virtual_user(self, seed):
+        rng = random.Random(seed)
+        session = create_session()
+        # Spread the first requests so new users don't all arrive at once
+        if self.stop.wait(rng.uniform(0, self.think_time)):
+            return
+        while not self.stop.is_set():
+            query_info = rng.choices(self.workload, cum_weights=self.cum_weights)[0]
+            outcome = test_prom_query(
+                name=query_info['name'],
+                query=query_info['query'],
+                expected_type=query_info['expected_type'],
+                prometheus_url=self.prometheus_url,
+                instance_name=self.instance_name,
+                session=session
+            )
+            # list.append is atomic, so no lock is needed on the hot path
+            self.samples.append((outcome['metrics']['wall_ms'], is_failure(outcome['result'])))
+            # Exponential think time around the mean, like independent students
+            self.stop.wait(rng.expovariate(1 / self.think_time) if self.think_time > 0 else 0)
+        session.close()
+
+    def add_users(self, count):
+        for _ in range(count):
+            thread = threading.Thread(target=self.virtual_user, args=(len(self.threads),), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def run_step(self, duration):
+        """Collect the samples of one step and summarize them"""
+        self.samples = []
+        started = time.monotonic()
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= duration:
+                break
+            sys.stdout.write(f"\r⏱️  {self.users} users | {len(self.samples)} queries | "
+                             f"{int(duration - elapsed)}s left in step   ")
+            sys.stdout.flush()
+            time.sleep(min(1.0, duration - elapsed))
+        samples, self.samples = self.samples, []
+        elapsed = time.monotonic() - started
+        sys.stdout.write("\r" + " " * 70 + "\r")
+        return summarize_step(self.users, samples, elapsed)
+
+    def shutdown(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join(timeout=15)
+
+def summarize_step(users, samples, elapsed):
+    """Throughput, error rate and latency percentiles (ms) for one step"""
+    latencies = [wall_ms for wall_ms, failed in samples if wall_ms is not None and not failed]
+    errors = sum(1 for _, failed in samples if failed)
+    step = {
+        "users": users,
+        "requests": len(samples),
+        "errors": errors,
+        "throughput": round(len(samples) / elapsed, 2) if elapsed > 0 else 0,
+        "error_rate": round(errors / len(samples) * 100, 2) if samples else 0
+    }
+    for p in (50, 95, 99):
+        value = percentile(latencies, p)
+        step[f"p{p}"] = round(value, 1) if value is not None else None
+    return step
+
+def saturation_reason(step, previous, max_error_rate, max_p95_ms, min_scaling):
+    """Return why a step counts as saturated, or None if the server kept up"""
+    if step["requests"] == 0:
+        return "no query finished during the step"
+    if step["error_rate"] > max_error_rate:
+        return f"error rate {step['error_rate']}% > {max_error_rate}%"
+    if max_p95_ms is not None and step["p95"] is not None and step["p95"] > max_p95_ms:
+        return f"p95 {step['p95']} ms > {max_p95_ms} ms"
+    if previous and previous["throughput"] > 0:
+        user_growth = step["users"] / previous["users"] - 1
+        throughput_growth = step["throughput"] / previous["throughput"] - 1
+        # With a closed loop, throughput grows with users until the server runs out of capacity
+        if user_growth > 0 and throughput_growth < user_growth * min_scaling:
+            return (f"throughput grew {throughput_growth * 100:.0f}% for "
+                    f"{user_growth * 100:.0f}% more users")
+    return None
+
+def print_step(step):
+    latencies = " ".join(f"{step[p]:>9.1f}" if step[p] is not None else f"{'-':>9}"
+                         for p in ('p50', 'p95', 'p99'))
+    print(f"{step['users']:>6} {step['throughput']:>10.1f} {step['error_rate']:>8.1f}% {latencies}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Ramp up virtual users running the lab queries until Prometheus saturates')
+    parser.add_argument('--start-users', type=int, default=5, help='Virtual users in the first step (default: 5)')
+    parser.add_argument('--step-users', type=int, default=5, help='Users added at every step (default: 5)')
+    parser.add_argument('--max-users', type=int, default=100, help='Stop after the step with this many users (default: 100)')
+    parser.add_argument('--step-duration', type=float, default=30, help='Seconds per step (default: 30)')
+    parser.add_argument('--think-time', type=float, default=1.0,
+                        help='Mean pause between a user\'s queries, in seconds (default: 1.0)')
+    parser.add_argument('--weight', action='append', metavar='LAB=WEIGHT',
+                        help='Relative weight of a lab list, e.g. lab9_queries=5 (default: 1 for every lab)')
+    parser.add_argument('--max-error-rate', type=float, default=1.0,
+                        help='Error rate, in percent, that counts as saturation (default: 1)')
+    parser.add_argument('--max-p95-ms', type=float, default=None,
+                        help='p95 latency that counts as saturation (default: no limit)')
+    parser.add_argument('--min-scaling', type=float, default=0.5,
+                        help='Saturated when throughput grows by less than this fraction of the user '
+                             'growth (default: 0.5)')
+    parser.add_argument('--output', metavar='FILE', help='Write the per-step results as JSON')
+    args = parser.parse_args()
+
+    try:
+        weights = parse_weights(args.weight)
+        workload, cum_weights = build_workload(weights)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+    config = load_config()
+    prometheus_url = config['prometheus_url']
+    session = create_session()
+    check_prerequisites(prometheus_url, session)
+    version = fetch_build_info(prometheus_url, session).get('version')
+
+    print(f"\n===== Load Testing Lab Queries (Prometheus {version or 'unknown version'}) =====\n")
+    print(f"{len(workload)} queries, think time {args.think_time}s, {args.step_duration:g}s per step")
+    weighted = {lab: weight for lab, weight in weights.items() if weight != 1}
+    if weighted:
+        print("Lab weights: " + ", ".join(f"{lab}={weight:g}" for lab, weight in weighted.items()))
+    print()
+    print(f"{'Users':>6} {'Req/s':>10} {'Errors':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    test = LoadTest(prometheus_url, config['instance_name'], workload, cum_weights, args.think_time)
+    steps = []
+    saturation = None
+    try:
+        target = max(1, args.start_users)
+        while True:
+            test.add_users(target - test.users)
+            step = test.run_step(args.step_duration)
+            print_step(step)
+            reason = saturation_reason(step, steps[-1] if steps else None,
+                                       args.max_error_rate, args.max_p95_ms, args.min_scaling)
+            steps.append(step)
+            if reason:
+                saturation = {"users": step["users"], "reason": reason}
+                break
+            if target >= args.max_users:
+                break
+            target = min(args.max_users, target + max(1, args.step_users))
+    except KeyboardInterrupt:
+        print("\n\n⏹️  Stopped by user")
+    finally:
+        test.shutdown()
+
+    print()
+    if saturation:
+        healthy = steps[-2] if len(steps) > 1 else None
+        print(f"🔥 Saturated at {saturation['users']} users: {saturation['reason']}")
+        if healthy:
+            print(f"✅ Last healthy step: {healthy['users']} users at {healthy['throughput']:.1f} req/s "
+                  f"(p95 {healthy['p95']} ms)")
+        else:
+            print("⚠️ Already saturated at the first step; try fewer --start-users")
+    elif steps:
+        print(f"✅ No saturation up to {steps[-1]['users']} users "
+              f"({steps[-1]['throughput']:.1f} req/s); raise --max-users to push further")
+
+    if args.output:
+        report = {
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "prometheus_url": prometheus_url,
+            "prometheus_version": version,
+            "think_time": args.think_time,
+            "step_duration": args.step_duration,
+            "weights": weights,
+            "steps": steps,
+            "saturation": saturation
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
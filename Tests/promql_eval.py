@@ -0,0 +1,1053 @@
+#!/usr/bin/env python3
+"""
+An in-process PromQL evaluator over an in-memory, NumPy-backed TSDB.
+
+It covers the PromQL the labs use: instant and range selectors with
+offset and @, subqueries, rate/increase/delta/irate, the *_over_time
+functions, deriv and predict_linear, aggregations with by/without,
+arithmetic, comparison and set operators with on/ignoring and
+group_left/group_right, histogram_quantile, label_replace, label_join and
+absent.
+
+Data is columnar: every metric name holds one (series x samples) float64
+array on a shared timestamp grid, with the label values kept as one array
+per label name. Expressions are evaluated for all requested timestamps at
+once, so an instant query, a range query and the inner steps of a
+subquery all go through the same vectorized code.
+
+start_eval_server() serves the evaluator over the Prometheus HTTP API
+(/api/v1/query and /api/v1/query_range), so test_queries.py --offline can
+run the whole catalog without a Prometheus server. Results follow
+Prometheus semantics closely but not bit for bit (for example, staleness
+markers and native histograms are not modelled).
+"""
+
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from promql_parser import (AggregateExpr, BinaryExpr, Call, COMPARISON_OPS, MatrixSelector, NumberLiteral, ParenExpr,
+                           PromQLSyntaxError, SET_OPS, StringLiteral, SubqueryExpr, UnaryExpr, VectorSelector,
+                           parse, required_history, strip_parens)
+from synthetic_fleet import DEFAULT_INSTANCE, Fleet
+
+LOOKBACK_SECONDS = 300.0           # Prometheus's default --query.lookback-delta
+DEFAULT_SUBQUERY_STEP = 60.0       # Prometheus's default evaluation_interval
+MAX_WINDOW_CELLS = 4000000         # Samples gathered at once by range functions
+# The lab recording rules, as Scripts/install-rules.sh installs them
+LAB_RECORDING_RULES = {
+    'instance:node_cpu_usage:percent': '100 * (1 - (avg by (instance) (rate(node_cpu_seconds_total{mode="idle"}[5m])) '
+                                       '/ count by (instance) (node_cpu_seconds_total{mode="idle"})))',
+    'memory_usage_percent': '100 * (1 - (node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes))',
+}
+
+class PromQLEvalError(ValueError):
+    """Raised when a parsed query cannot be evaluated."""
+
+# ---------------------------------------------------------------------------
+# Storage
+# ---------------------------------------------------------------------------
+
+class _Block:
+    """All series of one metric name: label columns and a (series x samples) value array."""
+
+    def __init__(self, labels, values):
+        self.labels = labels
+        self.values = values
+
+class TSDB:
+    """In-memory time-series store with one shared sample timestamp grid."""
+
+    def __init__(self, timestamps):
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.blocks = {}
+
+    @classmethod
+    def from_fleet(cls, fleet, start, end, interval=15.0):
+        """Sample every series of a synthetic fleet from start to end"""
+        tsdb = cls(np.arange(start, end + interval / 2, interval))
+        for family in fleet.families:
+            values = family.values_at(tsdb.timestamps)
+            names = family.sample_names if family.sample_names is not None else np.full(len(family), family.name)
+            for name in np.unique(names):
+                rows = np.flatnonzero(names == name)
+                labels = {key: column[rows] for key, column in family.labels.items()}
+                tsdb.add_block(str(name), labels, values[rows])
+        return tsdb
+
+    def add_block(self, name, labels, values):
+        """Add series for one metric name (label columns may use '' for a missing label)"""
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(self.timestamps))
+        labels = {key: np.asarray(column, dtype=str) for key, column in labels.items() if key != '__name__'}
+        block = self.blocks.get(name)
+        if block is None:
+            self.blocks[name] = _Block(labels, values)
+            return
+        count = len(block.values)
+        merged = {}
+        for key in set(block.labels) | set(labels):
+            old = block.labels.get(key, np.full(count, ''))
+            new = labels.get(key, np.full(len(values), ''))
+            merged[key] = np.concatenate([old, new])
+        block.labels = merged
+        block.values = np.vstack([block.values, values])
+
+    def add_series(self, labels, values):
+        """Add series given as label dicts (including __name__) and a (series x samples) array"""
+        values = np.asarray(values, dtype=np.float64).reshape(len(labels), -1)
+        by_name = {}
+        for row, series in enumerate(labels):
+            by_name.setdefault(series.get('__name__', ''), []).append(row)
+        for name, rows in by_name.items():
+            keys = {key for row in rows for key in labels[row]}
+            columns = {key: [labels[row].get(key, '') for row in rows] for key in keys}
+            self.add_block(name, columns, values[rows])
+
+    @property
+    def series_count(self):
+        return sum(len(block.values) for block in self.blocks.values())
+
+    def select(self, name, matchers):
+        """Return (label dicts, values) of the series matching a selector"""
+        name_matchers = [m for m in matchers if m.name == '__name__']
+        label_matchers = [m for m in matchers if m.name != '__name__']
+        if name is not None:
+            names = [name] if name in self.blocks else []
+        else:
+            names = list(self.blocks)
+        names = [n for n in names if all(_match_values(m, np.asarray([n]))[0] for m in name_matchers)]
+
+        labels, values = [], []
+        for metric in names:
+            block = self.blocks[metric]
+            mask = np.ones(len(block.values), dtype=bool)
+            for matcher in label_matchers:
+                column = block.labels.get(matcher.name)
+                if column is None:
+                    column = np.full(len(block.values), '')
+                mask &= _match_values(matcher, column)
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                continue
+            columns = [(key, column[rows]) for key, column in block.labels.items()]
+            for i in range(len(rows)):
+                series = {'__name__': metric}
+                series.update((key, str(column[i])) for key, column in columns if column[i] != '')
+                labels.append(series)
+            values.append(block.values[rows])
+        if not values:
+            return [], np.empty((0, len(self.timestamps)))
+        return labels, np.vstack(values)
+
+def _match_values(matcher, column):
+    """Vectorized label matching; regexes run once per distinct value"""
+    if matcher.op == '=':
+        return column == matcher.value
+    if matcher.op == '!=':
+        return column != matcher.value
+    regex = re.compile(f"^(?:{matcher.value})$", re.DOTALL)
+    distinct, inverse = np.unique(column, return_inverse=True)
+    matched = np.array([regex.match(str(value)) is not None for value in distinct], dtype=bool)
+    result = matched[inverse.reshape(-1)] if len(distinct) else np.zeros(0, dtype=bool)
+    return result if matcher.op == '=~' else ~result
+
+# ---------------------------------------------------------------------------
+# Values
+# ---------------------------------------------------------------------------
+
+class Scalar:
+    def __init__(self, values):
+        self.values = values          # One value per evaluation timestamp
+
+class String:
+    def __init__(self, value):
+        self.value = value
+
+class Vector:
+    def __init__(self, labels, values):
+        self.labels = labels          # One label dict per series
+        self.values = values          # (series x timestamps); NaN means no sample at that step
+
+class RangeData:
+    """Samples a range function reads: a matrix selector or an evaluated subquery."""
+
+    def __init__(self, labels, times, values, range_seconds, eval_times):
+        self.labels = labels
+        self.times = times            # Sample timestamps shared by all series
+        self.values = values          # (series x samples)
+        self.range = range_seconds
+        self.eval_times = eval_times  # Window end for each evaluation step (offset applied)
+
+def _drop_name(labels):
+    return [{k: v for k, v in series.items() if k != '__name__'} for series in labels]
+
+def _signature(series, labels, on):
+    """Matching key of a series for binary operators"""
+    if on:
+        return tuple((name, series.get(name, '')) for name in labels)
+    return tuple(sorted((k, v) for k, v in series.items() if k != '__name__' and k not in labels))
+
+def _group_index(keys):
+    """Map each key to a dense group number; return (group per item, distinct keys)"""
+    groups = {}
+    index = np.fromiter((groups.setdefault(key, len(groups)) for key in keys), dtype=np.int64, count=len(keys))
+    return index, list(groups)
+
+def format_value(value):
+    """Render a sample value like Prometheus (shortest form, NaN, +Inf, -Inf)"""
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return np.format_float_positional(value, trim='-')
+
+# ---------------------------------------------------------------------------
+# Range functions: each gets windows of shape (series, steps, samples)
+# ---------------------------------------------------------------------------
+
+def _take(array, index):
+    return np.take_along_axis(array, index[..., None], axis=-1)[..., 0]
+
+def _first_last(valid):
+    width = valid.shape[-1]
+    first = np.argmax(valid, axis=-1)
+    last = width - 1 - np.argmax(valid[..., ::-1], axis=-1)
+    return first, last
+
+def _extrapolated(values, times, valid, eval_times, range_seconds, is_counter, is_rate):
+    """Prometheus's extrapolatedRate for rate(), increase() and delta()"""
+    count = valid.sum(axis=-1)
+    first, last = _first_last(valid)
+    first_value, last_value = _take(values, first), _take(values, last)
+    first_time, last_time = _take(times, first), _take(times, last)
+    result = last_value - first_value
+    if is_counter:
+        previous, current = values[..., :-1], values[..., 1:]
+        resets = np.where(valid[..., :-1] & valid[..., 1:] & (current < previous), previous, 0.0)
+        result = result + resets.sum(axis=-1)
+    sampled = last_time - first_time
+    average = sampled / np.maximum(count - 1, 1)
+    to_start = first_time - (eval_times - range_seconds)
+    to_end = eval_times - last_time
+    if is_counter:
+        to_zero = np.where((result > 0) & (first_value >= 0), sampled * first_value / np.where(result > 0, result, 1),
+                           np.inf)
+        to_start = np.minimum(to_start, to_zero)
+    threshold = average * 1.1
+    interval = (sampled + np.where(to_start < threshold, to_start, average / 2)
+                + np.where(to_end < threshold, to_end, average / 2))
+    result = result * interval / np.where(sampled > 0, sampled, np.nan)
+    if is_rate:
+        result = result / range_seconds
+    return np.where(count >= 2, result, np.nan)
+
+def _instant_delta(values, valid, is_rate, times):
+    """irate() and idelta(): the last two samples of each window"""
+    count = valid.sum(axis=-1)
+    _, last = _first_last(valid)
+    # The sample before the last valid one (windows have no holes in practice)
+    previous = np.maximum(last - 1, 0)
+    last_value, previous_value = _take(values, last), _take(values, previous)
+    result = last_value - previous_value
+    if is_rate:
+        result = np.where(last_value < previous_value, last_value, result)  # Counter reset
+        result = result / (_take(times, last) - _take(times, previous))
+    return np.where(count >= 2, result, np.nan)
+
+def _regression(values, times, valid, eval_times):
+    """Least-squares slope and intercept (at the evaluation time) per window"""
+    x = np.where(valid, times - eval_times[..., None], 0.0)
+    y = np.where(valid, values, 0.0)
+    n = valid.sum(axis=-1)
+    sum_x, sum_y = x.sum(axis=-1), y.sum(axis=-1)
+    covariance = n * (x * y).sum(axis=-1) - sum_x * sum_y
+    variance = n * (x * x).sum(axis=-1) - sum_x * sum_x
+    slope = covariance / np.where(variance != 0, variance, np.nan)
+    intercept = (sum_y - slope * sum_x) / np.where(n > 0, n, np.nan)
+    return np.where(n >= 2, slope, np.nan), np.where(n >= 2, intercept, np.nan)
+
+def _over_time(func, values, valid, args):
+    count = valid.sum(axis=-1)
+    with np.errstate(all='ignore'):
+        if func == 'count_over_time':
+            result = count.astype(np.float64)
+        elif func == 'sum_over_time':
+            result = np.where(valid, values, 0.0).sum(axis=-1)
+        elif func == 'avg_over_time':
+            result = np.where(valid, values, 0.0).sum(axis=-1) / count
+        elif func == 'min_over_time':
+            result = np.where(valid, values, np.inf).min(axis=-1)
+        elif func == 'max_over_time':
+            result = np.where(valid, values, -np.inf).max(axis=-1)
+        elif func == 'last_over_time':
+            result = _take(values, _first_last(valid)[1])
+        elif func in ('stddev_over_time', 'stdvar_over_time'):
+            mean = np.where(valid, values, 0.0).sum(axis=-1) / count
+            variance = np.where(valid, (values - mean[..., None]) ** 2, 0.0).sum(axis=-1) / count
+            result = np.sqrt(variance) if func == 'stddev_over_time' else variance
+        elif func == 'quantile_over_time':
+            result = np.nanquantile(np.where(valid, values, np.nan), np.clip(args[0], 0, 1), axis=-1) \
+                if values.shape[-1] else np.full(count.shape, np.nan)
+        elif func == 'present_over_time':
+            result = np.ones(count.shape)
+        elif func == 'changes':
+            both = valid[..., 1:] & valid[..., :-1]
+            result = (both & (values[..., 1:] != values[..., :-1])).sum(axis=-1).astype(np.float64)
+        elif func == 'resets':
+            both = valid[..., 1:] & valid[..., :-1]
+            result = (both & (values[..., 1:] < values[..., :-1])).sum(axis=-1).astype(np.float64)
+        else:
+            raise PromQLEvalError(f"unsupported function {func}")
+    return np.where(count > 0, result, np.nan)
+
+RANGE_FUNCTIONS = {'rate', 'increase', 'delta', 'irate', 'idelta', 'deriv', 'predict_linear', 'count_over_time',
+                   'sum_over_time', 'avg_over_time', 'min_over_time', 'max_over_time', 'last_over_time',
+                   'stddev_over_time', 'stdvar_over_time', 'quantile_over_time', 'present_over_time',
+                   'absent_over_time', 'changes', 'resets'}
+ELEMENTWISE_FUNCTIONS = {
+    'abs': np.abs, 'ceil': np.ceil, 'floor': np.floor, 'exp': np.exp, 'sqrt': np.sqrt, 'ln': np.log,
+    'log2': np.log2, 'log10': np.log10, 'sgn': np.sign,
+}
+ARITHMETIC = {
+    '+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide, '%': np.fmod, '^': np.power,
+    'atan2': np.arctan2,
+}
+COMPARISONS = {
+    '==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+}
+
+def _go_expand(match, template):
+    """Expand $1, ${1}, $name and ${name} like Go's regexp.Expand"""
+    def group(m):
+        if m.group(0) == '$$':
+            return '$'
+        name = m.group(1) or m.group(2)
+        try:
+            value = match.group(int(name) if name.isdigit() else name)
+        except (IndexError, re.error):
+            value = None
+        return value or ''
+    return re.sub(r'\$\$|\$\{(\w+)\}|\$(\w+)', group, template)
+
+# ---------------------------------------------------------------------------
+# Evaluation
+# ---------------------------------------------------------------------------
+
+class _Evaluation:
+    """State of one query evaluation: timestamps, @ start()/end() and sample statistics."""
+
+    def __init__(self, tsdb, lookback, start, end):
+        self.tsdb = tsdb
+        self.lookback = lookback
+        self.start = start
+        self.end = end
+        self.total_samples = 0
+        self.peak_samples = 0
+
+    def _count(self, samples):
+        self.total_samples += int(samples)
+        self.peak_samples = max(self.peak_samples, int(samples))
+
+    def _modified_times(self, node, ts):
+        if node.at is not None:
+            if node.at == 'start()':
+                at = self.start
+            elif node.at == 'end()':
+                at = self.end
+            else:
+                at = float(node.at)
+            ts = np.full(len(ts), at)
+        return ts - node.offset / 1000
+
+    def eval(self, node, ts):
+        if isinstance(node, ParenExpr):
+            return self.eval(node.expr, ts)
+        if isinstance(node, NumberLiteral):
+            return Scalar(np.full(len(ts), float(node.value)))
+        if isinstance(node, StringLiteral):
+            return String(node.value)
+        if isinstance(node, VectorSelector):
+            return self.select(node, ts)
+        if isinstance(node, (MatrixSelector, SubqueryExpr)):
+            return self.range_data(node, ts)
+        if isinstance(node, Call):
+            return self.call(node, ts)
+        if isinstance(node, AggregateExpr):
+            return self.aggregate(node, ts)
+        if isinstance(node, UnaryExpr):
+            operand = self.eval(node.expr, ts)
+            if node.op == '+':
+                return operand
+            if isinstance(operand, Scalar):
+                return Scalar(-operand.values)
+            if isinstance(operand, Vector):
+                return Vector(_drop_name(operand.labels), -operand.values)
+            raise PromQLEvalError("unary minus needs a scalar or instant vector")
+        if isinstance(node, BinaryExpr):
+            return self.binary(node, ts)
+        raise PromQLEvalError(f"cannot evaluate {type(node).__name__}")
+
+    def select(self, node, ts):
+        """Instant vector selector: the latest sample within the lookback window"""
+        labels, values = self.tsdb.select(node.name, node.matchers)
+        times = self.tsdb.timestamps
+        at = self._modified_times(node, ts)
+        index = np.searchsorted(times, at, side='right') - 1
+        clipped = np.clip(index, 0, max(len(times) - 1, 0))
+        present = (index >= 0) & (len(times) > 0)
+        if len(times):
+            present &= times[clipped] > at - self.lookback
+        result = values[:, clipped] if len(times) else np.empty((len(labels), len(ts)))
+        result = np.where(present, result, np.nan)
+        self._count(np.count_nonzero(~np.isnan(result)))
+        keep = ~np.all(np.isnan(result), axis=1)
+        return Vector([l for l, k in zip(labels, keep) if k], result[keep])
+
+    def range_data(self, node, ts):
+        """Samples for a range selector or a subquery, with the window end per step"""
+        if isinstance(node, MatrixSelector):
+            labels, values = self.tsdb.select(node.vector.name, node.vector.matchers)
+            return RangeData(labels, self.tsdb.timestamps, values, node.range / 1000,
+                             self._modified_times(node.vector, ts))
+        eval_times = self._modified_times(node, ts)
+        step = node.step / 1000 if node.step else DEFAULT_SUBQUERY_STEP
+        range_seconds = node.range / 1000
+        # Subquery steps are aligned to multiples of the step, like Prometheus does
+        first = math.floor((eval_times.min() - range_seconds) / step) * step + step
+        inner_times = np.arange(first, eval_times.max() + step / 2, step)
+        inner = self.eval(node.expr, inner_times)
+        if not isinstance(inner, Vector):
+            raise PromQLEvalError("subquery is only allowed on instant vector expressions")
+        return RangeData(inner.labels, inner_times, inner.values, range_seconds, eval_times)
+
+    def windows(self, data):
+        """Yield (step slice, values, sample times, valid mask) with shape (series, steps, samples)"""
+        times = data.times
+        lo = np.searchsorted(times, data.eval_times - data.range, side='right')
+        hi = np.searchsorted(times, data.eval_times, side='right')
+        width = int(max((hi - lo).max(initial=0), 1))
+        series = max(len(data.labels), 1)
+        chunk = max(1, MAX_WINDOW_CELLS // (series * width))
+        for start in range(0, len(data.eval_times), chunk):
+            steps = slice(start, start + chunk)
+            index = lo[steps, None] + np.arange(width)
+            inside = index < hi[steps, None]
+            index = np.minimum(index, max(len(times) - 1, 0))
+            if len(times):
+                window_times = np.where(inside, times[index], np.nan)
+                values = data.values[:, index]
+            else:
+                window_times = np.full(index.shape, np.nan)
+                values = np.full((len(data.labels),) + index.shape, np.nan)
+            valid = inside[None, :, :] & ~np.isnan(values)
+            self._count(np.count_nonzero(valid))
+            yield steps, values, np.broadcast_to(window_times, values.shape), valid
+
+    def range_function(self, func, data, args):
+        result = np.full((len(data.labels), len(data.eval_times)), np.nan)
+        with np.errstate(all='ignore'):
+            for steps, values, times, valid in self.windows(data):
+                eval_times = data.eval_times[steps][None, :]
+                if func in ('rate', 'increase', 'delta'):
+                    out = _extrapolated(values, times, valid, eval_times, data.range,
+                                        is_counter=func != 'delta', is_rate=func == 'rate')
+                elif func in ('irate', 'idelta'):
+                    out = _instant_delta(values, valid, func == 'irate', times)
+                elif func in ('deriv', 'predict_linear'):
+                    slope, intercept = _regression(values, times, valid, eval_times)
+                    out = slope if func == 'deriv' else intercept + slope * args[0][steps][None, :]
+                elif func == 'absent_over_time':
+                    out = np.where(valid.any(axis=-1), np.nan, 1.0)
+                else:
+                    out = _over_time(func, values, valid,
+                                     [a[steps][None, :] if isinstance(a, np.ndarray) else a for a in args])
+                result[:, steps] = out
+        if func == 'absent_over_time':
+            present = ~np.isnan(result).all(axis=0) if len(result) else np.zeros(len(data.eval_times), bool)
+            return Vector([{}], np.where(present, 1.0, np.nan)[None, :]) if len(data.labels) else \
+                Vector([{}], np.ones((1, len(data.eval_times))))
+        labels = data.labels if func == 'last_over_time' else _drop_name(data.labels)
+        keep = ~np.all(np.isnan(result), axis=1)
+        return Vector([l for l, k in zip(labels, keep) if k], result[keep])
+
+    def call(self, node, ts):
+        func = node.func
+        if func in RANGE_FUNCTIONS:
+            if func in ('quantile_over_time',):
+                args = [self.scalar_arg(node.args[0], ts)]
+                data_node = node.args[1]
+            elif func == 'predict_linear':
+                args = [self.scalar_arg(node.args[1], ts)]
+                data_node = node.args[0]
+            else:
+                args = []
+                data_node = node.args[0]
+            data = self.eval(data_node, ts)
+            if not isinstance(data, RangeData):
+                raise PromQLEvalError(f"expected range vector in call to function {func}")
+            if func == 'absent_over_time':
+                return self.absent(data_node, data.labels and self.range_function(func, data, args), ts)
+            return self.range_function(func, data, args)
+
+        if func in ELEMENTWISE_FUNCTIONS:
+            vector = self.vector_arg(node.args[0], ts, func)
+            with np.errstate(all='ignore'):
+                return Vector(_drop_name(vector.labels), ELEMENTWISE_FUNCTIONS[func](vector.values))
+        if func == 'round':
+            vector = self.vector_arg(node.args[0], ts, func)
+            to = self.scalar_arg(node.args[1], ts) if len(node.args) > 1 else np.ones(len(ts))
+            return Vector(_drop_name(vector.labels), np.floor(vector.values / to + 0.5) * to)
+        if func in ('clamp', 'clamp_min', 'clamp_max'):
+            vector = self.vector_arg(node.args[0], ts, func)
+            bounds = [self.scalar_arg(arg, ts) for arg in node.args[1:]]
+            low = bounds[0] if func in ('clamp', 'clamp_min') else np.full(len(ts), -np.inf)
+            high = bounds[-1] if func in ('clamp', 'clamp_max') else np.full(len(ts), np.inf)
+            return Vector(_drop_name(vector.labels), np.minimum(np.maximum(vector.values, low), high))
+        if func == 'time':
+            return Scalar(np.asarray(ts, dtype=np.float64))
+        if func == 'vector':
+            return Vector([{}], self.scalar_arg(node.args[0], ts)[None, :])
+        if func == 'scalar':
+            vector = self.vector_arg(node.args[0], ts, func)
+            present = ~np.isnan(vector.values)
+            single = present.sum(axis=0) == 1
+            values = np.where(present, vector.values, 0.0).sum(axis=0) if len(vector.labels) else np.zeros(len(ts))
+            return Scalar(np.where(single, values, np.nan))
+        if func in ('sort', 'sort_desc'):
+            return self.vector_arg(node.args[0], ts, func)
+        if func == 'absent':
+            vector = self.vector_arg(node.args[0], ts, func)
+            return self.absent(node.args[0], vector, ts)
+        if func == 'histogram_quantile':
+            return self.histogram_quantile(self.scalar_arg(node.args[0], ts),
+                                           self.vector_arg(node.args[1], ts, func))
+        if func == 'label_replace':
+            return self.label_replace(node, ts)
+        if func == 'label_join':
+            vector = self.vector_arg(node.args[0], ts, func)
+            destination, separator = self.string_arg(node.args[1]), self.string_arg(node.args[2])
+            sources = [self.string_arg(arg) for arg in node.args[3:]]
+            labels = []
+            for series in vector.labels:
+                series = dict(series)
+                joined = separator.join(series.get(source, '') for source in sources)
+                if joined:
+                    series[destination] = joined
+                else:
+                    series.pop(destination, None)
+                labels.append(series)
+            return Vector(labels, vector.values)
+        raise PromQLEvalError(f"function {func}() is not supported by the offline evaluator")
+
+    def scalar_arg(self, node, ts):
+        value = self.eval(node, ts)
+        if not isinstance(value, Scalar):
+            raise PromQLEvalError("expected a scalar argument")
+        return value.values
+
+    def vector_arg(self, node, ts, func):
+        value = self.eval(node, ts)
+        if not isinstance(value, Vector):
+            raise PromQLEvalError(f"expected instant vector argument in call to function {func}")
+        return value
+
+    def string_arg(self, node):
+        node = strip_parens(node)
+        if not isinstance(node, StringLiteral):
+            raise PromQLEvalError("expected a string argument")
+        return node.value
+
+    def absent(self, arg, vector, ts):
+        """1 at every step where the argument has no series, labelled from its equality matchers"""
+        arg = strip_parens(arg)
+        selector = arg.vector if isinstance(arg, MatrixSelector) else arg
+        labels = {}
+        if isinstance(selector, VectorSelector):
+            labels = {m.name: m.value for m in selector.matchers if m.op == '=' and m.name != '__name__'}
+        if isinstance(vector, Vector) and len(vector.labels):
+            present = ~np.isnan(vector.values).all(axis=0)
+        else:
+            present = np.zeros(len(ts), dtype=bool)
+        values = np.where(present, np.nan, 1.0)[None, :]
+        return Vector([labels], values)
+
+    def label_replace(self, node, ts):
+        vector = self.vector_arg(node.args[0], ts, 'label_replace')
+        destination, replacement, source, pattern = (self.string_arg(arg) for arg in node.args[1:5])
+        try:
+            regex = re.compile(f"^(?:{pattern})$", re.DOTALL)
+        except re.error as e:
+            raise PromQLEvalError(f"invalid regular expression in label_replace(): {pattern}") from e
+        labels = []
+        for series in vector.labels:
+            match = regex.match(series.get(source, ''))
+            if match:
+                series = dict(series)
+                value = _go_expand(match, replacement)
+                if value:
+                    series[destination] = value
+                else:
+                    series.pop(destination, None)
+            labels.append(series)
+        return Vector(labels, vector.values)
+
+    def histogram_quantile(self, q, vector):
+        """Prometheus's bucketQuantile over classic histogram buckets, per step"""
+        keys, bounds = [], []
+        for series in vector.labels:
+            try:
+                bound = float(series['le'].replace('+Inf', 'inf'))
+            except (KeyError, ValueError):
+                bound = None
+            bounds.append(bound)
+            keys.append(tuple(sorted((k, v) for k, v in series.items() if k not in ('le', '__name__'))))
+        groups = {}
+        for row, (key, bound) in enumerate(zip(keys, bounds)):
+            if bound is not None:
+                groups.setdefault(key, []).append(row)
+
+        labels, results = [], []
+        with np.errstate(all='ignore'):
+            for key, rows in groups.items():
+                upper = np.array([bounds[r] for r in rows])
+                order = np.argsort(upper, kind='stable')
+                upper = upper[order]
+                counts = vector.values[np.asarray(rows)[order]]
+                # Coalesce duplicate bounds and make the counts monotonic
+                distinct, starts = np.unique(upper, return_index=True)
+                counts = np.add.reduceat(np.where(np.isnan(counts), 0.0, counts), starts, axis=0)
+                missing = np.add.reduceat(np.isnan(vector.values[np.asarray(rows)[order]]).astype(int), starts, axis=0)
+                counts = np.maximum.accumulate(counts, axis=0)
+                result = self._bucket_quantile(q, distinct, counts)
+                # No +Inf bucket, or the +Inf bucket has no sample at this step
+                if not np.isinf(distinct[-1]):
+                    result[:] = np.nan
+                else:
+                    result[missing[-1] > 0] = np.nan
+                labels.append(dict(key))
+                results.append(result)
+        if not results:
+            return Vector([], np.empty((0, len(q))))
+        values = np.vstack(results)
+        keep = ~np.all(np.isnan(values), axis=1)
+        return Vector([l for l, k in zip(labels, keep) if k], values[keep])
+
+    @staticmethod
+    def _bucket_quantile(q, upper, counts):
+        buckets, steps = counts.shape
+        result = np.full(steps, np.nan)
+        if buckets < 2:
+            return result
+        observations = counts[-1]
+        rank = q * observations
+        # First bucket whose count reaches the rank (never the +Inf bucket)
+        reached = counts[:-1] >= rank
+        b = np.where(reached.any(axis=0), np.argmax(reached, axis=0), buckets - 1)
+        columns = np.arange(steps)
+        start = np.where(b > 0, upper[np.maximum(b - 1, 0)], 0.0)
+        end = upper[np.minimum(b, buckets - 1)]
+        below = np.where(b > 0, counts[np.maximum(b - 1, 0), columns], 0.0)
+        in_bucket = counts[np.minimum(b, buckets - 1), columns] - below
+        interpolated = start + (end - start) * (rank - below) / in_bucket
+        result = np.where(b == buckets - 1, upper[-2], interpolated)
+        result = np.where((b == 0) & (upper[0] <= 0), upper[0], result)
+        result = np.where(observations == 0, np.nan, result)
+        result = np.where(q < 0, -np.inf, np.where(q > 1, np.inf, result))
+        return result
+
+    def aggregate(self, node, ts):
+        op = node.op
+        vector = self.eval(node.expr, ts)
+        if not isinstance(vector, Vector):
+            raise PromQLEvalError(f"expected instant vector in aggregation {op}")
+        grouping = sorted(set(node.grouping))
+        if node.without:
+            drop = set(grouping) | {'__name__'}
+            keys = [tuple(sorted((k, v) for k, v in s.items() if k not in drop)) for s in vector.labels]
+        else:
+            keys = [tuple((name, s[name]) for name in grouping if name in s) for s in vector.labels]
+        group, distinct = _group_index(keys)
+        values = vector.values
+        steps = len(ts)
+
+        if op in ('topk', 'bottomk', 'limitk'):
+            k = self.scalar_arg(node.param, ts)
+            return self._select_k(op, vector, group, len(distinct), k)
+        if op == 'count_values':
+            raise PromQLEvalError("count_values is not supported by the offline evaluator")
+
+        present = ~np.isnan(values)
+        count = np.zeros((len(distinct), steps))
+        np.add.at(count, group, present)
+        filled = np.where(present, values, 0.0)
+        with np.errstate(all='ignore'):
+            if op in ('sum', 'avg', 'stddev', 'stdvar'):
+                total = np.zeros((len(distinct), steps))
+                np.add.at(total, group, filled)
+                if op == 'sum':
+                    result = total
+                else:
+                    mean = total / count
+                    if op == 'avg':
+                        result = mean
+                    else:
+                        squares = np.zeros((len(distinct), steps))
+                        np.add.at(squares, group, np.where(present, (values - mean[group]) ** 2, 0.0))
+                        result = squares / count
+                        if op == 'stddev':
+                            result = np.sqrt(result)
+            elif op in ('count', 'group'):
+                result = count.copy() if op == 'count' else np.ones((len(distinct), steps))
+            elif op == 'min':
+                result = np.full((len(distinct), steps), np.inf)
+                np.fmin.at(result, group, values)
+            elif op == 'max':
+                result = np.full((len(distinct), steps), -np.inf)
+                np.fmax.at(result, group, values)
+            elif op == 'quantile':
+                q = self.scalar_arg(node.param, ts)
+                result = np.full((len(distinct), steps), np.nan)
+                for g in range(len(distinct)):
+                    rows = values[group == g]
+                    for column in range(steps):
+                        column_values = rows[:, column][~np.isnan(rows[:, column])]
+                        if len(column_values):
+                            result[g, column] = np.quantile(column_values, np.clip(q[column], 0, 1))
+            else:
+                raise PromQLEvalError(f"aggregation {op} is not supported by the offline evaluator")
+        result = np.where(count > 0, result, np.nan)
+        return Vector([dict(key) for key in distinct], result)
+
+    def _select_k(self, op, vector, group, groups, k):
+        """topk/bottomk/limitk: keep the k largest/smallest/first series per group and step"""
+        values = vector.values
+        keep = np.zeros(values.shape, dtype=bool)
+        for g in range(groups):
+            rows = np.flatnonzero(group == g)
+            block = values[rows]
+            if op == 'topk':
+                key = np.where(np.isnan(block), -np.inf, block)
+                order = np.argsort(-key, axis=0, kind='stable')
+            elif op == 'bottomk':
+                key = np.where(np.isnan(block), np.inf, block)
+                order = np.argsort(key, axis=0, kind='stable')
+            else:
+                order = np.argsort(np.isnan(block), axis=0, kind='stable')
+            ranks = np.empty_like(order)
+            np.put_along_axis(ranks, order, np.arange(len(rows))[:, None].repeat(block.shape[1], axis=1), axis=0)
+            keep[rows] = (ranks < k[None, :]) & ~np.isnan(block)
+        result = np.where(keep, values, np.nan)
+        present = ~np.all(np.isnan(result), axis=1)
+        return Vector([l for l, p in zip(vector.labels, present) if p], result[present])
+
+    def binary(self, node, ts):
+        lhs = self.eval(node.lhs, ts)
+        rhs = self.eval(node.rhs, ts)
+        op = node.op
+        if isinstance(lhs, (String, RangeData)) or isinstance(rhs, (String, RangeData)):
+            raise PromQLEvalError(f"binary expression must contain only scalar and instant vector types")
+
+        if op in SET_OPS:
+            if not (isinstance(lhs, Vector) and isinstance(rhs, Vector)):
+                raise PromQLEvalError(f"set operator {op} not allowed in binary scalar expression")
+            return self.set_operation(node, lhs, rhs)
+
+        with np.errstate(all='ignore'):
+            if isinstance(lhs, Scalar) and isinstance(rhs, Scalar):
+                if op in COMPARISON_OPS:
+                    if not node.return_bool:
+                        raise PromQLEvalError("comparisons between scalars must use BOOL modifier")
+                    return Scalar(COMPARISONS[op](lhs.values, rhs.values).astype(np.float64))
+                return Scalar(ARITHMETIC[op](lhs.values, rhs.values))
+
+            if isinstance(lhs, Scalar) or isinstance(rhs, Scalar):
+                vector = lhs if isinstance(lhs, Vector) else rhs
+                left = lhs.values if isinstance(lhs, Scalar) else lhs.values
+                right = rhs.values if isinstance(rhs, Scalar) else rhs.values
+                if op in COMPARISON_OPS:
+                    matched = COMPARISONS[op](left, right)
+                    if node.return_bool:
+                        values = np.where(np.isnan(vector.values), np.nan, matched.astype(np.float64))
+                        return Vector(_drop_name(vector.labels), values)
+                    values = np.where(matched, vector.values, np.nan)
+                    return self._compact(vector.labels, values)
+                return Vector(_drop_name(vector.labels), ARITHMETIC[op](left, right))
+
+            return self.vector_operation(node, lhs, rhs)
+
+    @staticmethod
+    def _compact(labels, values):
+        keep = ~np.all(np.isnan(values), axis=1)
+        return Vector([l for l, k in zip(labels, keep) if k], values[keep])
+
+    def set_operation(self, node, lhs, rhs):
+        matching = node.matching
+        on = matching is not None and matching.on
+        names = sorted(set(matching.labels)) if matching is not None else []
+        lhs_keys = [_signature(s, names, on) for s in lhs.labels]
+        rhs_keys = [_signature(s, names, on) for s in rhs.labels]
+        if node.op == 'or':
+            lhs_group, lhs_distinct = _group_index(lhs_keys)
+            presence = np.zeros((len(lhs_distinct), lhs.values.shape[1]), dtype=bool)
+            np.logical_or.at(presence, lhs_group, ~np.isnan(lhs.values))
+            blocked = self._presence_of(rhs_keys, lhs_distinct, presence)
+            values = np.vstack([lhs.values, np.where(blocked, np.nan, rhs.values)])
+            return self._compact(lhs.labels + rhs.labels, values)
+
+        rhs_group, rhs_distinct = _group_index(rhs_keys)
+        presence = np.zeros((len(rhs_distinct), rhs.values.shape[1]), dtype=bool)
+        np.logical_or.at(presence, rhs_group, ~np.isnan(rhs.values))
+        matched = self._presence_of(lhs_keys, rhs_distinct, presence)
+        keep = matched if node.op == 'and' else ~matched
+        return self._compact(lhs.labels, np.where(keep, lhs.values, np.nan))
+
+    @staticmethod
+    def _presence_of(keys, distinct, presence):
+        """Per key and step: does the other side have a sample with the same signature"""
+        lookup = {key: g for g, key in enumerate(distinct)}
+        result = np.zeros((len(keys), presence.shape[1]), dtype=bool)
+        for row, key in enumerate(keys):
+            if key in lookup:
+                result[row] = presence[lookup[key]]
+        return result
+
+    def vector_operation(self, node, lhs, rhs):
+        op = node.op
+        matching = node.matching
+        on = matching is not None and matching.on
+        names = sorted(set(matching.labels)) if matching is not None else []
+        card = matching.card if matching is not None else 'one-to-one'
+        include = matching.include if matching is not None else []
+
+        # The "one" side must have unique signatures; with one-to-one both sides must
+        one, many = (rhs, lhs) if card != 'one-to-many' else (lhs, rhs)
+        one_keys = [_signature(s, names, on) for s in one.labels]
+        many_keys = [_signature(s, names, on) for s in many.labels]
+        one_index = {}
+        for row, key in enumerate(one_keys):
+            if key in one_index and self._overlap(one.values[one_index[key]], one.values[row]):
+                side = 'right' if one is rhs else 'left'
+                raise PromQLEvalError(f"found duplicate series for the match group {dict(key)} on the {side} "
+                                      "hand-side of the operation; many-to-many matching not allowed: "
+                                      "matching labels must be unique on one side")
+            one_index.setdefault(key, row)
+        pairs = [(row, one_index[key]) for row, key in enumerate(many_keys) if key in one_index]
+        if card == 'one-to-one':
+            seen = {}
+            for row, other in pairs:
+                if other in seen and self._overlap(many.values[seen[other]], many.values[row]):
+                    raise PromQLEvalError("multiple matches for labels: many-to-one matching must be explicit "
+                                          "(group_left/group_right)")
+                seen.setdefault(other, row)
+        if not pairs:
+            return Vector([], np.empty((0, lhs.values.shape[1])))
+        many_rows = np.array([p[0] for p in pairs])
+        one_rows = np.array([p[1] for p in pairs])
+        many_values, one_values = many.values[many_rows], one.values[one_rows]
+        left, right = (many_values, one_values) if many is lhs else (one_values, many_values)
+
+        drop_name = op not in COMPARISON_OPS or node.return_bool
+        labels = []
+        for row, other in pairs:
+            series = dict(many.labels[row])
+            if drop_name:
+                series.pop('__name__', None)
+            if card == 'one-to-one':
+                if on:
+                    series = {k: v for k, v in series.items() if k in names}
+                else:
+                    series = {k: v for k, v in series.items() if k not in names}
+            for name in include:
+                value = one.labels[other].get(name, '')
+                if value:
+                    series[name] = value
+                else:
+                    series.pop(name, None)
+            labels.append(series)
+
+        with np.errstate(all='ignore'):
+            if op in COMPARISON_OPS:
+                matched = COMPARISONS[op](left, right)
+                both = ~np.isnan(left) & ~np.isnan(right)
+                if node.return_bool:
+                    values = np.where(both, matched.astype(np.float64), np.nan)
+                else:
+                    values = np.where(both & matched, left, np.nan)
+            else:
+                values = ARITHMETIC[op](left, right)
+        return self._compact(labels, values)
+
+    @staticmethod
+    def _overlap(a, b):
+        return bool(np.any(~np.isnan(a) & ~np.isnan(b)))
+
+class Engine:
+    """Evaluates PromQL queries against a TSDB and returns Prometheus API data blocks."""
+
+    def __init__(self, tsdb, lookback=LOOKBACK_SECONDS):
+        self.tsdb = tsdb
+        self.lookback = lookback
+
+    def instant_query(self, query, eval_time):
+        """Evaluate a query at one time; returns (data, stats) like /api/v1/query"""
+        started = time.perf_counter()
+        evaluation = _Evaluation(self.tsdb, self.lookback, eval_time, eval_time)
+        value = evaluation.eval(parse(query), np.array([float(eval_time)]))
+        timestamp = round(float(eval_time), 3)
+        if isinstance(value, Scalar):
+            data = {'resultType': 'scalar', 'result': [timestamp, format_value(value.values[0])]}
+        elif isinstance(value, String):
+            data = {'resultType': 'string', 'result': [timestamp, value.value]}
+        elif isinstance(value, RangeData):
+            data = {'resultType': 'matrix', 'result': self._raw_samples(evaluation, value)}
+        else:
+            result = [{'metric': labels, 'value': [timestamp, format_value(v)]}
+                      for labels, v in zip(value.labels, value.values[:, 0]) if not math.isnan(v)]
+            tree = parse(query)
+            if isinstance(tree, Call) and tree.func in ('sort', 'sort_desc'):
+                result.sort(key=lambda s: float(s['value'][1].replace('Inf', 'inf')),
+                            reverse=tree.func == 'sort_desc')
+            data = {'resultType': 'vector', 'result': result}
+        return data, self._stats(evaluation, started)
+
+    def range_query(self, query, start, end, step):
+        """Evaluate a query from start to end; returns (data, stats) like /api/v1/query_range"""
+        started = time.perf_counter()
+        if step <= 0:
+            raise PromQLEvalError("zero or negative query resolution step widths are not accepted")
+        evaluation = _Evaluation(self.tsdb, self.lookback, start, end)
+        steps = np.arange(float(start), float(end) + step / 2, float(step))
+        value = evaluation.eval(parse(query), steps)
+        if isinstance(value, Scalar):
+            value = Vector([{}], value.values[None, :])
+        if not isinstance(value, Vector):
+            raise PromQLEvalError("invalid expression type for range query, must be Scalar or instant Vector")
+        result = []
+        timestamps = [round(float(t), 3) for t in steps]
+        for labels, row in zip(value.labels, value.values):
+            points = [[t, format_value(v)] for t, v in zip(timestamps, row) if not math.isnan(v)]
+            if points:
+                result.append({'metric': labels, 'values': points})
+        return {'resultType': 'matrix', 'result': result}, self._stats(evaluation, started)
+
+    @staticmethod
+    def _raw_samples(evaluation, data):
+        result = []
+        for steps, values, times, valid in evaluation.windows(data):
+            for labels, row_values, row_times, row_valid in zip(data.labels, values[:, 0], times[:, 0], valid[:, 0]):
+                points = [[round(float(t), 3), format_value(v)]
+                          for t, v, ok in zip(row_times, row_values, row_valid) if ok]
+                if points:
+                    result.append({'metric': labels, 'values': points})
+        return result
+
+    @staticmethod
+    def _stats(evaluation, started):
+        elapsed = time.perf_counter() - started
+        return {
+            'timings': {'evalTotalTime': elapsed, 'execTotalTime': elapsed},
+            'samples': {'totalQueryableSamples': evaluation.total_samples, 'peakSamples': evaluation.peak_samples},
+        }
+
+def build_lab_tsdb(instances=1, cpus=4, first_instance=DEFAULT_INSTANCE, end=None, history=7200.0, interval=15.0,
+                   seed=42):
+    """Synthetic fleet data plus the lab recording rules, ending at `end` (default: now)"""
+    if end is None:
+        end = math.floor(time.time() / interval) * interval
+    fleet = Fleet(instances=instances, cpus=cpus, seed=seed, first_instance=first_instance)
+    tsdb = TSDB.from_fleet(fleet, end - history, end, interval)
+    for labels, values in evaluate_recording_rules(tsdb):
+        tsdb.add_series(labels, values)
+    return tsdb, end
+
+def evaluate_recording_rules(tsdb, rules=LAB_RECORDING_RULES, lookback=LOOKBACK_SECONDS):
+    """Yield (label dicts with __name__, values) of each rule at every timestamp of the TSDB (NaN = no sample)"""
+    timestamps = tsdb.timestamps
+    for name, expr in rules.items():
+        value = _Evaluation(tsdb, lookback, timestamps[0], timestamps[-1]).eval(parse(expr), timestamps)
+        yield [dict(series, __name__=name) for series in value.labels], value.values
+
+def catalog_history(queries, minimum=3600.0):
+    """Seconds of data the catalog needs before its evaluation time"""
+    needed = minimum * 1000
+    for query_info in queries:
+        try:
+            needed = max(needed, required_history(parse(query_info['query'].replace('\\"', '"'))))
+        except PromQLSyntaxError:
+            continue
+    return needed / 1000
+
+# ---------------------------------------------------------------------------
+# HTTP API
+# ---------------------------------------------------------------------------
+
+def _make_handler(engine):
+    class EvalHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass  # Keep the test output readable
+
+        def _send(self, code, payload):
+            if isinstance(payload, str):
+                body, content_type = payload.encode(), 'text/plain; charset=utf-8'
+            else:
+                body, content_type = json.dumps(payload, separators=(',', ':')).encode(), 'application/json'
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, params):
+            path = urlparse(self.path).path.rstrip('/')
+            param = lambda name, default=None: params.get(name, [default])[0]
+            if path in ('/-/healthy', '/-/ready'):
+                self._send(200, 'Prometheus Server is Healthy.')
+                return
+            if path == '/api/v1/status/buildinfo':
+                self._send(200, {'status': 'success', 'data': {'version': 'offline-evaluator'}})
+                return
+            try:
+                if path == '/api/v1/query':
+                    data, stats = engine.instant_query(param('query', ''), float(param('time', time.time())))
+                elif path == '/api/v1/query_range':
+                    data, stats = engine.range_query(param('query', ''), float(param('start')),
+                                                     float(param('end')), float(param('step')))
+                else:
+                    self._send(404, {'status': 'error', 'errorType': 'not_found',
+                                     'error': f'{path} is not served by the offline evaluator'})
+                    return
+            except (PromQLSyntaxError, TypeError) as e:
+                self._send(400, {'status': 'error', 'errorType': 'bad_data', 'error': str(e)})
+                return
+            except (PromQLEvalError, ValueError) as e:
+                self._send(422, {'status': 'error', 'errorType': 'execution', 'error': str(e)})
+                return
+            if param('stats'):
+                data['stats'] = stats
+            self._send(200, {'status': 'success', 'data': data})
+
+        def do_GET(self):
+            self._handle(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            params = parse_qs(urlparse(self.path).query)
+            params.update(parse_qs(self.rfile.read(length).decode()))
+            self._handle(params)
+
+    return EvalHandler
+
+def start_eval_server(engine, host='127.0.0.1', port=0):
+    """Serve the evaluator from a background thread and return (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), _make_handler(engine))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+"""
+A small PromQL tokenizer and parser for the lab tooling.
+
+It covers the PromQL used in the labs: selectors, range selectors and
+subqueries, offset and @ modifiers, function calls, aggregations with
+by/without, binary operators with bool/on/ignoring/group_left/group_right,
+and number and string literals.
+
+parse() turns a query into an expression tree. canonicalize() renders a
+tree back as a single canonical string: label matchers and grouping labels
+are sorted, durations are normalized (300s -> 5m), by/without is always
+written before the aggregated expression and redundant parentheses are
+dropped. Two queries that only differ in formatting therefore have the
+same canonical form and the same canonical_hash().
+"""
+
+import hashlib
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+class PromQLSyntaxError(ValueError):
+    """Raised when a query cannot be tokenized or parsed."""
+
+    def __init__(self, message, position=None):
+        if position is not None:
+            message = f"{message} (at position {position})"
+        super().__init__(message)
+        self.position = position
+
+AGGREGATION_OPS = {
+    'sum', 'avg', 'count', 'min', 'max', 'group', 'stddev', 'stdvar',
+    'topk', 'bottomk', 'quantile', 'count_values', 'limitk', 'limit_ratio'
+}
+# Aggregations that take a parameter before the aggregated expression
+PARAMETER_AGGREGATIONS = {'topk', 'bottomk', 'quantile', 'count_values', 'limitk', 'limit_ratio'}
+
+KEYWORDS = {'and', 'or', 'unless', 'atan2', 'by', 'without', 'on', 'ignoring',
+            'group_left', 'group_right', 'bool', 'offset'}
+
+# Binary operator precedence, lowest first
+PRECEDENCE = {
+    'or': 1,
+    'and': 2, 'unless': 2,
+    '==': 3, '!=': 3, '<=': 3, '<': 3, '>=': 3, '>': 3,
+    '+': 4, '-': 4,
+    '*': 5, '/': 5, '%': 5, 'atan2': 5,
+    '^': 6
+}
+COMPARISON_OPS = {'==', '!=', '<=', '<', '>=', '>'}
+SET_OPS = {'and', 'or', 'unless'}
+# How catalog queries refer to the instance under test
+INSTANCE_PLACEHOLDER = '$INSTANCE'
+
+DURATION_UNITS = [('y', 365 * 86400000), ('w', 7 * 86400000), ('d', 86400000),
+                  ('h', 3600000), ('m', 60000), ('s', 1000), ('ms', 1)]
+_UNIT_MS = dict(DURATION_UNITS)
+
+# ---------------------------------------------------------------------------
+# Tokenizer
+# ---------------------------------------------------------------------------
+
+@dataclass
+class Token:
+    kind: str       # IDENT, NUMBER, DURATION, STRING, OP, PUNCT, EOF
+    value: str
+    position: int
+
+_DURATION_RE = re.compile(r'(?:\d+(?:ms|[smhdwy]))+')
+_NUMBER_RE = re.compile(r'0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_IDENT_RE = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+_IDENT_IN_BRACKETS_RE = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+_WORD_CHAR_RE = re.compile(r'[a-zA-Z0-9_]')
+_OPERATORS = ['==', '!=', '<=', '>=', '=~', '!~', '+', '-', '*', '/', '%', '^', '<', '>', '=', '@']
+_PUNCTUATION = '(){}[],:'
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"', "'": "'",
+            'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v'}
+
+def tokenize(query):
+    """Split a query into tokens. Comments (# ...) are skipped."""
+    tokens = []
+    position = 0
+    bracket_depth = 0
+    length = len(query)
+    while position < length:
+        char = query[position]
+        if char.isspace():
+            position += 1
+            continue
+        if char == '#':
+            newline = query.find('\n', position)
+            position = length if newline == -1 else newline
+            continue
+        if char in '"\'`':
+            value, position = _read_string(query, position)
+            tokens.append(Token('STRING', value, position))
+            continue
+        if char.isdigit() or (char == '.' and position + 1 < length and query[position + 1].isdigit()):
+            match = _DURATION_RE.match(query, position)
+            if match and not _WORD_CHAR_RE.match(query, match.end()):
+                tokens.append(Token('DURATION', match.group(), position))
+                position = match.end()
+                continue
+            match = _NUMBER_RE.match(query, position)
+            tokens.append(Token('NUMBER', match.group(), position))
+            position = match.end()
+            continue
+        # Inside [...] a colon separates the subquery range from its step
+        ident_re = _IDENT_IN_BRACKETS_RE if bracket_depth else _IDENT_RE
+        match = ident_re.match(query, position)
+        if match:
+            tokens.append(Token('IDENT', match.group(), position))
+            position = match.end()
+            continue
+        for op in _OPERATORS:
+            if query.startswith(op, position):
+                tokens.append(Token('OP', op, position))
+                position += len(op)
+                break
+        else:
+            if char in _PUNCTUATION:
+                if char == '[':
+                    bracket_depth += 1
+                elif char == ']':
+                    bracket_depth = max(0, bracket_depth - 1)
+                tokens.append(Token('PUNCT', char, position))
+                position += 1
+            else:
+                raise PromQLSyntaxError(f"unexpected character {char!r}", position)
+    tokens.append(Token('EOF', '', length))
+    return tokens
+
+def _read_string(query, start):
+    quote = query[start]
+    position = start + 1
+    chars = []
+    while position < len(query):
+        char = query[position]
+        if char == quote:
+            return ''.join(chars), position + 1
+        if char == '\\' and quote != '`' and position + 1 < len(query):
+            escaped = query[position + 1]
+            chars.append(_ESCAPES.get(escaped, '\\' + escaped))
+            position += 2
+            continue
+        chars.append(char)
+        position += 1
+    raise PromQLSyntaxError("unterminated string", start)
+
+def parse_duration(text):
+    """Convert a duration such as 1h30m or 500ms to milliseconds"""
+    if not _DURATION_RE.fullmatch(text):
+        raise PromQLSyntaxError(f"invalid duration {text!r}")
+    return sum(int(amount) * _UNIT_MS[unit]
+               for amount, unit in re.findall(r'(\d+)(ms|[smhdwy])', text))
+
+def format_duration(milliseconds):
+    """Render milliseconds with the largest units first, e.g. 5400000 -> 1h30m"""
+    if milliseconds == 0:
+        return '0s'
+    parts = []
+    for unit, size in DURATION_UNITS:
+        if milliseconds >= size:
+            amount, milliseconds = divmod(milliseconds, size)
+            parts.append(f"{amount}{unit}")
+    return ''.join(parts)
+
+# ---------------------------------------------------------------------------
+# Expression tree
+# ---------------------------------------------------------------------------
+
+@dataclass
+class LabelMatcher:
+    name: str
+    op: str        # =, !=, =~, !~
+    value: str
+
+@dataclass
+class NumberLiteral:
+    value: float
+
+@dataclass
+class StringLiteral:
+    value: str
+
+@dataclass
+class VectorSelector:
+    name: Optional[str]
+    matchers: List[LabelMatcher] = field(default_factory=list)
+    offset: int = 0          # milliseconds
+    at: Optional[str] = None  # @ modifier: a timestamp, start() or end()
+
+@dataclass
+class MatrixSelector:
+    vector: VectorSelector
+    range: int               # milliseconds
+
+@dataclass
+class SubqueryExpr:
+    expr: object
+    range: int               # milliseconds
+    step: Optional[int] = None
+    offset: int = 0
+    at: Optional[str] = None
+
+@dataclass
+class Call:
+    func: str
+    args: list
+
+@dataclass
+class AggregateExpr:
+    op: str
+    expr: object
+    param: object = None
+    grouping: List[str] = field(default_factory=list)
+    without: bool = False
+    has_grouping: bool = False  # True if by (...) or without (...) was given
+
+@dataclass
+class VectorMatching:
+    on: bool = False              # on(...) instead of ignoring(...)
+    labels: List[str] = field(default_factory=list)
+    card: str = 'one-to-one'      # one-to-one, many-to-one (group_left), one-to-many (group_right)
+    include: List[str] = field(default_factory=list)
+    has_labels: bool = False      # True if on (...) or ignoring (...) was given
+
+@dataclass
+class BinaryExpr:
+    op: str
+    lhs: object
+    rhs: object
+    return_bool: bool = False
+    matching: Optional[VectorMatching] = None
+
+@dataclass
+class UnaryExpr:
+    op: str
+    expr: object
+
+@dataclass
+class ParenExpr:
+    expr: object
+
+# ---------------------------------------------------------------------------
+# Parser
+# ---------------------------------------------------------------------------
+
+class _Parser:
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.index = 0
+
+    @property
+    def current(self):
+        return self.tokens[self.index]
+
+    def advance(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def at(self, kind, value=None):
+        token = self.current
+        return token.kind == kind and (value is None or token.value == value)
+
+    def at_keyword(self, *words):
+        return self.current.kind == 'IDENT' and self.current.value.lower() in words
+
+    def expect(self, kind, value=None):
+        if not self.at(kind, value):
+            wanted = value or kind
+            found = self.current.value or 'end of query'
+            raise PromQLSyntaxError(f"expected {wanted!r} but found {found!r}", self.current.position)
+        return self.advance()
+
+    def parse(self):
+        expr = self.parse_binary(0)
+        if not self.at('EOF'):
+            raise PromQLSyntaxError(f"unexpected {self.current.value!r}", self.current.position)
+        return expr
+
+    def binary_operator(self):
+        token = self.current
+        if token.kind == 'OP' and token.value in PRECEDENCE:
+            return token.value
+        if token.kind == 'IDENT' and token.value.lower() in ('and', 'or', 'unless', 'atan2'):
+            return token.value.lower()
+        return None
+
+    def parse_binary(self, min_precedence):
+        lhs = self.parse_unary()
+        while True:
+            op = self.binary_operator()
+            if op is None or PRECEDENCE[op] < min_precedence:
+                return lhs
+            self.advance()
+            return_bool = False
+            if self.at_keyword('bool'):
+                if op not in COMPARISON_OPS:
+                    raise PromQLSyntaxError("bool modifier can only be used on comparison operators",
+                                            self.current.position)
+                self.advance()
+                return_bool = True
+            matching = self.parse_vector_matching(op)
+            # ^ is right-associative, everything else is left-associative
+            next_precedence = PRECEDENCE[op] if op == '^' else PRECEDENCE[op] + 1
+            rhs = self.parse_binary(next_precedence)
+            lhs = BinaryExpr(op, lhs, rhs, return_bool, matching)
+
+    def parse_vector_matching(self, op):
+        if not self.at_keyword('on', 'ignoring'):
+            if op in SET_OPS:
+                return VectorMatching(card='many-to-many')
+            return None
+        matching = VectorMatching(on=self.advance().value.lower() == 'on', has_labels=True)
+        matching.labels = self.parse_label_list()
+        if op in SET_OPS:
+            matching.card = 'many-to-many'
+        if self.at_keyword('group_left', 'group_right'):
+            if op in SET_OPS:
+                raise PromQLSyntaxError("no grouping allowed for set operations", self.current.position)
+            side = self.advance().value.lower()
+            matching.card = 'many-to-one' if side == 'group_left' else 'one-to-many'
+            if self.at('PUNCT', '('):
+                matching.include = self.parse_label_list()
+        return matching
+
+    def parse_label_list(self):
+        self.expect('PUNCT', '(')
+        labels = []
+        while not self.at('PUNCT', ')'):
+            labels.append(self.expect('IDENT').value)
+            if not self.at('PUNCT', ')'):
+                self.expect('PUNCT', ',')
+        self.expect('PUNCT', ')')
+        return labels
+
+    def parse_unary(self):
+        if self.at('OP', '-') or self.at('OP', '+'):
+            op = self.advance().value
+            # Unary operators bind less tightly than ^ (-2 ^ 2 == -4)
+            expr = self.parse_binary(PRECEDENCE['^'])
+            if op == '+':
+                return expr
+            if isinstance(expr, NumberLiteral):
+                return NumberLiteral(-expr.value)
+            return UnaryExpr('-', expr)
+        return self.parse_postfix(self.parse_primary())
+
+    def parse_postfix(self, expr):
+        while True:
+            if self.at('PUNCT', '['):
+                expr = self.parse_range(expr)
+            elif self.at_keyword('offset'):
+                self.advance()
+                negative = False
+                if self.at('OP', '-'):
+                    self.advance()
+                    negative = True
+                offset = parse_duration(self.expect('DURATION').value)
+                self.set_modifier(expr, 'offset', -offset if negative else offset)
+            elif self.at('OP', '@'):
+                self.advance()
+                if self.at('NUMBER'):
+                    at = self.advance().value
+                else:
+                    at = self.expect('IDENT').value + '()'
+                    self.expect('PUNCT', '(')
+                    self.expect('PUNCT', ')')
+                self.set_modifier(expr, 'at', at)
+            else:
+                return expr
+
+    def set_modifier(self, expr, name, value):
+        target = expr.vector if isinstance(expr, MatrixSelector) else expr
+        if not isinstance(target, (VectorSelector, SubqueryExpr)):
+            raise PromQLSyntaxError(f"{name} modifier must be preceded by a selector or subquery",
+                                    self.current.position)
+        setattr(target, name, value)
+
+    def parse_range(self, expr):
+        start = self.expect('PUNCT', '[').position
+        range_ms = parse_duration(self.expect('DURATION').value)
+        if self.at('PUNCT', ':'):
+            self.advance()
+            step = None
+            if self.at('DURATION'):
+                step = parse_duration(self.advance().value)
+            self.expect('PUNCT', ']')
+            return SubqueryExpr(expr, range_ms, step)
+        self.expect('PUNCT', ']')
+        if not isinstance(expr, VectorSelector) or expr.offset or expr.at:
+            raise PromQLSyntaxError("ranges are only allowed for vector selectors", start)
+        return MatrixSelector(expr, range_ms)
+
+    def parse_primary(self):
+        token = self.current
+        if token.kind == 'NUMBER':
+            self.advance()
+            return NumberLiteral(float.fromhex(token.value) if token.value.lower().startswith('0x')
+                                 else float(token.value))
+        if token.kind == 'STRING':
+            self.advance()
+            return StringLiteral(token.value)
+        if token.kind == 'PUNCT' and token.value == '(':
+            self.advance()
+            expr = self.parse_binary(0)
+            self.expect('PUNCT', ')')
+            return ParenExpr(expr)
+        if token.kind == 'PUNCT' and token.value == '{':
+            return self.parse_selector(None)
+        if token.kind == 'IDENT':
+            name = token.value
+            lowered = name.lower()
+            if lowered in ('inf', 'nan'):
+                self.advance()
+                return NumberLiteral(float(lowered))
+            if lowered in AGGREGATION_OPS and self.peek_aggregation():
+                return self.parse_aggregation()
+            self.advance()
+            if self.at('PUNCT', '(') and lowered not in KEYWORDS:
+                return self.parse_call(name)
+            if lowered in KEYWORDS:
+                raise PromQLSyntaxError(f"unexpected keyword {name!r}", token.position)
+            return self.parse_selector(name)
+        found = token.value or 'end of query'
+        raise PromQLSyntaxError(f"unexpected {found!r}", token.position)
+
+    def peek_aggregation(self):
+        following = self.tokens[self.index + 1]
+        return (following.kind == 'PUNCT' and following.value == '(') or \
+            (following.kind == 'IDENT' and following.value.lower() in ('by', 'without'))
+
+    def parse_aggregation(self):
+        op = self.advance().value.lower()
+        node = AggregateExpr(op, None)
+        if self.at_keyword('by', 'without'):
+            self.parse_grouping(node)
+        self.expect('PUNCT', '(')
+        if op in PARAMETER_AGGREGATIONS:
+            node.param = self.parse_binary(0)
+            self.expect('PUNCT', ',')
+        node.expr = self.parse_binary(0)
+        self.expect('PUNCT', ')')
+        if self.at_keyword('by', 'without'):
+            if node.has_grouping:
+                raise PromQLSyntaxError("aggregation has more than one grouping clause", self.current.position)
+            self.parse_grouping(node)
+        return node
+
+    def parse_grouping(self, node):
+        node.without = self.advance().value.lower() == 'without'
+        node.grouping = self.parse_label_list()
+        node.has_grouping = True
+
+    def parse_call(self, name):
+        self.expect('PUNCT', '(')
+        args = []
+        while not self.at('PUNCT', ')'):
+            args.append(self.parse_binary(0))
+            if not self.at('PUNCT', ')'):
+                self.expect('PUNCT', ',')
+        self.expect('PUNCT', ')')
+        return Call(name, args)
+
+    def parse_selector(self, name):
+        matchers = []
+        if self.at('PUNCT', '{'):
+            self.advance()
+            while not self.at('PUNCT', '}'):
+                label = self.expect('IDENT').value
+                op = self.advance()
+                if op.kind != 'OP' or op.value not in ('=', '!=', '=~', '!~'):
+                    raise PromQLSyntaxError(f"expected label matching operator but found {op.value!r}",
+                                            op.position)
+                matchers.append(LabelMatcher(label, op.value, self.expect('STRING').value))
+                if not self.at('PUNCT', '}'):
+                    self.expect('PUNCT', ',')
+            self.expect('PUNCT', '}')
+        if name is None:
+            # {__name__="metric"} is the same selector as metric{}
+            for matcher in matchers:
+                if matcher.name == '__name__' and matcher.op == '=':
+                    name = matcher.value
+                    matchers.remove(matcher)
+                    break
+            if name is None and not matchers:
+                raise PromQLSyntaxError("vector selector must contain at least one matcher",
+                                        self.current.position)
+        return VectorSelector(name, matchers)
+
+def parse(query):
+    """Parse a PromQL query into an expression tree"""
+    return _Parser(query).parse()
+
+# ---------------------------------------------------------------------------
+# Canonical rendering
+# ---------------------------------------------------------------------------
+
+def strip_parens(node):
+    """Return the expression inside any number of redundant parentheses"""
+    while isinstance(node, ParenExpr):
+        node = node.expr
+    return node
+
+def format_number(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def format_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def format_selector(node):
+    matchers = sorted(node.matchers, key=lambda m: (m.name, m.op, m.value))
+    text = node.name or ''
+    if matchers or not text:
+        text += '{' + ','.join(f"{m.name}{m.op}{format_string(m.value)}" for m in matchers) + '}'
+    return text
+
+def format_modifiers(node):
+    text = ''
+    if node.offset:
+        text += f" offset {'-' if node.offset < 0 else ''}{format_duration(abs(node.offset))}"
+    if node.at:
+        text += f" @ {node.at}"
+    return text
+
+def _needs_parens(child, parent_op, is_rhs):
+    child = strip_parens(child)
+    if not isinstance(child, BinaryExpr):
+        return False
+    parent, own = PRECEDENCE[parent_op], PRECEDENCE[child.op]
+    if own != parent:
+        return own < parent
+    # Equal precedence: only the side that associates away needs parentheses
+    return not is_rhs if parent_op == '^' else is_rhs
+
+def _format_operand(node):
+    """Render an expression that is followed by [range] or a modifier"""
+    node = strip_parens(node)
+    text = canonicalize(node)
+    if isinstance(node, (BinaryExpr, UnaryExpr, SubqueryExpr)):
+        return f"({text})"
+    return text
+
+def canonicalize(node):
+    """Render an expression tree as canonical PromQL text"""
+    node = strip_parens(node)
+    if isinstance(node, NumberLiteral):
+        return format_number(node.value)
+    if isinstance(node, StringLiteral):
+        return format_string(node.value)
+    if isinstance(node, VectorSelector):
+        return format_selector(node) + format_modifiers(node)
+    if isinstance(node, MatrixSelector):
+        return f"{format_selector(node.vector)}[{format_duration(node.range)}]{format_modifiers(node.vector)}"
+    if isinstance(node, SubqueryExpr):
+        step = format_duration(node.step) if node.step else ''
+        return f"{_format_operand(node.expr)}[{format_duration(node.range)}:{step}]{format_modifiers(node)}"
+    if isinstance(node, Call):
+        return f"{node.func}({', '.join(canonicalize(arg) for arg in node.args)})"
+    if isinstance(node, AggregateExpr):
+        text = node.op
+        if node.has_grouping:
+            text += f" {'without' if node.without else 'by'} ({', '.join(sorted(set(node.grouping)))}) "
+        args = [canonicalize(node.param)] if node.param is not None else []
+        args.append(canonicalize(node.expr))
+        return f"{text}({', '.join(args)})"
+    if isinstance(node, UnaryExpr):
+        inner = strip_parens(node.expr)
+        text = canonicalize(inner)
+        if isinstance(inner, BinaryExpr):
+            text = f"({text})"
+        return f"-{text}"
+    if isinstance(node, BinaryExpr):
+        lhs = canonicalize(node.lhs)
+        rhs = canonicalize(node.rhs)
+        if _needs_parens(node.lhs, node.op, False):
+            lhs = f"({lhs})"
+        if _needs_parens(node.rhs, node.op, True):
+            rhs = f"({rhs})"
+        op = node.op
+        if node.return_bool:
+            op += ' bool'
+        matching = node.matching
+        if matching is not None and matching.has_labels:
+            op += f" {'on' if matching.on else 'ignoring'} ({', '.join(sorted(set(matching.labels)))})"
+        if matching is not None and matching.card in ('many-to-one', 'one-to-many'):
+            side = 'group_left' if matching.card == 'many-to-one' else 'group_right'
+            # Always write the label list so a parenthesized rhs is not mistaken for it
+            op += f" {side} ({', '.join(sorted(set(matching.include)))})"
+        return f"{lhs} {op} {rhs}"
+    raise TypeError(f"cannot render {type(node).__name__}")
+
+def canonical_query(query):
+    """Parse a query and return its canonical text"""
+    return canonicalize(parse(query))
+
+def canonical_hash(query):
+    """Stable short hash of a query's canonical form"""
+    return hashlib.sha1(canonical_query(query).encode('utf-8')).hexdigest()[:16]
+
+def walk(node):
+    """Yield every node of an expression tree, parents before children"""
+    yield node
+    if isinstance(node, (ParenExpr, UnaryExpr, SubqueryExpr)):
+        yield from walk(node.expr)
+    elif isinstance(node, MatrixSelector):
+        yield from walk(node.vector)
+    elif isinstance(node, Call):
+        for arg in node.args:
+            yield from walk(arg)
+    elif isinstance(node, AggregateExpr):
+        if node.param is not None:
+            yield from walk(node.param)
+        yield from walk(node.expr)
+    elif isinstance(node, BinaryExpr):
+        yield from walk(node.lhs)
+        yield from walk(node.rhs)
+
+def required_history(node, lookback=300000):
+    """Milliseconds of data before the evaluation time that an expression reads.
+
+    Instant selectors look back `lookback` (Prometheus's 5m default),
+    range selectors their range, and subqueries add their range to
+    whatever their inner expression needs. Offsets shift all of it back.
+    """
+    node = strip_parens(node)
+    if isinstance(node, VectorSelector):
+        return node.offset + lookback
+    if isinstance(node, MatrixSelector):
+        return node.vector.offset + node.range
+    if isinstance(node, SubqueryExpr):
+        return node.offset + node.range + required_history(node.expr, lookback)
+    children = []
+    if isinstance(node, UnaryExpr):
+        children = [node.expr]
+    elif isinstance(node, Call):
+        children = node.args
+    elif isinstance(node, AggregateExpr):
+        children = [node.expr] + ([node.param] if node.param is not None else [])
+    elif isinstance(node, BinaryExpr):
+        children = [node.lhs, node.rhs]
+    return max((required_history(child, lookback) for child in children), default=0)
+
+def generalize(node):
+    """Drop instance="$INSTANCE" matchers in place; return True if any were found"""
+    found = False
+    for child in walk(node):
+        if isinstance(child, VectorSelector):
+            kept = [m for m in child.matchers
+                    if not (m.name == 'instance' and m.op == '=' and m.value == INSTANCE_PLACEHOLDER)]
+            found = found or len(kept) != len(child.matchers)
+            child.matchers = kept
+    return found
@@ -295,6 +295,11 @@ lab8_queries = [
         "query": "max_over_time(rate(node_cpu_seconds_total{instance=\"$INSTANCE\",mode=\"user\"}[5m])[30m:5m])",
         "expected_type": "vector"
     },
+    {
+        "name": "Peak non-idle CPU over 30m (subquery)",
+        "query": "max_over_time((sum(rate(node_cpu_seconds_total{instance=\"$INSTANCE\",mode!=\"idle\"}[5m])) * 100)[30m:5m])",
+        "expected_type": "vector"
+    },
     {
         "name": "Detecting missing data",
         "query": "absent(node_cpu_seconds_total{instance=\"$INSTANCE\"})",
@@ -340,6 +345,11 @@ lab8_queries = [
         "query": "absent(node_filesystem_size_bytes{instance=\"$INSTANCE\"})",
         "expected_type": "vector"
     },
+    {
+        "name": "Top 3 filesystems by usage",
+        "query": "topk(3, 100 * (1 - (node_filesystem_free_bytes{instance=\"$INSTANCE\",fstype!=\"tmpfs\"} / node_filesystem_size_bytes{instance=\"$INSTANCE\",fstype!=\"tmpfs\"})))",
+        "expected_type": "vector"
+    },
     {
         "name": "TopK filesystems by usage",
         "query": "topk(2, 100 * (1 - (node_filesystem_free_bytes{instance=\"$INSTANCE\",fstype!=\"tmpfs\"} / node_filesystem_size_bytes{instance=\"$INSTANCE\",fstype!=\"tmpfs\"})))",
@@ -489,3 +499,18 @@ all_queries = (
     lab9_queries +
     lab10_queries
 )
+
+# Queries grouped by lab list, for per-lab reporting
+queries_by_lab = {
+    "lab0_queries": lab0_queries,
+    "lab1_queries": lab1_queries,
+    "lab2_queries": lab2_queries,
+    "lab3_queries": lab3_queries,
+    "lab4_queries": lab4_queries,
+    "lab5_queries": lab5_queries,
+    "lab6_queries": lab6_queries,
+    "lab7_queries": lab7_queries,
+    "lab8_queries": lab8_queries,
+    "lab9_queries": lab9_queries,
+    "lab10_queries": lab10_queries
+}
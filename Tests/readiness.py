@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Wait until Prometheus has enough data for each lab query, instead of sleeping.
+
+Every query is parsed and each selector it reads is turned into a data
+requirement: how far back the data must reach (its offset plus the
+offsets of enclosing subqueries) and how many samples the window needs
+(two for rate(), deriv() and friends, one otherwise). A requirement is
+checked with count_over_time(<selector>[window] offset <age>), so
+Prometheus itself answers whether the samples are there.
+
+ReadinessProbe.ready_batches() polls the pending requirements and
+yields queries as soon as all of theirs are met, so a test run can start
+on the queries that are ready while the ones with offsets and long
+subqueries are still waiting. With full_history=True every window must
+be covered back to its start, not just hold enough samples to return a
+result.
+
+Selectors inside absent() are skipped: those queries are meant to run
+against missing data.
+
+Usage (standalone, to see what the catalog is waiting for):
+    python readiness.py [--timeout SECONDS] [--full-history]
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from promql_parser import (AggregateExpr, BinaryExpr, Call, MatrixSelector, PromQLSyntaxError, SubqueryExpr,
+                           UnaryExpr, VectorSelector, canonicalize, format_duration, parse, strip_parens)
+
+LOOKBACK_MS = 300000               # Prometheus's default --query.lookback-delta
+DEFAULT_SUBQUERY_STEP_MS = 60000   # Prometheus's default evaluation_interval
+# Range functions that return nothing until their window holds two samples
+TWO_SAMPLE_FUNCTIONS = {'rate', 'irate', 'increase', 'delta', 'idelta', 'deriv', 'predict_linear'}
+ABSENT_FUNCTIONS = {'absent', 'absent_over_time'}
+
+class Requirement:
+    """At least `min_samples` samples of `selector` in (now - offset - window, now - offset]."""
+
+    def __init__(self, selector, window, offset, min_samples):
+        self.selector = selector   # Canonical selector text without offset or @
+        self.window = window       # milliseconds
+        self.offset = offset       # milliseconds
+        self.min_samples = min_samples
+
+    @property
+    def key(self):
+        return (self.selector, self.window, self.offset, self.min_samples)
+
+    @property
+    def expr(self):
+        offset = f" offset {format_duration(self.offset)}" if self.offset else ""
+        return f"count_over_time({self.selector}[{format_duration(self.window)}]{offset})"
+
+    def oldest(self):
+        """The requirement that the data reaches back to the start of the window"""
+        return Requirement(self.selector, min(self.window, LOOKBACK_MS), self.offset + self.window, 1)
+
+def _selector_text(node):
+    return canonicalize(VectorSelector(node.name, node.matchers))
+
+def requirements(node, offset=0, min_samples=1, full_history=False):
+    """Yield the data requirements of an expression.
+
+    With full_history, subqueries push their inner expression back by
+    their whole range (the oldest step) instead of only their offset.
+    """
+    node = strip_parens(node)
+    if isinstance(node, VectorSelector):
+        yield Requirement(_selector_text(node), LOOKBACK_MS, offset + node.offset, 1)
+    elif isinstance(node, MatrixSelector):
+        yield Requirement(_selector_text(node.vector), node.range, offset + node.vector.offset, min_samples)
+    elif isinstance(node, SubqueryExpr):
+        # The newest subquery step needs data; a two-sample function needs the step before it too
+        step = node.step or DEFAULT_SUBQUERY_STEP_MS
+        shift = node.range if full_history else (step if min_samples > 1 else 0)
+        yield from requirements(node.expr, offset + node.offset + shift, 1, full_history)
+    elif isinstance(node, Call):
+        if node.func in ABSENT_FUNCTIONS:
+            return
+        needed = 2 if node.func in TWO_SAMPLE_FUNCTIONS else 1
+        for arg in node.args:
+            yield from requirements(arg, offset, needed, full_history)
+    elif isinstance(node, AggregateExpr):
+        if node.param is not None:
+            yield from requirements(node.param, offset, 1, full_history)
+        yield from requirements(node.expr, offset, 1, full_history)
+    elif isinstance(node, BinaryExpr):
+        yield from requirements(node.lhs, offset, 1, full_history)
+        yield from requirements(node.rhs, offset, 1, full_history)
+    elif isinstance(node, UnaryExpr):
+        yield from requirements(node.expr, offset, 1, full_history)
+
+def query_requirements(query, instance_name, full_history=False):
+    """Distinct requirements of a catalog query ([] if it does not parse)"""
+    query = query.replace('$INSTANCE', instance_name).replace('\\"', '"')
+    try:
+        node = parse(query)
+    except PromQLSyntaxError:
+        return []
+    found = {}
+    for requirement in requirements(node):
+        found.setdefault(requirement.key, requirement)
+    if full_history:
+        for requirement in requirements(node, full_history=True):
+            oldest = requirement.oldest()
+            found.setdefault(oldest.key, oldest)
+    return list(found.values())
+
+class ReadinessProbe:
+    """Polls Prometheus until the data each query needs is there."""
+
+    def __init__(self, prometheus_url, session, instance_name, full_history=False, concurrency=8, instances=None):
+        self.prometheus_url = prometheus_url
+        self.session = session
+        self.instance_name = instance_name
+        # A query is ready once every one of these instances has its data
+        self.instances = list(instances) if instances else [instance_name]
+        self.full_history = full_history
+        self.concurrency = concurrency
+        self.met = set()
+
+    def requirements_of(self, query_info):
+        """Distinct requirements of a query across every probed instance"""
+        found = {}
+        for instance in self.instances:
+            for need in query_requirements(query_info['query'], instance, self.full_history):
+                found.setdefault(need.key, need)
+        return list(found.values())
+
+    def check(self, requirement):
+        """True once Prometheus holds enough samples for a requirement"""
+        if requirement.key in self.met:
+            return True
+        try:
+            response = self.session.get(f"{self.prometheus_url}/api/v1/query",
+                                        params={'query': requirement.expr}, timeout=10)
+            result = response.json().get('data', {}).get('result', [])
+        except Exception:
+            return False
+        if any(float(series['value'][1]) >= requirement.min_samples for series in result):
+            self.met.add(requirement.key)
+            return True
+        return False
+
+    def check_all(self, needed):
+        """Check the requirements that are not met yet, in parallel"""
+        unmet = list({need.key: need for need in needed if need.key not in self.met}.values())
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self.check, unmet))
+
+    def ready_batches(self, queries, timeout=600, interval=5):
+        """Yield (seconds waited, queries) as queries become ready, in readiness order.
+
+        Queries still waiting when the timeout passes are yielded last with
+        None instead of the waiting time, so the caller can run them anyway.
+        """
+        pending = [(query_info, self.requirements_of(query_info)) for query_info in queries]
+        started = time.monotonic()
+        while pending:
+            self.check_all(need for _, needs in pending for need in needs)
+            ready = [query_info for query_info, needs in pending if all(need.key in self.met for need in needs)]
+            waited = time.monotonic() - started
+            if ready:
+                pending = [(query_info, needs) for query_info, needs in pending if query_info not in ready]
+                yield round(waited, 1), ready
+            if not pending:
+                return
+            if waited >= timeout:
+                yield None, [query_info for query_info, _ in pending]
+                return
+            waiting_on = {need.key: need for _, needs in pending for need in needs if need.key not in self.met}
+            sys.stdout.write(f"\r⏳ {len(queries) - len(pending)}/{len(queries)} queries ready, waiting on "
+                             f"{len(waiting_on)} selectors ({int(waited)}s)   ")
+            sys.stdout.flush()
+            time.sleep(interval)
+            sys.stdout.write("\r" + " " * 90 + "\r")
+
+    def waiting_on(self, queries):
+        """Requirements of the given queries that are not met yet"""
+        unmet = {}
+        for query_info in queries:
+            for need in self.requirements_of(query_info):
+                unmet[need.key] = need
+        self.check_all(unmet.values())
+        return [need for need in unmet.values() if need.key not in self.met]
+
+def main():
+    from queries import all_queries
+    from test_queries import check_prerequisites, create_session, load_config
+
+    parser = argparse.ArgumentParser(description='Wait until Prometheus has enough data for the lab queries')
+    parser.add_argument('--timeout', type=float, default=600, help='Give up after this many seconds (default: 600)')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between polls (default: 5)')
+    parser.add_argument('--full-history', action='store_true',
+                        help='Wait until every range, subquery and offset window is fully covered')
+    args = parser.parse_args()
+
+    config = load_config()
+    session = create_session(8)
+    check_prerequisites(config['prometheus_url'], session)
+    probe = ReadinessProbe(config['prometheus_url'], session, config['instance_name'], args.full_history)
+    for waited, batch in probe.ready_batches(all_queries, args.timeout, args.interval):
+        if waited is None:
+            print(f"⚠️ {len(batch)} queries not ready after {args.timeout:g}s, still missing:")
+            for need in probe.waiting_on(batch):
+                print(f"   {need.expr} >= {need.min_samples}")
+            return 1
+        print(f"✅ {waited:>6.1f}s  {len(batch)} queries ready")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
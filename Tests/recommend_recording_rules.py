@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Recommend recording rules from subexpressions the query catalog repeats.
+
+Every query in queries.py is parsed and each of its subexpressions is
+rendered in canonical form, so the same expression written in different
+ways is counted once. Subexpressions that several queries share are
+ranked by how often they occur times their cost, and the best ones are
+written as recording-rule YAML in the format Scripts/install-rules.sh
+installs.
+
+A subexpression that filters on instance="$INSTANCE" is generalized to
+the whole fleet when the instance label survives every step of it (for
+example avg by (instance) (...)); the lab query can then select the
+recorded series for one instance. Subexpressions that aggregate the
+instance away only make sense for that one instance and are skipped.
+
+The cost is estimated from the samples each subexpression reads (range
+length / scrape interval, multiplied by subquery steps). With --measure
+each candidate is run against Prometheus and the totalQueryableSamples
+from stats=all is used instead.
+
+Usage:
+    python recommend_recording_rules.py [--min-queries N] [--top N] [--output FILE] [--measure]
+"""
+
+import argparse
+import re
+import sys
+from promql_parser import (AggregateExpr, BinaryExpr, Call, INSTANCE_PLACEHOLDER, MatrixSelector, NumberLiteral,
+                           ParenExpr, PromQLSyntaxError, StringLiteral, SubqueryExpr, UnaryExpr, VectorSelector,
+                           canonicalize, format_duration, generalize, parse, strip_parens, walk)
+from queries import queries_by_lab
+
+SCRAPE_INTERVAL_MS = 15000  # Matches the scrape_interval used by the labs and CI
+# Functions whose result no longer carries the input series' labels
+LABEL_DROPPING_FUNCTIONS = {'scalar', 'vector', 'absent', 'absent_over_time', 'time', 'pi'}
+# Names for the operation part of a generated rule name
+BINARY_OP_NAMES = {'/': 'ratio', '*': 'product', '-': 'diff', '+': 'sum', '%': 'mod', '^': 'pow'}
+
+class Candidate:
+    """A canonical subexpression and the catalog queries that contain it."""
+
+    def __init__(self, expr, node):
+        self.expr = expr
+        self.node = node
+        self.queries = set()      # (lab, query name)
+        self.occurrences = 0
+        self.contained = set()    # Canonical forms of candidate subexpressions inside this one
+        self.cost = estimate_cost(node)
+        self.measured = False
+
+    @property
+    def score(self):
+        return len(self.queries) * self.cost
+
+def is_recordable(node):
+    """Only instant-vector expressions that do some work are worth recording"""
+    if isinstance(node, (NumberLiteral, StringLiteral, VectorSelector, MatrixSelector, SubqueryExpr, ParenExpr)):
+        return False
+    if isinstance(node, UnaryExpr):
+        return False  # Recording -x instead of x saves nothing
+    if isinstance(node, Call) and node.func in LABEL_DROPPING_FUNCTIONS:
+        return False
+    if isinstance(node, BinaryExpr) and (isinstance(strip_parens(node.lhs), NumberLiteral) and
+                                         isinstance(strip_parens(node.rhs), NumberLiteral)):
+        return False
+    # At least one selector, otherwise it is just arithmetic on literals
+    return any(isinstance(child, VectorSelector) for child in walk(node))
+
+def keeps_instance(node):
+    """True if every step of the expression keeps the instance label on its result"""
+    for child in walk(node):
+        if isinstance(child, AggregateExpr) and child.op not in ('topk', 'bottomk', 'limitk', 'limit_ratio'):
+            if child.without == ('instance' in child.grouping) or not child.has_grouping:
+                return False
+        elif isinstance(child, Call) and child.func in LABEL_DROPPING_FUNCTIONS:
+            return False
+        elif isinstance(child, BinaryExpr) and child.matching is not None and child.matching.has_labels:
+            if child.matching.on != ('instance' in child.matching.labels):
+                return False
+    return True
+
+def estimate_cost(node, multiplier=1):
+    """Rough number of samples an expression reads per series"""
+    node = strip_parens(node)
+    if isinstance(node, VectorSelector):
+        return multiplier
+    if isinstance(node, MatrixSelector):
+        return multiplier * max(1, node.range // SCRAPE_INTERVAL_MS)
+    if isinstance(node, SubqueryExpr):
+        step = node.step or 60000  # Default evaluation interval
+        return estimate_cost(node.expr, multiplier * max(1, node.range // step))
+    if isinstance(node, (UnaryExpr, ParenExpr)):
+        return estimate_cost(node.expr, multiplier)
+    if isinstance(node, Call):
+        return sum(estimate_cost(arg, multiplier) for arg in node.args)
+    if isinstance(node, AggregateExpr):
+        return estimate_cost(node.expr, multiplier)
+    if isinstance(node, BinaryExpr):
+        return estimate_cost(node.lhs, multiplier) + estimate_cost(node.rhs, multiplier)
+    return 0
+
+def recordable_form(node):
+    """Canonical text of a subexpression as a recording rule, or None if it can't be recorded"""
+    if not is_recordable(node):
+        return None, None
+    # Work on a re-parsed copy so generalizing doesn't touch the original tree
+    copy = parse(canonicalize(node))
+    if generalize(copy) and not keeps_instance(copy):
+        return None, None
+    if INSTANCE_PLACEHOLDER in canonicalize(copy):
+        return None, None  # Instance used in some other way (regex, label_replace, ...)
+    return canonicalize(copy), copy
+
+def find_candidates(catalog):
+    """Collect every recordable subexpression of every query, keyed by canonical form"""
+    candidates = {}
+    errors = []
+    for lab, lab_queries in catalog.items():
+        for query_info in lab_queries:
+            query = query_info['query'].replace('\\"', '"')
+            try:
+                tree = parse(query)
+            except PromQLSyntaxError as e:
+                errors.append((f"{lab}: {query_info['name']}", str(e)))
+                continue
+            forms = {}
+            for node in walk(tree):
+                node = strip_parens(node)
+                if id(node) in forms:
+                    continue
+                expr, generalized = recordable_form(node)
+                forms[id(node)] = expr
+                if expr is None:
+                    continue
+                candidate = candidates.setdefault(expr, Candidate(expr, generalized))
+                candidate.queries.add((lab, query_info['name']))
+                candidate.occurrences += 1
+                for child in walk(node):
+                    child = strip_parens(child)
+                    if child is not node:
+                        child_expr = forms.get(id(child)) or recordable_form(child)[0]
+                        if child_expr:
+                            candidate.contained.add(child_expr)
+    return candidates, errors
+
+def select_candidates(candidates, min_queries):
+    """Keep shared subexpressions that aren't fully covered by a larger shared one"""
+    shared = {expr: c for expr, c in candidates.items() if len(c.queries) >= min_queries}
+    selected = []
+    for expr, candidate in shared.items():
+        covered = any(expr in other.contained and other.queries == candidate.queries
+                      for other in shared.values() if other is not candidate)
+        if not covered:
+            selected.append(candidate)
+    return sorted(selected, key=lambda c: (c.score, len(c.queries)), reverse=True)
+
+def measure_costs(selected):
+    """Replace cost estimates with Prometheus's totalQueryableSamples for each candidate"""
+    from test_queries import check_prerequisites, create_session, load_config, test_prom_query
+    config = load_config()
+    session = create_session()
+    check_prerequisites(config['prometheus_url'], session)
+    for candidate in selected:
+        outcome = test_prom_query(candidate.expr, candidate.expr, 'vector', config['prometheus_url'],
+                                  config['instance_name'], session=session)
+        samples = outcome['metrics'].get('total_queryable_samples')
+        if samples is not None:
+            candidate.cost = samples
+            candidate.measured = True
+
+def output_labels(node):
+    """Label names an expression's result is known to keep, from the expression alone.
+
+    A selector contributes the target labels, the labels it matches on,
+    and le for a _bucket series; every other label is left out, so the
+    same query always gets the same name.
+    """
+    node = strip_parens(node)
+    if isinstance(node, VectorSelector):
+        names = {m.name for m in node.matchers if m.name != '__name__'} | {'instance', 'job'}
+        if node.name and node.name.endswith('_bucket'):
+            names.add('le')
+        return names
+    if isinstance(node, (MatrixSelector, SubqueryExpr, UnaryExpr)):
+        return output_labels(node.vector if isinstance(node, MatrixSelector) else node.expr)
+    if isinstance(node, Call):
+        if node.func in LABEL_DROPPING_FUNCTIONS:
+            return set()
+        vector = next((a for a in node.args if not isinstance(strip_parens(a), (NumberLiteral, StringLiteral))), None)
+        labels = output_labels(vector) if vector is not None else set()
+        if node.func in ('label_replace', 'label_join'):
+            labels.add(strip_parens(node.args[1]).value)
+        elif node.func == 'histogram_quantile':
+            labels.discard('le')
+        return labels
+    if isinstance(node, AggregateExpr):
+        inner = output_labels(node.expr)
+        if node.op in ('topk', 'bottomk', 'limitk', 'limit_ratio'):
+            return inner
+        labels = inner - set(node.grouping) if node.without else set(node.grouping)
+        if node.op == 'count_values':
+            labels.add(strip_parens(node.param).value)
+        return labels
+    if isinstance(node, BinaryExpr):
+        lhs, rhs = strip_parens(node.lhs), strip_parens(node.rhs)
+        if isinstance(lhs, NumberLiteral):
+            return output_labels(rhs)
+        if isinstance(rhs, NumberLiteral) or node.op in ('and', 'unless'):
+            return output_labels(lhs)
+        if node.op == 'or':
+            return output_labels(lhs) | output_labels(rhs)
+        matching = node.matching
+        if matching is None:
+            return output_labels(lhs)
+        # on() labels are on both sides, so also on the result
+        matched = set(matching.labels) if matching.on else set()
+        side = rhs if matching.card == 'one-to-many' else lhs
+        return output_labels(side) | matched | set(matching.include)
+    return set()
+
+def aggregation_level(node):
+    """Labels an expression's result keeps, for the level part of a rule name.
+
+    job is left out as the convention does, unless it is all that is left.
+    """
+    labels = output_labels(node)
+    return '_'.join(sorted(labels - {'job'} or labels)) or 'global'
+
+def complemented(node):
+    """ids of the nodes under the x of a `1 - x` (or `100 - x`), toggled by each one they are in"""
+    flipped = set()
+    for child in walk(node):
+        if isinstance(child, BinaryExpr) and child.op == '-' and isinstance(strip_parens(child.lhs), NumberLiteral):
+            flipped ^= {id(inner) for inner in walk(child.rhs)}
+    return flipped
+
+def metric_part(node):
+    """First metric name in the expression plus the values it is filtered on.
+
+    Equality filters are left out when the expression takes the complement
+    of the selector, so 1 - idle is not named after idle; exclusions such as
+    device!="lo" still hold for the complement and are kept.
+    """
+    selector = next((child for child in walk(node) if isinstance(child, VectorSelector) and child.name), None)
+    if selector is None:
+        return 'expr'
+    name = selector.name[:-len('_total')] if selector.name.endswith('_total') else selector.name
+    inverted = id(selector) in complemented(node)
+    for matcher in sorted(selector.matchers, key=lambda m: m.name):
+        value = re.sub(r'[^a-zA-Z0-9_]', '_', matcher.value).strip('_')
+        if value and matcher.op == '=' and not inverted:
+            name += f"_{value}"
+        elif value and matcher.op == '!=':
+            name += f"_not_{value}"
+    return name
+
+def operation_part(node):
+    """Outermost operations first, e.g. avg_rate5m or percent"""
+    operations = []
+    current = node
+    while current is not None and len(operations) < 3:
+        current = strip_parens(current)
+        if isinstance(current, AggregateExpr):
+            operations.append(current.op)
+            current = current.expr
+        elif isinstance(current, Call):
+            matrix = next((strip_parens(a) for a in current.args if isinstance(strip_parens(a), MatrixSelector)), None)
+            operations.append(current.func + (format_duration(matrix.range) if matrix else ''))
+            current = next((a for a in current.args if not isinstance(strip_parens(a), (NumberLiteral, StringLiteral))),
+                           None)
+        elif isinstance(current, BinaryExpr):
+            literals = [strip_parens(side) for side in (current.lhs, current.rhs)
+                        if isinstance(strip_parens(side), NumberLiteral)]
+            if current.op == '*' and any(literal.value == 100 for literal in literals):
+                operations.append('percent')
+            else:
+                operations.append(BINARY_OP_NAMES.get(current.op, 'filtered'))
+            current = None
+        else:
+            current = None
+    return '_'.join(operations) or 'value'
+
+def rule_name(node, taken):
+    """Build a unique level:metric:operations name following the Prometheus naming convention"""
+    name = f"{aggregation_level(node)}:{metric_part(node)}:{operation_part(node)}"
+    unique, suffix = name, 2
+    while unique in taken:
+        unique, suffix = f"{name}{suffix}", suffix + 1
+    taken.add(unique)
+    return unique
+
+def yaml_scalar(text):
+    """Quote an expression only when plain YAML would misread it"""
+    if ': ' in text or ' #' in text or text[0] in '!&*{}[]|>\'"%@`-?,#':
+        return "'" + text.replace("'", "''") + "'"
+    return text
+
+def render_rules(selected, group_name):
+    """Recording-rule YAML in the format Scripts/install-rules.sh writes"""
+    taken = set()
+    lines = ["groups:", f"  - name: {group_name}", "    rules:"]
+    for candidate in selected:
+        queries = sorted(candidate.queries)
+        lines.append(f"      # Shared by {len(queries)} queries, e.g. {queries[0][0]}: {queries[0][1]}")
+        lines.append(f"      - record: {rule_name(candidate.node, taken)}")
+        lines.append(f"        expr: {yaml_scalar(candidate.expr)}")
+    return "\n".join(lines) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(description='Recommend recording rules for subexpressions shared by the lab queries')
+    parser.add_argument('--min-queries', type=int, default=2,
+                        help='Only consider subexpressions used by at least this many queries (default: 2)')
+    parser.add_argument('--top', type=int, default=10, help='Number of rules to recommend (default: 10)')
+    parser.add_argument('--group', default='recommended_rules', help='Rule group name (default: recommended_rules)')
+    parser.add_argument('--output', metavar='FILE', help='Write the rules YAML to a file instead of stdout')
+    parser.add_argument('--measure', action='store_true',
+                        help='Rank by samples measured on the Prometheus in config.json instead of estimates')
+    args = parser.parse_args()
+
+    candidates, errors = find_candidates(queries_by_lab)
+    for name, error in errors:
+        print(f"⚠️ Skipped {name}: {error}")
+
+    selected = select_candidates(candidates, args.min_queries)
+    if args.measure:
+        measure_costs(selected)
+        selected.sort(key=lambda c: (c.score, len(c.queries)), reverse=True)
+    selected = selected[:args.top]
+    if not selected:
+        print(f"No subexpression is shared by {args.min_queries} or more queries.")
+        return 0
+
+    cost_label = 'Samples' if args.measure else 'Est. cost'
+    print(f"\n===== Shared Subexpressions (top {len(selected)}) =====")
+    print(f"{'Queries':>7} {'Uses':>5} {cost_label:>10} {'Score':>10}  Expression")
+    for candidate in selected:
+        cost = f"{candidate.cost:g}" + ('' if candidate.measured or not args.measure else '*')
+        print(f"{len(candidate.queries):>7} {candidate.occurrences:>5} {cost:>10} {candidate.score:>10g}  {candidate.expr}")
+    if args.measure and not all(c.measured for c in selected):
+        print("* estimated, Prometheus returned no stats for this expression")
+    print()
+
+    rules = render_rules(selected, args.group)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(rules)
+        print(f"Recording rules written to: {args.output}")
+    else:
+        print(rules)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Summarize Prometheus query responses without loading them whole.
+
+A /api/v1/query or /api/v1/query_range response can be hundreds of MB
+for unscoped selectors on a big server. summarize_response() reads the
+body chunk by chunk and decodes one series at a time, so memory is
+bounded by the largest single series instead of the whole result. It
+returns the status, resultType, error, stats and warnings plus the
+number of series and samples, and keeps only the first K series. With
+count_by, series are also counted per value of one label (e.g. instance)
+and the first K series of each value are kept under kept_by.
+
+The top level of the document is walked key by key; inside
+data.result each series object is handed to the C JSON decoder on its
+own and dropped after counting unless it is one of the kept ones.
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 65536
+# Consumed text is dropped from the buffer once this many characters have been read
+COMPACT_AFTER = 1 << 20
+
+class ResultSummary:
+    """What a query response contained, without the bulk of the result."""
+
+    def __init__(self):
+        self.status = None
+        self.result_type = None
+        self.series = 0
+        self.samples = 0
+        self.kept = []             # The first K series, as decoded JSON
+        self.count_by = None       # Label whose values series are counted by
+        self.counts = {}           # Series per value of the count_by label ('' if missing)
+        self.kept_by = {}          # The first K series per value of the count_by label
+        self.value = None          # The [time, value] pair of scalar and string results
+        self.error_type = None
+        self.error = None
+        self.stats = None
+        self.warnings = []
+
+    def as_response(self):
+        """A response dict in the usual shape, with only the kept series in the result"""
+        if self.status != 'success':
+            return {'status': self.status, 'errorType': self.error_type, 'error': self.error}
+        data = {'resultType': self.result_type,
+                'result': self.value if self.result_type in ('scalar', 'string') else self.kept}
+        if self.stats is not None:
+            data['stats'] = self.stats
+        return {'status': self.status, 'data': data}
+
+class _Reader:
+    """A text buffer over a byte-chunk iterator with just enough JSON scanning."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+
+    def _fill(self):
+        if self.done:
+            return False
+        if self.pos > COMPACT_AFTER:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += self.decoder.decode(chunk)
+                return True
+        self.buffer += self.decoder.decode(b'', final=True)
+        self.done = True
+        return False
+
+    def peek(self):
+        """Next non-whitespace character (not consumed), or '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError(f"invalid JSON: expected {chars!r} at offset {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def _delimited(self, end):
+        return self.done or (end < len(self.buffer) and self.buffer[end] in ',]} \t\r\n')
+
+    def value(self):
+        """Decode one complete JSON value, reading more input until it parses"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Read at least as much again as is pending, so a big value is not re-parsed for every chunk
+                pending = len(self.buffer) - self.pos
+                grew = False
+                while len(self.buffer) - self.pos < pending * 2 and self._fill():
+                    grew = True
+                if not grew:
+                    raise
+                continue
+            # A bare number or literal may continue in the next chunk
+            if self.buffer[self.pos] not in '{["' and not self._delimited(end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+def _count_samples(series):
+    values = series.get('values')
+    if values is not None:
+        return len(values) + len(series.get('histograms') or [])
+    histograms = series.get('histograms')
+    if histograms is not None:
+        return len(histograms)
+    return 1 if 'value' in series or 'histogram' in series else 0
+
+def _read_result(reader, summary, keep):
+    """Count (and keep the first K of) the series in data.result"""
+    if reader.peek() != '[':
+        summary.value = reader.value()
+        return
+    reader.expect('[')
+    if reader.peek() not in '{]':
+        # A scalar or string result: [time, "value"]
+        summary.value = [reader.value()]
+        while reader.expect(',]') == ',':
+            summary.value.append(reader.value())
+        summary.samples = 1
+        return
+    while reader.peek() != ']':
+        series = reader.value()
+        summary.series += 1
+        summary.samples += _count_samples(series)
+        if summary.count_by is not None:
+            value = (series.get('metric') or {}).get(summary.count_by, '')
+            summary.counts[value] = summary.counts.get(value, 0) + 1
+            if summary.counts[value] <= keep:
+                summary.kept_by.setdefault(value, []).append(series)
+        if len(summary.kept) < keep:
+            summary.kept.append(series)
+        if reader.expect(',]') == ']':
+            return
+    reader.expect(']')
+
+def _read_object(reader, summary, keep, fields):
+    """Walk one object key by key; `fields` maps keys to handlers"""
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        handler = fields.get(key)
+        if handler is None:
+            reader.value()
+        else:
+            handler(reader, summary, keep)
+        if reader.expect(',}') == '}':
+            return
+
+def _set(attribute):
+    def handler(reader, summary, keep):
+        setattr(summary, attribute, reader.value())
+    return handler
+
+_DATA_FIELDS = {
+    'resultType': _set('result_type'),
+    'result': _read_result,
+    'stats': _set('stats'),
+}
+
+def _read_data(reader, summary, keep):
+    if reader.peek() != '{':
+        reader.value()
+        return
+    _read_object(reader, summary, keep, _DATA_FIELDS)
+
+_TOP_FIELDS = {
+    'status': _set('status'),
+    'errorType': _set('error_type'),
+    'error': _set('error'),
+    'warnings': _set('warnings'),
+    'data': _read_data,
+}
+
+def summarize_response(chunks, keep=0, count_by=None):
+    """Summarize a Prometheus API response given as an iterable of byte chunks"""
+    reader = _Reader(chunks)
+    summary = ResultSummary()
+    summary.count_by = count_by
+    _read_object(reader, summary, keep, _TOP_FIELDS)
+    if reader.peek() != '':
+        raise ValueError(f"invalid JSON: extra data at offset {reader.pos}")
+    return summary
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Run the query catalog against many Prometheus servers at once.
+
+Each lab environment has its own Prometheus; the endpoints file lists
+them, one config.json-style entry each:
+
+    [
+        {"name": "lab-01", "prometheus_url": "http://10.0.0.11:9090", "instance_name": "localhost:9100"},
+        {"name": "lab-02", "prometheus_url": "http://10.0.0.12:9090", "instance_name": "localhost:9100"}
+    ]
+
+All endpoints are tested concurrently. A query is only dispatched when its
+endpoint has fewer than --per-endpoint queries in flight and the whole run
+fewer than --global, so a slow server holds at most its own slots and
+never a worker that another server could use. Each endpoint's first task
+is its health check: one that fails it is marked unreachable while the
+others are already querying. Every request has a --timeout, and after
+--max-failures consecutive exceptions the rest of an endpoint's queries
+are skipped.
+
+The report is a query x endpoint matrix with one status code per cell,
+followed by a summary per endpoint. --output and --csv save the full
+matrix.
+
+Usage:
+    python run_fleet.py [--endpoints FILE] [--per-endpoint N] [--global N] [--timeout SECONDS]
+                        [--max-failures N] [--output FILE] [--csv FILE]
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from benchmark_queries import percentile
+from queries import all_queries
+from run_history import DEFAULT_HISTORY, RunHistory, status_of
+from test_queries import create_session, fetch_build_info, is_failure, test_prom_query
+
+DEFAULT_ENDPOINTS = 'endpoints.json'
+# One character per matrix cell
+STATUS_CODES = {
+    'PASS': '.',
+    'PASS (ALERT NO DATA)': 'a',
+    'NO DATA': 'n',
+    'TYPE MISMATCH': 'M',
+    'ERROR': 'E',
+    'EXCEPTION': 'X',
+    'UNREACHABLE': 'U',
+    'SKIPPED': 's',
+}
+
+class Endpoint:
+    """One Prometheus server of the fleet and the outcomes of its queries."""
+
+    def __init__(self, name, prometheus_url, instance_name, pool_size):
+        self.name = name
+        self.prometheus_url = prometheus_url.rstrip('/')
+        self.instance_name = instance_name
+        self.session = create_session(pool_size)
+        self.reachable = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.outcomes = {}            # Catalog index -> outcome
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+def load_endpoints(path, pool_size):
+    """Endpoints from a JSON list of {name, prometheus_url, instance_name}"""
+    with open(path) as f:
+        entries = json.load(f)
+    endpoints = []
+    for i, entry in enumerate(entries):
+        if 'prometheus_url' not in entry:
+            raise ValueError(f"entry {i + 1} in {path} has no prometheus_url")
+        endpoints.append(Endpoint(entry.get('name') or entry['prometheus_url'], entry['prometheus_url'],
+                                  entry.get('instance_name', 'localhost:9100'), pool_size))
+    return endpoints
+
+def check_health(endpoint, timeout):
+    """True if the endpoint answers /-/healthy within the timeout"""
+    try:
+        return endpoint.session.get(f"{endpoint.prometheus_url}/-/healthy", timeout=timeout).status_code == 200
+    except Exception:
+        return False
+
+def _placeholder(query_info, result):
+    return {"name": query_info['name'], "query": query_info['query'], "catalog_query": query_info['query'],
+            "result": result, "output": [],
+            "metrics": {'series': None, 'wall_ms': None}, "series": []}
+
+def run_fleet(endpoints, queries, per_endpoint=4, global_limit=32, timeout=30, max_failures=3):
+    """Run every query against every endpoint within both concurrency limits.
+
+    An endpoint's first task is its health check (index None); its queries
+    are dispatched once the check passes.
+    """
+    def run(endpoint, index):
+        if index is None:
+            return check_health(endpoint, timeout)
+        query_info = queries[index]
+        return test_prom_query(name=query_info['name'], query=query_info['query'],
+                               expected_type=query_info['expected_type'], prometheus_url=endpoint.prometheus_url,
+                               instance_name=endpoint.instance_name, session=endpoint.session, timeout=timeout)
+
+    pending = {endpoint: deque(range(len(queries))) for endpoint in endpoints}
+    total = len(endpoints) * len(queries)
+    done_count = 0
+    futures = {}
+    with ThreadPoolExecutor(max_workers=global_limit) as executor:
+        while pending or futures:
+            # Hand out free global slots round-robin to endpoints with a free slot of their own
+            dispatched = True
+            while dispatched and len(futures) < global_limit:
+                dispatched = False
+                for endpoint in list(pending):
+                    if len(futures) >= global_limit:
+                        break
+                    if endpoint.consecutive_failures >= max_failures:
+                        for index in pending.pop(endpoint):
+                            endpoint.outcomes[index] = _placeholder(queries[index], 'SKIPPED: endpoint failing')
+                            done_count += 1
+                        continue
+                    if endpoint.in_flight >= per_endpoint:
+                        continue
+                    if endpoint.reachable is None:
+                        if endpoint.in_flight:
+                            continue  # Health check still running
+                        index = None
+                    else:
+                        index = pending[endpoint].popleft()
+                        if not pending[endpoint]:
+                            del pending[endpoint]
+                    if endpoint.started is None:
+                        endpoint.started = time.perf_counter()
+                    endpoint.in_flight += 1
+                    futures[executor.submit(run, endpoint, index)] = (endpoint, index)
+                    dispatched = True
+            if not futures:
+                if pending:
+                    raise ValueError(f"cannot dispatch any query (per_endpoint={per_endpoint}, "
+                                     f"global_limit={global_limit})")
+                continue
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                endpoint, index = futures.pop(future)
+                endpoint.in_flight -= 1
+                if index is None:
+                    endpoint.reachable = future.result()
+                    if not endpoint.reachable:
+                        print(f"\r❌ {endpoint.name}: {endpoint.prometheus_url} is unreachable, skipping it" + " " * 20)
+                        endpoint.started = None
+                        for i in pending.pop(endpoint):
+                            endpoint.outcomes[i] = _placeholder(queries[i], 'UNREACHABLE')
+                            done_count += 1
+                    continue
+                outcome = future.result()
+                endpoint.outcomes[index] = outcome
+                endpoint.finished = time.perf_counter()
+                done_count += 1
+                if outcome['result'].startswith('EXCEPTION'):
+                    endpoint.consecutive_failures += 1
+                else:
+                    endpoint.consecutive_failures = 0
+            running = sum(1 for e in endpoints if e.in_flight)
+            sys.stdout.write(f"\r⏳ {done_count}/{total} queries done, {running} endpoints busy   ")
+            sys.stdout.flush()
+    print("\r" + " " * 90 + "\r", end="")
+    for endpoint in endpoints:
+        if endpoint.consecutive_failures >= max_failures:
+            print(f"⚠️ {endpoint.name}: stopped after {max_failures} consecutive failures")
+
+def status_code(result):
+    return STATUS_CODES.get(status_of(result), '?')
+
+def print_matrix(endpoints, queries):
+    print(f"{'Query':<50} " + "".join(f"{i + 1:>3}" for i in range(len(endpoints))))
+    for index, query_info in enumerate(queries):
+        cells = "".join(f"{status_code(e.outcomes[index]['result']):>3}" for e in endpoints)
+        print(f"{query_info['name'][:50]:<50} {cells}")
+    print("\nLegend: " + ", ".join(f"{code} {status}" for status, code in STATUS_CODES.items()))
+
+def print_endpoint_summary(endpoints):
+    print(f"\n{'#':>3} {'Endpoint':<24} {'Passed':>7} {'Failed':>7} {'No data':>8} {'p50 ms':>8} {'Elapsed':>9}  URL")
+    for i, endpoint in enumerate(endpoints, 1):
+        results = [o['result'] for o in endpoint.outcomes.values()]
+        latencies = [o['metrics']['wall_ms'] for o in endpoint.outcomes.values() if o['metrics']['wall_ms'] is not None]
+        passed = sum(1 for r in results if not is_failure(r) and status_of(r) in ('PASS', 'PASS (ALERT NO DATA)'))
+        failed = sum(1 for r in results if is_failure(r) or status_of(r) in ('UNREACHABLE', 'SKIPPED'))
+        no_data = sum(1 for r in results if status_of(r) == 'NO DATA')
+        p50 = f"{percentile(latencies, 50):.1f}" if latencies else '-'
+        elapsed = f"{endpoint.elapsed:.1f}s" if endpoint.elapsed is not None else '-'
+        print(f"{i:>3} {endpoint.name[:24]:<24} {passed:>7} {failed:>7} {no_data:>8} {p50:>8} {elapsed:>9}  "
+              f"{endpoint.prometheus_url}")
+
+def write_outputs(endpoints, queries, json_path=None, csv_path=None):
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({
+                "created": datetime.now().isoformat(timespec='seconds'),
+                "endpoints": [{
+                    "name": e.name,
+                    "prometheus_url": e.prometheus_url,
+                    "instance_name": e.instance_name,
+                    "reachable": e.reachable,
+                    "elapsed_s": round(e.elapsed, 3) if e.elapsed is not None else None,
+                    "results": [{"name": queries[i]['name'], "result": e.outcomes[i]['result'],
+                                 "wall_ms": e.outcomes[i]['metrics']['wall_ms'],
+                                 "series": e.outcomes[i]['metrics']['series']} for i in range(len(queries))],
+                } for e in endpoints],
+            }, f, indent=2)
+        print(f"Results saved to: {json_path}")
+    if csv_path:
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['query'] + [e.name for e in endpoints])
+            for i, query_info in enumerate(queries):
+                writer.writerow([query_info['name']] + [e.outcomes[i]['result'] for e in endpoints])
+        print(f"Matrix saved to: {csv_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the query catalog against many Prometheus servers at once')
+    parser.add_argument('--endpoints', default=DEFAULT_ENDPOINTS,
+                        help=f'JSON list of {{name, prometheus_url, instance_name}} (default: {DEFAULT_ENDPOINTS})')
+    parser.add_argument('--per-endpoint', type=int, default=4,
+                        help='Queries in flight per endpoint (default: 4)')
+    parser.add_argument('--global', dest='global_limit', type=int, default=32,
+                        help='Queries in flight across all endpoints (default: 32)')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='Seconds before a health check or query gives up (default: 30)')
+    parser.add_argument('--max-failures', type=int, default=3,
+                        help='Skip the rest of an endpoint after this many consecutive exceptions (default: 3)')
+    parser.add_argument('--output', metavar='FILE', help='Write every result as JSON')
+    parser.add_argument('--csv', metavar='FILE', help='Write the query x endpoint matrix as CSV')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, metavar='FILE',
+                        help=f'Add one run per endpoint to a SQLite run history (default: {DEFAULT_HISTORY})')
+    parser.add_argument('--no-history', action='store_true', help='Do not add the runs to the run history')
+    args = parser.parse_args()
+    for option, value in (('--per-endpoint', args.per_endpoint), ('--global', args.global_limit),
+                          ('--max-failures', args.max_failures)):
+        if value < 1:
+            parser.error(f"{option} must be at least 1")
+
+    try:
+        endpoints = load_endpoints(args.endpoints, args.per_endpoint)
+    except (OSError, ValueError) as e:
+        print(f"❌ Cannot load endpoints: {e}")
+        return 1
+    if not endpoints:
+        print(f"❌ No endpoints in {args.endpoints}")
+        return 1
+
+    print(f"\n===== Testing {len(all_queries)} queries on {len(endpoints)} endpoints "
+          f"({args.per_endpoint} per endpoint, {args.global_limit} in total) =====\n")
+    run_time = time.time()
+    started = time.perf_counter()
+    run_fleet(endpoints, all_queries, args.per_endpoint, args.global_limit, args.timeout, args.max_failures)
+    elapsed = time.perf_counter() - started
+
+    print_matrix(endpoints, all_queries)
+    print_endpoint_summary(endpoints)
+    failures = sum(1 for e in endpoints for o in e.outcomes.values()
+                   if is_failure(o['result']) or status_of(o['result']) in ('UNREACHABLE', 'SKIPPED'))
+    print(f"\nEndpoints: {len(endpoints)} ({sum(1 for e in endpoints if e.reachable)} reachable), "
+          f"failed cells: {failures}, elapsed: {elapsed:.2f}s")
+    write_outputs(endpoints, all_queries, args.output, args.csv)
+
+    if not args.no_history:
+        history = RunHistory(args.history)
+        for endpoint in endpoints:
+            if not endpoint.reachable:
+                continue
+            outcomes = [endpoint.outcomes[i] for i in range(len(all_queries))]
+            history.add_run('run_fleet.py', [
+                {'name': o['name'], 'query': o['query'], 'catalog_query': o['catalog_query'], 'result': o['result'],
+                 'latency_ms': o['metrics']['wall_ms'], 'series': o['metrics']['series']}
+                for o in outcomes
+            ], mode=f"fleet:{endpoint.name}", prometheus_url=endpoint.prometheus_url,
+                build_info=fetch_build_info(endpoint.prometheus_url, endpoint.session), run_time=run_time)
+        history.close()
+        print(f"Runs added to history: {args.history}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Run history for the PromQL test scripts, kept in a local SQLite file.
+
+test_queries.py and test_recording_rules.py add one run per invocation
+(time, script, mode, Prometheus URL and build info) and one row per
+query: name, canonical query hash (promql_parser.canonical_hash of the
+catalog text, before $INSTANCE is filled in), status, latency and series
+count. Rows are indexed on query hash and run time, so questions about
+one query across many runs are answered from the index instead of by
+grepping results.log.
+
+p95, no-data and show only look at runs against a live Prometheus
+(LIVE_MODES), so cassette, synthetic, fixture and --verify results do not
+mix into live latencies or hide when a query stopped returning data.
+
+Usage:
+    python run_history.py runs [--last N]
+    python run_history.py p95 QUERY [--last N]
+    python run_history.py no-data QUERY
+    python run_history.py show QUERY [--last N]
+
+QUERY is a query name from queries.py, a rule name, or a query hash (prefix).
+
+Examples:
+    python run_history.py p95 "CPU usage %" --last 30
+    python run_history.py no-data "Absent check for disk metrics"
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from promql_parser import PromQLSyntaxError, canonical_hash
+
+DEFAULT_HISTORY = 'history.sqlite'
+# Status categories stored for each result, in the order they are checked
+STATUSES = ('PASS (ALERT NO DATA)', 'PASS', 'NO DATA', 'TYPE MISMATCH', 'ERROR', 'EXCEPTION', 'FAIL')
+PASSING = ('PASS', 'PASS (ALERT NO DATA)')
+# Modes whose results come from a live Prometheus; --record runs query it too
+LIVE_MODES = ('live', 'record')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_time REAL NOT NULL,
+    script TEXT NOT NULL,
+    mode TEXT,
+    prometheus_url TEXT,
+    prometheus_version TEXT,
+    prometheus_revision TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    run_time REAL NOT NULL,
+    name TEXT NOT NULL,
+    query_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    latency_ms REAL,
+    series INTEGER,
+    detail TEXT,
+    query TEXT
+);
+CREATE INDEX IF NOT EXISTS results_by_hash ON results (query_hash, run_time);
+CREATE INDEX IF NOT EXISTS results_by_name ON results (name, run_time);
+CREATE INDEX IF NOT EXISTS results_by_time ON results (run_time);
+"""
+
+def query_hash(query):
+    """Canonical hash of a query, or a hash of its text if it does not parse"""
+    try:
+        return canonical_hash(query)
+    except PromQLSyntaxError:
+        return hashlib.sha1(' '.join(query.split()).encode('utf-8')).hexdigest()[:16]
+
+def status_of(result):
+    """Reduce a test result string such as 'ERROR: ...' to its status category"""
+    for status in STATUSES:
+        if result.startswith(status):
+            return status
+    return result.split(':', 1)[0]
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+def _in_modes(modes):
+    """SQL condition on results.run_id: the run's mode is one of `modes`"""
+    return f"run_id IN (SELECT id FROM runs WHERE mode IN ({_placeholders(modes)}))"
+
+class RunHistory:
+    """An append-only store of test runs and their per-query results."""
+
+    def __init__(self, path=DEFAULT_HISTORY):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_run(self, script, results, mode=None, prometheus_url=None, build_info=None, run_time=None):
+        """Store one run; results are dicts with name, query, result and optionally latency_ms/series.
+
+        The hash is taken from catalog_query when given (the query before
+        $INSTANCE is filled in), otherwise from query.
+        """
+        run_time = run_time if run_time is not None else time.time()
+        build_info = build_info or {}
+        with self.db:
+            run_id = self.db.execute(
+                "INSERT INTO runs (run_time, script, mode, prometheus_url, prometheus_version, prometheus_revision) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (run_time, script, mode, prometheus_url, build_info.get('version'), build_info.get('revision'))
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO results (run_id, run_time, name, query_hash, status, latency_ms, series, detail, query) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, run_time, r['name'], query_hash(r.get('catalog_query') or r['query']),
+                  status_of(r['result']), r.get('latency_ms'), r.get('series'), r['result'], r['query'])
+                 for r in results]
+            )
+        return run_id
+
+    def resolve(self, query, modes=LIVE_MODES):
+        """Query hashes with results in `modes` matching a name or a hash prefix, most recently run first"""
+        in_modes = _in_modes(modes)
+        rows = self.db.execute(
+            f"SELECT query_hash, MAX(run_time) AS last FROM results WHERE name = ? AND {in_modes} "
+            "GROUP BY query_hash ORDER BY last DESC", (query, *modes)).fetchall()
+        if not rows:
+            rows = self.db.execute(
+                f"SELECT query_hash, MAX(run_time) AS last FROM results WHERE query_hash GLOB ? AND {in_modes} "
+                "GROUP BY query_hash ORDER BY last DESC", (query + '*', *modes)).fetchall()
+        return [row[0] for row in rows]
+
+    def recent(self, query_hash, last, modes=LIVE_MODES):
+        """(run_time, status, latency_ms, series, name, version) of the last N results of a query from runs
+        in `modes`, newest first"""
+        return self.db.execute(
+            "SELECT r.run_time, r.status, r.latency_ms, r.series, r.name, runs.prometheus_version "
+            "FROM results r JOIN runs ON runs.id = r.run_id "
+            f"WHERE r.query_hash = ? AND runs.mode IN ({_placeholders(modes)}) "
+            "ORDER BY r.run_time DESC LIMIT ?", (query_hash, *modes, last)).fetchall()
+
+    def no_data_since(self, query_hash, modes=LIVE_MODES):
+        """(first NO DATA run time, consecutive NO DATA runs, last passing run time) for the current streak"""
+        in_modes = _in_modes(modes)
+        last_good = self.db.execute(
+            f"SELECT MAX(run_time) FROM results WHERE query_hash = ? AND {in_modes} "
+            f"AND status IN ({_placeholders(PASSING)})", (query_hash, *modes, *PASSING)).fetchone()[0]
+        first, count = self.db.execute(
+            f"SELECT MIN(run_time), COUNT(*) FROM results WHERE query_hash = ? AND {in_modes} "
+            "AND status = 'NO DATA' AND run_time > ?",
+            (query_hash, *modes, last_good if last_good is not None else -1)).fetchone()
+        return first, count, last_good
+
+    def runs(self, last):
+        return self.db.execute(
+            "SELECT runs.id, runs.run_time, runs.script, runs.mode, runs.prometheus_version, COUNT(r.name), "
+            "SUM(r.status IN ('PASS', 'PASS (ALERT NO DATA)')), SUM(r.status = 'NO DATA') "
+            "FROM runs LEFT JOIN results r ON r.run_id = runs.id "
+            "GROUP BY runs.id ORDER BY runs.run_time DESC LIMIT ?", (last,)).fetchall()
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp is not None else '-'
+
+def resolve_or_report(history, query):
+    hashes = history.resolve(query)
+    if not hashes:
+        print(f"❌ No results for '{query}' from live runs in {history.path}")
+    return hashes
+
+def command_runs(history, args):
+    print(f"{'Run':>5} {'Time':<19} {'Script':<24} {'Mode':<8} {'Version':<18} {'Queries':>8} {'Passed':>7} {'No data':>8}")
+    for run_id, run_time, script, mode, version, total, passed, no_data in history.runs(args.last):
+        print(f"{run_id:>5} {format_time(run_time):<19} {script:<24} {mode or '-':<8} {version or '-':<18} "
+              f"{total:>8} {passed or 0:>7} {no_data or 0:>8}")
+    return 0
+
+def command_p95(history, args):
+    # Imported here: benchmark_queries imports test_queries, which imports this module
+    from benchmark_queries import percentile
+    hashes = resolve_or_report(history, args.query)
+    for query_hash in hashes:
+        rows = history.recent(query_hash, args.last)
+        latencies = [row[2] for row in rows if row[2] is not None]
+        print(f"{rows[0][4]} [{query_hash}]: {len(latencies)} measured of the last {len(rows)} runs")
+        if latencies:
+            print(f"   p50 {percentile(latencies, 50):.1f} ms, p95 {percentile(latencies, 95):.1f} ms, "
+                  f"max {max(latencies):.1f} ms (since {format_time(rows[-1][0])})")
+    return 0 if hashes else 1
+
+def command_no_data(history, args):
+    hashes = resolve_or_report(history, args.query)
+    for query_hash in hashes:
+        first, count, last_good = history.no_data_since(query_hash)
+        name = history.recent(query_hash, 1)[0][4]
+        if not count:
+            print(f"✅ {name} [{query_hash}] returned data in its last run ({format_time(last_good)})")
+        elif last_good is None:
+            print(f"⚠️ {name} [{query_hash}] has returned NO DATA in all {count} recorded runs "
+                  f"(since {format_time(first)})")
+        else:
+            print(f"⚠️ {name} [{query_hash}] has returned NO DATA since {format_time(first)} "
+                  f"({count} runs); last run with data: {format_time(last_good)}")
+    return 0 if hashes else 1
+
+def command_show(history, args):
+    hashes = resolve_or_report(history, args.query)
+    for query_hash in hashes:
+        rows = history.recent(query_hash, args.last)
+        print(f"{rows[0][4]} [{query_hash}]")
+        for run_time, status, latency, series, _, version in rows:
+            latency = f"{latency:.1f} ms" if latency is not None else '-'
+            print(f"   {format_time(run_time)}  {status:<20} {latency:>10} {series if series is not None else '-':>7} "
+                  f"series  {version or '-'}")
+    return 0 if hashes else 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the history of test runs')
+    parser.add_argument('--history', default=DEFAULT_HISTORY,
+                        help=f'History database (default: {DEFAULT_HISTORY})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    runs = commands.add_parser('runs', help='List recent runs')
+    runs.add_argument('--last', type=int, default=20, help='Number of runs (default: 20)')
+    p95 = commands.add_parser('p95', help='Latency percentiles of a query over its last runs')
+    p95.add_argument('query', help='Query name, rule name or query hash')
+    p95.add_argument('--last', type=int, default=30, help='Number of runs (default: 30)')
+    no_data = commands.add_parser('no-data', help='When a query started returning NO DATA')
+    no_data.add_argument('query', help='Query name, rule name or query hash')
+    show = commands.add_parser('show', help='Results of a query over its last runs')
+    show.add_argument('query', help='Query name, rule name or query hash')
+    show.add_argument('--last', type=int, default=20, help='Number of runs (default: 20)')
+    args = parser.parse_args()
+
+    history = RunHistory(args.history)
+    try:
+        return {'runs': command_runs, 'p95': command_p95, 'no-data': command_no_data,
+                'show': command_show}[args.command](history, args)
+    finally:
+        history.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
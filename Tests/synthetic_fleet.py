@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic metrics for a fleet of node_exporter instances.
+
+The fleet covers the metric families the lab queries use:
+node_cpu_seconds_total, node_memory_*, node_filesystem_*, node_network_*,
+node_load*, up and Prometheus's own prometheus_http_request_duration_seconds
+histogram. Every value is a closed-form function of the timestamp, so the
+same fleet gives identical samples whether it is loaded into the offline
+evaluator, served by a fake exporter or written as a backfill file.
+
+Counters grow at a rate that oscillates around a per-series base rate
+and never decreases; gauges oscillate around a per-series level. Labels
+are stored as one NumPy string array per label name, so fleets with
+millions of series stay compact.
+"""
+
+import math
+import numpy as np
+
+DEFAULT_INSTANCE = 'localhost:9100'
+PROMETHEUS_INSTANCE = 'localhost:9090'
+# Counters start at a fixed boot time so values are reproducible across runs
+FLEET_EPOCH = 1700000000
+
+CPU_MODES = ('idle', 'user', 'system', 'iowait', 'irq', 'softirq', 'steal', 'nice')
+# Share of the busy (non-idle) CPU time spent in each mode
+BUSY_MODE_SHARES = {'user': 0.6, 'system': 0.25, 'iowait': 0.05, 'irq': 0.02,
+                    'softirq': 0.03, 'steal': 0.02, 'nice': 0.03}
+FILESYSTEMS = (
+    ('/dev/sda1', 'ext4', '/'),
+    ('/dev/sda2', 'ext4', '/home'),
+    ('/dev/sdb1', 'xfs', '/data'),
+    ('tmpfs', 'tmpfs', '/run'),
+)
+NETWORK_DEVICES = ('lo', 'eth0', 'eth1', 'veth3f2a1c')
+MEMORY_SIZES_GIB = (4, 8, 16, 32, 64)
+HTTP_HANDLERS = ('/api/v1/query', '/api/v1/query_range', '/api/v1/series', '/metrics', '/-/healthy')
+# Prometheus's default histogram buckets for prometheus_http_request_duration_seconds
+HTTP_BUCKETS = (0.1, 0.2, 0.4, 1, 3, 8, 20, 60, 120, math.inf)
+
+def instance_names(count, first_instance=DEFAULT_INSTANCE):
+    """Instance label values; the first one matches the instance in config.json"""
+    return [first_instance] + [f"node-{i:05d}:9100" for i in range(1, count)]
+
+def format_le(bound):
+    """Render a bucket bound the way Prometheus does (+Inf, 0.1, 1)"""
+    return '+Inf' if math.isinf(bound) else f"{bound:g}"
+
+def _wave(t, period, phase):
+    return np.sin(2 * np.pi * t / period + phase)
+
+def _wave_integral(t, period, phase, since):
+    """Integral of _wave from `since` to t"""
+    omega = 2 * np.pi / period
+    return (np.cos(omega * since + phase) - np.cos(omega * t + phase)) / omega
+
+class MetricFamily:
+    """A metric family with columnar labels and a function from timestamps to values."""
+
+    def __init__(self, name, metric_type, help_text, labels, values_at, sample_names=None):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        # Label name -> array of values, one per series
+        self.labels = labels
+        # Per-series sample name (name_bucket, name_count, ...) for histograms
+        self.sample_names = sample_names
+        self._values_at = values_at
+
+    def __len__(self):
+        return len(next(iter(self.labels.values())))
+
+    def values_at(self, timestamps):
+        """Sample values as an array of shape (series, len(timestamps))"""
+        t = np.asarray(timestamps, dtype=np.float64).reshape(1, -1)
+        return np.asarray(self._values_at(t), dtype=np.float64).reshape(len(self), -1)
+
+class Fleet:
+    """A deterministic set of node_exporter instances plus one Prometheus server."""
+
+    def __init__(self, instances=1, cpus=4, seed=42, first_instance=DEFAULT_INSTANCE, include_prometheus=True):
+        self.instances = instance_names(instances, first_instance)
+        self.cpus = cpus
+        rng = np.random.default_rng(seed)
+        count = len(self.instances)
+        # Per-instance parameters shared by several families
+        self.boot = FLEET_EPOCH - rng.uniform(86400, 30 * 86400, count)
+        self.busy = rng.uniform(0.05, 0.6, count)
+        self.phase = rng.uniform(0, 2 * np.pi, count)
+        self.memory_total = rng.choice(MEMORY_SIZES_GIB, count) * 2.0 ** 30
+        self.memory_used = rng.uniform(0.3, 0.7, count)
+
+        self.families = [
+            self._cpu_family(rng),
+            *self._memory_families(),
+            *self._filesystem_families(rng),
+            *self._network_families(rng),
+            *self._load_families(),
+            self._up_family(include_prometheus),
+        ]
+        if include_prometheus:
+            self.families.append(self._http_histogram_family(rng))
+
+    def family(self, name):
+        return next(f for f in self.families if f.name == name)
+
+    @property
+    def series_count(self):
+        return sum(len(f) for f in self.families)
+
+    def _instance_columns(self, index):
+        return {'instance': np.asarray(self.instances)[index], 'job': np.full(len(index), 'node')}
+
+    def _cpu_family(self, rng):
+        count = len(self.instances)
+        instance, cpu, mode = (a.ravel() for a in np.meshgrid(np.arange(count), np.arange(self.cpus),
+                                                              np.arange(len(CPU_MODES)), indexing='ij'))
+        # Each CPU is a little busier or quieter than its host average
+        busy = np.clip(self.busy[instance] * rng.uniform(0.8, 1.2, count * self.cpus)[instance * self.cpus + cpu],
+                       0.01, 0.95).reshape(-1, 1)
+        amplitude = 0.5 * np.minimum(busy, 1 - busy)
+        phase = (self.phase[instance] + cpu * 0.3).reshape(-1, 1)
+        boot = self.boot[instance].reshape(-1, 1)
+        share = np.array([0.0] + [BUSY_MODE_SHARES[m] for m in CPU_MODES[1:]])[mode].reshape(-1, 1)
+        idle = (mode == 0).reshape(-1, 1)
+
+        def values_at(t):
+            busy_seconds = busy * (t - boot) + amplitude * _wave_integral(t, 1800, phase, boot)
+            return np.where(idle, (t - boot) - busy_seconds, share * busy_seconds)
+
+        labels = self._instance_columns(instance)
+        labels['cpu'] = cpu.astype(str)
+        labels['mode'] = np.asarray(CPU_MODES)[mode]
+        return MetricFamily('node_cpu_seconds_total', 'counter',
+                            'Seconds the CPUs spent in each mode.', labels, values_at)
+
+    def _memory_families(self):
+        index = np.arange(len(self.instances))
+        total = self.memory_total.reshape(-1, 1)
+        used = self.memory_used.reshape(-1, 1)
+        phase = self.phase.reshape(-1, 1)
+
+        def available(t):
+            return total * np.clip(1 - used - 0.1 * _wave(t, 3600, phase), 0.02, 0.98)
+
+        families = []
+        for name, values_at in (
+            ('MemTotal_bytes', lambda t: np.broadcast_to(total, (len(total), t.shape[1]))),
+            ('MemAvailable_bytes', available),
+            ('MemFree_bytes', lambda t: available(t) * 0.4),
+            ('Cached_bytes', lambda t: available(t) * 0.45),
+            ('Buffers_bytes', lambda t: available(t) * 0.05),
+            ('Active_bytes', lambda t: (total - available(t)) * 0.7 + total * 0.01 * _wave(t, 600, phase)),
+        ):
+            families.append(MetricFamily(f'node_memory_{name}', 'gauge', f'Memory information field {name}.',
+                                         self._instance_columns(index), values_at))
+        return families
+
+    def _filesystem_families(self, rng):
+        instance, fs = (a.ravel() for a in np.meshgrid(np.arange(len(self.instances)), np.arange(len(FILESYSTEMS)),
+                                                       indexing='ij'))
+        size = (rng.choice((20, 50, 100, 500), len(instance)) * 2.0 ** 30).reshape(-1, 1)
+        size[fs == 3] = 2.0 ** 30  # tmpfs
+        free_fraction = rng.uniform(0.2, 0.8, len(instance)).reshape(-1, 1)
+        phase = self.phase[instance].reshape(-1, 1)
+
+        def free(t):
+            return size * np.clip(free_fraction - 0.05 * (1 + _wave(t, 86400, phase)), 0.01, 1)
+
+        labels = self._instance_columns(instance)
+        labels['device'] = np.asarray([f[0] for f in FILESYSTEMS])[fs]
+        labels['fstype'] = np.asarray([f[1] for f in FILESYSTEMS])[fs]
+        labels['mountpoint'] = np.asarray([f[2] for f in FILESYSTEMS])[fs]
+        return [
+            MetricFamily('node_filesystem_size_bytes', 'gauge', 'Filesystem size in bytes.', labels,
+                         lambda t: np.broadcast_to(size, (len(size), t.shape[1]))),
+            MetricFamily('node_filesystem_free_bytes', 'gauge', 'Filesystem free space in bytes.', labels, free),
+            MetricFamily('node_filesystem_avail_bytes', 'gauge',
+                         'Filesystem space available to non-root users in bytes.', labels,
+                         lambda t: free(t) * 0.95),
+        ]
+
+    def _network_families(self, rng):
+        instance, device = (a.ravel() for a in np.meshgrid(np.arange(len(self.instances)),
+                                                           np.arange(len(NETWORK_DEVICES)), indexing='ij'))
+        boot = self.boot[instance].reshape(-1, 1)
+        phase = self.phase[instance].reshape(-1, 1) + device.reshape(-1, 1)
+        labels = self._instance_columns(instance)
+        labels['device'] = np.asarray(NETWORK_DEVICES)[device]
+        families = []
+        for direction in ('receive', 'transmit'):
+            rate = (10 ** rng.uniform(3, 6.5, len(instance))).reshape(-1, 1)
+
+            def byte_counter(t, rate=rate):
+                return rate * (t - boot) + 0.5 * rate * _wave_integral(t, 900, phase, boot)
+
+            families.append(MetricFamily(f'node_network_{direction}_bytes_total', 'counter',
+                                         f'Network device statistic {direction}_bytes.', labels, byte_counter))
+            families.append(MetricFamily(f'node_network_{direction}_packets_total', 'counter',
+                                         f'Network device statistic {direction}_packets.', labels,
+                                         lambda t, counter=byte_counter: np.floor(counter(t) / 800)))
+        return families
+
+    def _load_families(self):
+        index = np.arange(len(self.instances))
+        level = (self.busy * self.cpus).reshape(-1, 1)
+        phase = self.phase.reshape(-1, 1)
+        return [
+            MetricFamily(f'node_load{minutes}', 'gauge', f'{minutes}m load average.', self._instance_columns(index),
+                         lambda t, period=period: level * (1 + 0.3 * _wave(t, period, phase)))
+            for minutes, period in ((1, 600), (5, 1800), (15, 3600))
+        ]
+
+    def _up_family(self, include_prometheus):
+        instances = list(self.instances) + ([PROMETHEUS_INSTANCE] if include_prometheus else [])
+        jobs = ['node'] * len(self.instances) + (['prometheus'] if include_prometheus else [])
+        labels = {'instance': np.asarray(instances), 'job': np.asarray(jobs)}
+        return MetricFamily('up', 'gauge', 'Whether the target was scraped successfully.', labels,
+                            lambda t: np.ones((len(instances), t.shape[1])))
+
+    def _http_histogram_family(self, rng):
+        handlers = len(HTTP_HANDLERS)
+        # Per handler: requests per second and a log-normal latency distribution
+        rate = rng.uniform(0.2, 5, handlers)
+        median = rng.uniform(0.01, 0.3, handlers)
+        sigma = rng.uniform(0.5, 1.2, handlers)
+        boot = FLEET_EPOCH - 3 * 86400
+
+        names, handler_column, le_column, bounds_fraction, handler_index = [], [], [], [], []
+        for h, handler in enumerate(HTTP_HANDLERS):
+            for bound in HTTP_BUCKETS:
+                cdf = 1.0 if math.isinf(bound) else 0.5 * (1 + math.erf(math.log(bound / median[h]) /
+                                                                          (sigma[h] * math.sqrt(2))))
+                names.append('prometheus_http_request_duration_seconds_bucket')
+                handler_column.append(handler)
+                le_column.append(format_le(bound))
+                bounds_fraction.append(cdf)
+                handler_index.append(h)
+            for suffix, factor in (('count', 1.0), ('sum', median[h] * math.exp(sigma[h] ** 2 / 2))):
+                names.append(f'prometheus_http_request_duration_seconds_{suffix}')
+                handler_column.append(handler)
+                le_column.append('')
+                bounds_fraction.append(factor)
+                handler_index.append(h)
+        fractions = np.asarray(bounds_fraction).reshape(-1, 1)
+        series_rate = rate[handler_index].reshape(-1, 1)
+        phase = np.asarray(handler_index, dtype=np.float64).reshape(-1, 1)
+        is_sum = np.asarray([n.endswith('_sum') for n in names]).reshape(-1, 1)
+
+        def values_at(t):
+            requests = np.floor(series_rate * (t - boot) + 0.5 * series_rate * _wave_integral(t, 1200, phase, boot))
+            return np.where(is_sum, requests * fractions, np.floor(requests * fractions))
+
+        labels = {
+            'instance': np.full(len(names), PROMETHEUS_INSTANCE),
+            'job': np.full(len(names), 'prometheus'),
+            'handler': np.asarray(handler_column),
+            'le': np.asarray(le_column),
+        }
+        return MetricFamily('prometheus_http_request_duration_seconds', 'histogram',
+                            'Histogram of latencies for HTTP requests.', labels, values_at,
+                            sample_names=np.asarray(names))
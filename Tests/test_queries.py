@@ -1,151 +1,642 @@
 #!/usr/bin/env python3
 # Python script to test all PromQL queries against a Prometheus server
 
+import argparse
+import atexit
+import csv
 import json
 import requests
 import sys
 import urllib.parse
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from cassette import Cassette, start_replay_server
+from check_query_types import check_catalog, check_query
+from instance_batch import BATCHED, PER_INSTANCE, SHARED, batched_query, instance_plan
+from promql_parser import parse
 from queries import all_queries
+from readiness import ReadinessProbe
+from result_stream import CHUNK_SIZE, summarize_response
+from run_history import DEFAULT_HISTORY, RunHistory
 
-# Load configuration
-try:
-    with open('config.json', 'r') as config_file:
-        config = json.load(config_file)
-    
-    prometheus_url = config['prometheus_url']
-    instance_name = config['instance_name']
-except Exception as e:
-    print(f"Error loading configuration: {e}")
-    sys.exit(1)
-
-# Initialize results log
 log_file = 'results.log'
-with open(log_file, 'w') as f:
-    f.write(f"Query Test Results - {datetime.now()}\n\n")
+metrics_jsonl_file = 'results.jsonl'
+metrics_csv_file = 'results.csv'
+
+# Server-side timings reported by Prometheus with stats=all (seconds -> ms)
+STATS_TIMINGS = {
+    'execQueueTime': 'exec_queue_ms',
+    'queryPreparationTime': 'query_preparation_ms',
+    'innerEvalTime': 'inner_eval_ms',
+    'evalTotalTime': 'eval_total_ms',
+    'resultSortTime': 'result_sort_ms',
+    'execTotalTime': 'exec_total_ms'
+}
+STATS_SAMPLES = {
+    'totalQueryableSamples': 'total_queryable_samples',
+    'peakSamples': 'peak_samples'
+}
+METRIC_FIELDS = (
+    ['name', 'result', 'series', 'samples', 'wall_ms', 'ttfb_ms', 'response_bytes'] +
+    list(STATS_TIMINGS.values()) +
+    list(STATS_SAMPLES.values()) +
+    ['query']
+)
+
+def load_config(path='config.json'):
+    """Load the Prometheus URL and instance name from config.json"""
+    try:
+        with open(path, 'r') as config_file:
+            config = json.load(config_file)
+
+        return {
+            'prometheus_url': config['prometheus_url'].rstrip('/'),
+            'instance_name': config['instance_name']
+        }
+    except Exception as e:
+        print(f"Error loading configuration: {e}")
+        sys.exit(1)
+
+def create_session(pool_size=1):
+    """Create a keep-alive HTTP session shared by all query workers"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def is_failure(result):
+    """Return True if a test_prom_query result counts as a failed test"""
+    # Consider test passed if it executed without error, even if it returns no data
+    return "ERROR" in result or "EXCEPTION" in result or "MISMATCH" in result
 
-def test_prom_query(name, query, expected_type):
-    """Test a single PromQL query against the Prometheus server"""    # Replace instance placeholder
+def server_stats(response_data):
+    """Flatten the stats=all block of a query response into metric fields"""
+    stats = response_data.get('data', {}).get('stats') or {}
+    metrics = {}
+    for key, field in STATS_TIMINGS.items():
+        value = stats.get('timings', {}).get(key)
+        metrics[field] = round(value * 1000, 3) if value is not None else None
+    for key, field in STATS_SAMPLES.items():
+        metrics[field] = stats.get('samples', {}).get(key)
+    return metrics
+
+def test_prom_query(name, query, expected_type, prometheus_url, instance_name, session=requests, eval_time=None,
+                    keep_series=0, timeout=None):
+    """Test a single PromQL query against the Prometheus server.
+
+    Console output is buffered in the returned dict so that concurrent
+    workers can be reported in catalog order. Client timings and the
+    server-side stats are returned under "metrics".
+
+    The response is streamed and summarized (result_stream.py), so memory
+    stays flat however large the result is; only the first `keep_series`
+    series are kept, under "series". `timeout` (seconds) bounds the
+    connection and each read, so a hung server fails the query instead of
+    stalling the run. "catalog_query" is the query before $INSTANCE is
+    filled in, so results for different instances share a history hash.
+    """
+    output = []
+    metrics = {'series': None, 'samples': None, 'wall_ms': None, 'ttfb_ms': None, 'response_bytes': None}
+    kept = []
+    catalog_query = query.replace('\\"', '"')
+    # Replace instance placeholder
     query = query.replace('$INSTANCE', instance_name)
     query = query.replace('\\"', '"')  # Fix escaped quotes
-    
+
     # URL encode the query
     encoded_query = urllib.parse.quote(query)
-    url = f"{prometheus_url}/api/v1/query?query={encoded_query}"
-    
-    print(f"Testing: {name}")
-    print(f"Query: {query}")
-    
+    url = f"{prometheus_url}/api/v1/query?query={encoded_query}&stats=all"
+    if eval_time is not None:
+        url += f"&time={eval_time}"
+
+    output.append(f"Testing: {name}")
+    output.append(f"Query: {query}")
+
+    # Syntax and type errors are caught locally, without a round trip to the server
+    inferred, error = check_query(query)
+    if error is not None or inferred != expected_type:
+        result = f"ERROR: {error}" if error is not None else \
+            f"TYPE MISMATCH (inferred {inferred}, expected {expected_type})"
+        output.append(f"Not sent: {result}")
+        return {"name": name, "query": query, "catalog_query": catalog_query, "result": result, "output": output,
+                "metrics": metrics, "series": []}
+
     try:
         # Make the API call
-        response = requests.get(url)
-        response_data = response.json()
-        
+        started = time.perf_counter()
+        response = session.get(url, stream=True, timeout=timeout)
+        received = 0
+
+        def chunks():
+            nonlocal received
+            for chunk in response.iter_content(CHUNK_SIZE):
+                received += len(chunk)
+                yield chunk
+
+        try:
+            summary = summarize_response(chunks(), keep=keep_series)
+        finally:
+            response.close()
+        metrics['wall_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        # requests stops the elapsed clock once the response headers are parsed
+        metrics['ttfb_ms'] = round(response.elapsed.total_seconds() * 1000, 3)
+        metrics['response_bytes'] = received
+        metrics.update(server_stats(summary.as_response()))
+        kept = summary.kept
+
         # Check if successful
-        if response_data.get('status') == 'success':
-            result_type = response_data.get('data', {}).get('resultType')
-            print(f"Success! Result type: {result_type} (Expected: {expected_type})")
-              # Check if the result type matches what we expect
-            type_matches = result_type == expected_type
-            if type_matches:
-                result = "PASS"
-            else:
-                result = f"TYPE MISMATCH (got {result_type}, expected {expected_type})"
-              # Check if we got any data
+        if summary.status == 'success':
+            result_type = summary.result_type
+            output.append(f"Success! Result type: {result_type} (Expected: {expected_type})")
+            # Check if we got any data
             data_count = 0
-            if result_type == 'vector':
-                data_count = len(response_data.get('data', {}).get('result', []))
-            elif result_type == 'matrix':
-                data_count = len(response_data.get('data', {}).get('result', []))
+            if result_type in ('vector', 'matrix'):
+                data_count = summary.series
             elif result_type == 'scalar':
                 data_count = 1
-            
-            if data_count == 0:
-                # Only alert queries might legitimately return no data
-                # These are the specific queries we know might return no data
-                is_alert_query = "alert" in name.lower() or query.find(" > ") > 0
-                
-                if is_alert_query:
-                    print("Note: Alert query executed successfully but returned no data")
-                    print("This is normal for alert conditions that aren't currently triggered")
-                    result = "PASS (ALERT NO DATA)"
-                else:
-                    print("Warning: Query returned no data - this might indicate an issue")
-                    result = "NO DATA"
-            else:
-                print(f"Data points: {data_count}")
+            metrics['series'] = data_count
+            metrics['samples'] = summary.samples
+
+            result = judge_result(name, query, result_type, expected_type, data_count, output)
+            if data_count > 0:
+                output.append(f"Data points: {data_count}" +
+                              (f" ({summary.samples} samples)" if result_type == 'matrix' else ""))
+                for series in kept:
+                    output.append(f"  {series.get('metric', {})} {series.get('value', series.get('values'))}")
+                if data_count > len(kept) > 0:
+                    output.append(f"  ... {data_count - len(kept)} more")
+            output.append(f"Latency: {metrics['wall_ms']:.1f} ms (server eval: {metrics['eval_total_ms']} ms, "
+                          f"peak samples: {metrics['peak_samples']})")
         else:
-            error = response_data.get('error', 'Unknown error')
-            print(f"Error: {error}")
+            error = summary.error or 'Unknown error'
+            output.append(f"Error: {error}")
             result = f"ERROR: {error}"
     except Exception as e:
-        print(f"Exception: {e}")
+        output.append(f"Exception: {e}")
         result = f"EXCEPTION: {str(e)}"
-    
-    # Log the result
-    with open(log_file, 'a') as f:
-        f.write(f"{name} - {result}\n")
-        f.write(f"Query: {query}\n\n")
-    
-    print("-" * 40 + "\n")
+
+    return {
+        "name": name,
+        "query": query,
+        "catalog_query": catalog_query,
+        "result": result,
+        "output": output,
+        "metrics": metrics,
+        "series": kept
+    }
+
+def judge_result(name, query, result_type, expected_type, data_count, output):
+    """Result string for a successful response, with notes appended to output"""
+    # Check if the result type matches what we expect
+    if result_type == expected_type:
+        result = "PASS"
+    else:
+        result = f"TYPE MISMATCH (got {result_type}, expected {expected_type})"
+
+    if data_count == 0:
+        # Only alert queries might legitimately return no data
+        # These are the specific queries we know might return no data
+        is_alert_query = "alert" in name.lower() or query.find(" > ") > 0
+
+        if is_alert_query:
+            output.append("Note: Alert query executed successfully but returned no data")
+            output.append("This is normal for alert conditions that aren't currently triggered")
+            result = "PASS (ALERT NO DATA)"
+        else:
+            output.append("Warning: Query returned no data - this might indicate an issue")
+            result = "NO DATA"
     return result
 
-# Test prerequisites
-print("Testing prerequisites...")
+def test_batched_query(name, query, expected_type, instances, prometheus_url, session=requests, eval_time=None,
+                       keep_series=0, timeout=None):
+    """Run an instance-scoped query once for many instances and judge each instance's part of the result.
+
+    The query is sent with instance=~"a|b|..." (instance_batch.py) and the
+    streamed result is counted per instance label, so each instance gets
+    the outcome a run of its own would have given. Returns one outcome
+    per instance, named "<query name> [<instance>]", with the first
+    `keep_series` series of that instance under "series". `timeout` is
+    passed to the request as in test_prom_query().
+    """
+    query = query.replace('\\"', '"')
+    sent = batched_query(parse(query), instances)
+    metrics = {'series': None, 'samples': None, 'wall_ms': None, 'ttfb_ms': None, 'response_bytes': None}
+    params = {'query': sent, 'stats': 'all'}
+    if eval_time is not None:
+        params['time'] = eval_time
+
+    summary = None
+    try:
+        # POST, since a regex over hundreds of instances does not fit in a URL
+        started = time.perf_counter()
+        response = session.post(f"{prometheus_url}/api/v1/query", data=params, stream=True, timeout=timeout)
+        received = 0
+
+        def chunks():
+            nonlocal received
+            for chunk in response.iter_content(CHUNK_SIZE):
+                received += len(chunk)
+                yield chunk
+
+        try:
+            summary = summarize_response(chunks(), keep=keep_series, count_by='instance')
+        finally:
+            response.close()
+        metrics['wall_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        metrics['ttfb_ms'] = round(response.elapsed.total_seconds() * 1000, 3)
+        metrics['response_bytes'] = received
+        metrics.update(server_stats(summary.as_response()))
+        failure = None if summary.status == 'success' else f"ERROR: {summary.error or 'Unknown error'}"
+    except Exception as e:
+        failure = f"EXCEPTION: {str(e)}"
+
+    outcomes = []
+    for instance in instances:
+        instance_query = query.replace('$INSTANCE', instance)
+        output = [f"Testing: {name} [{instance}]", f"Query: {instance_query}",
+                  f"Batched: one request for {len(instances)} instances"]
+        instance_metrics = dict(metrics)
+        kept = []
+        if failure is not None:
+            output.append(failure)
+            result = failure
+        else:
+            count = summary.counts.get(instance, 0) if summary.result_type in ('vector', 'matrix') else 0
+            instance_metrics['series'] = count
+            output.append(f"Success! Result type: {summary.result_type} (Expected: {expected_type})")
+            result = judge_result(name, instance_query, summary.result_type, expected_type, count, output)
+            if count > 0:
+                kept = summary.kept_by.get(instance, [])
+                output.append(f"Data points: {count}")
+                for series in kept:
+                    output.append(f"  {series.get('metric', {})} {series.get('value', series.get('values'))}")
+                if count > len(kept) > 0:
+                    output.append(f"  ... {count - len(kept)} more")
+            output.append(f"Latency: {metrics['wall_ms']:.1f} ms for the batch")
+        outcomes.append({"name": f"{name} [{instance}]", "query": instance_query, "catalog_query": query,
+                         "result": result, "output": output, "metrics": instance_metrics, "series": kept})
+    return outcomes
+
+def run_multi_instance(queries, instances, prometheus_url, session, concurrency=1, delay=0.1, eval_time=None,
+                       stats=None, keep_series=0, timeout=None):
+    """Run queries for several instances and yield one outcome per query and instance, in catalog order.
+
+    Queries that instance_batch.instance_plan() can batch are sent once
+    with an instance regex; queries that do not use $INSTANCE are sent
+    once and their outcome is reported for every instance; the rest run
+    once per instance. `stats` counts the requests sent per plan;
+    `keep_series` and `timeout` are passed on to every request.
+    """
+    stats = stats if stats is not None else {}
+
+    def single(query_info, instance):
+        return test_prom_query(name=f"{query_info['name']} [{instance}]", query=query_info['query'],
+                               expected_type=query_info['expected_type'], prometheus_url=prometheus_url,
+                               instance_name=instance, session=session, eval_time=eval_time,
+                               keep_series=keep_series, timeout=timeout)
+
+    def shared(query_info):
+        outcome = single(query_info, instances[0])
+        return [dict(outcome, name=f"{query_info['name']} [{instance}]") for instance in instances]
 
-# Check if we can reach the Prometheus server
-try:
-    test_url = f"{prometheus_url}/-/healthy"
-    health_check = requests.get(test_url)
-    if health_check.status_code == 200:
-        print("✅ Prometheus server is reachable.")
+    # One task per request; each returns the outcomes it covers
+    tasks = []
+    for query_info in queries:
+        plan, _, _ = instance_plan(query_info['query'])
+        if plan == BATCHED and check_query(query_info['query'])[1] is None:
+            tasks.append(lambda q=query_info: test_batched_query(q['name'], q['query'], q['expected_type'], instances,
+                                                                 prometheus_url, session, eval_time,
+                                                                 keep_series, timeout))
+        elif plan == SHARED:
+            tasks.append(lambda q=query_info: shared(q))
+        else:
+            plan = PER_INSTANCE
+            tasks += [lambda q=query_info, i=instance: [single(q, i)] for instance in instances]
+        stats[plan] = stats.get(plan, 0) + (len(instances) if plan == PER_INSTANCE else 1)
+
+    if concurrency <= 1:
+        for task in tasks:
+            yield from task()
+            time.sleep(delay)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for outcomes in executor.map(lambda task: task(), tasks):
+            yield from outcomes
+
+def run_queries(queries, prometheus_url, instance_name, session, concurrency=1, delay=0.1, eval_time=None,
+                keep_series=0, timeout=None):
+    """Run queries and yield their outcomes in catalog order.
+
+    With concurrency 1 queries run one after another with a small delay to
+    avoid overwhelming the server. Otherwise up to `concurrency` queries are
+    in flight at once over the shared session, so the wall time tracks the
+    slowest query rather than the sum of all of them.
+    """
+    def run(query_info):
+        return test_prom_query(
+            name=query_info['name'],
+            query=query_info['query'],
+            expected_type=query_info['expected_type'],
+            prometheus_url=prometheus_url,
+            instance_name=instance_name,
+            session=session,
+            eval_time=eval_time,
+            keep_series=keep_series,
+            timeout=timeout
+        )
+
+    if concurrency <= 1:
+        for query_info in queries:
+            yield run(query_info)
+            # Small delay to avoid overwhelming the server
+            time.sleep(delay)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # executor.map yields in submission order, which keeps results.log stable
+        yield from executor.map(run, queries)
+
+def write_metrics(outcomes, jsonl_path=metrics_jsonl_file, csv_path=metrics_csv_file):
+    """Write per-query timings and server stats as JSONL and CSV"""
+    rows = []
+    for outcome in outcomes:
+        row = dict.fromkeys(METRIC_FIELDS)
+        row.update(outcome['metrics'])
+        row.update(name=outcome['name'], query=outcome['query'], result=outcome['result'])
+        rows.append(row)
+
+    with open(jsonl_path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=METRIC_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_most_expensive(outcomes, count=5):
+    """Print the queries with the highest latency and the most samples touched"""
+    measured = [o for o in outcomes if o['metrics']['wall_ms'] is not None]
+    print("\n===== Slowest Queries (client wall time) =====")
+    for o in sorted(measured, key=lambda o: o['metrics']['wall_ms'], reverse=True)[:count]:
+        print(f"{o['metrics']['wall_ms']:>10.1f} ms  {o['name']}")
+    sampled = [o for o in measured if o['metrics']['peak_samples'] is not None]
+    if sampled:
+        print("\n===== Most Samples Touched (peak) =====")
+        for o in sorted(sampled, key=lambda o: o['metrics']['peak_samples'], reverse=True)[:count]:
+            print(f"{o['metrics']['peak_samples']:>10}     {o['name']}")
+
+def check_prerequisites(prometheus_url, session):
+    """Exit early if the Prometheus server cannot be reached"""
+    print("Testing prerequisites...")
+
+    # Check if we can reach the Prometheus server
+    try:
+        test_url = f"{prometheus_url}/-/healthy"
+        health_check = session.get(test_url)
+        if health_check.status_code == 200:
+            print("✅ Prometheus server is reachable.")
+        else:
+            print(f"⚠️ Prometheus server returned status code {health_check.status_code}")
+    except Exception as e:
+        print(f"❌ Cannot reach Prometheus server at {prometheus_url}")
+        print(f"Error: {e}")
+        print("Please check your configuration in config.json")
+        sys.exit(1)
+
+def fetch_build_info(prometheus_url, session):
+    """Return Prometheus's /api/v1/status/buildinfo data ({} if it is not available)"""
+    try:
+        response = session.get(f"{prometheus_url}/api/v1/status/buildinfo", timeout=10)
+        return response.json().get('data', {}) or {}
+    except Exception:
+        return {}
+
+def load_instances(value):
+    """Instance names from a comma-separated list or @FILE (one per line, # comments allowed)"""
+    if value.startswith('@'):
+        with open(value[1:]) as f:
+            names = [line.split('#', 1)[0].strip() for line in f]
     else:
-        print(f"⚠️ Prometheus server returned status code {health_check.status_code}")
-except Exception as e:
-    print(f"❌ Cannot reach Prometheus server at {prometheus_url}")
-    print(f"Error: {e}")
-    print("Please check your configuration in config.json")
-    sys.exit(1)
-
-# Run tests for all queries
-print("\n===== Testing All PromQL Queries =====\n")
-
-results = {
-    "passed": 0,
-    "failed": 0,
-    "total": len(all_queries)
-}
+        names = [name.strip() for name in value.split(',')]
+    return list(dict.fromkeys(name for name in names if name))
+
+def announce_ready(batches, timeout):
+    """Pass through ReadinessProbe batches, printing when each became ready"""
+    for waited, batch in batches:
+        if waited is None:
+            print(f"⚠️ {len(batch)} queries still lack data after {timeout:g}s; running them anyway\n")
+        else:
+            print(f"✅ {len(batch)} queries ready after {waited:.1f}s\n")
+        yield waited, batch
+
+def main():
+    parser = argparse.ArgumentParser(description='Test all lab PromQL queries against a Prometheus server')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of queries to run in parallel (default: 1)')
+    parser.add_argument('--delay', type=float, default=0.1,
+                        help='Pause between queries in sequential mode, in seconds (default: 0.1)')
+    parser.add_argument('--show-series', type=int, default=0, metavar='K',
+                        help='Print the first K series of every result (default: 0)')
+    parser.add_argument('--timeout', type=float, default=None, metavar='SECONDS',
+                        help='Fail a query whose server does not answer within this many seconds (default: no limit)')
+    parser.add_argument('--instances', metavar='LIST',
+                        help='Test these instances instead of instance_name: comma-separated, or @FILE with one per '
+                             'line. $INSTANCE queries are sent once with an instance regex where that is safe')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, metavar='FILE',
+                        help=f'Add this run to a SQLite run history (default: {DEFAULT_HISTORY})')
+    parser.add_argument('--no-history', action='store_true', help='Do not add this run to the run history')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='CASSETTE',
+                      help='Save every query response to a cassette file')
+    mode.add_argument('--replay', metavar='CASSETTE',
+                      help='Serve responses from a cassette instead of a live Prometheus')
+    mode.add_argument('--offline', action='store_true',
+                      help='Evaluate the queries in-process against synthetic node_exporter data')
+    mode.add_argument('--fixture', metavar='DIR',
+                      help='Run against a local Prometheus on pre-built TSDB blocks in DIR (built if needed; '
+                           'needs promtool and prometheus)')
+    parser.add_argument('--fleet-size', type=int, default=1,
+                        help='Synthetic instances to generate with --offline or --fixture (default: 1)')
+    parser.add_argument('--cpus', type=int, default=4,
+                        help='CPUs per synthetic instance with --offline or --fixture (default: 4)')
+    parser.add_argument('--wait-ready', action='store_true',
+                        help='Wait until Prometheus has the data each query needs and run queries as they become '
+                             'ready (live and --record runs)')
+    parser.add_argument('--ready-timeout', type=float, default=600,
+                        help='Seconds to wait for data with --wait-ready before running the rest anyway '
+                             '(default: 600)')
+    parser.add_argument('--full-history', action='store_true',
+                        help='With --wait-ready, wait until every range, subquery and offset window is fully covered')
+    args = parser.parse_args()
 
-for query_info in all_queries:
-    result = test_prom_query(
-        name=query_info['name'],
-        query=query_info['query'],
-        expected_type=query_info['expected_type']
-    )
-      # Consider test passed if it executed without error, even if it returns no data
-    if "ERROR" not in result and "EXCEPTION" not in result and "MISMATCH" not in result:
-        results["passed"] += 1
+    config = load_config()
+    prometheus_url = config['prometheus_url']
+    instance_name = config['instance_name']
+    instances = load_instances(args.instances) if args.instances else None
+    if instances:
+        instance_name = instances[0]
+    session = create_session(args.concurrency)
+
+    cassette = None
+    eval_time = None
+    if args.record:
+        cassette = Cassette(meta={'prometheus_url': prometheus_url, 'instance_name': instance_name})
+        cassette.attach(session)
+        eval_time = cassette.eval_time
+        print(f"Recording responses to {args.record} (evaluation time {eval_time})")
+    elif args.replay:
+        cassette = Cassette.load(args.replay)
+        _, prometheus_url = start_replay_server(cassette)
+        instance_name = cassette.meta.get('instance_name', instance_name)
+        eval_time = cassette.eval_time
+        args.delay = 0  # Nothing to overwhelm when replaying locally
+        print(f"Replaying {len(cassette.entries)} recorded responses from {args.replay}")
+    elif args.offline:
+        # Imported here so numpy is only needed for offline runs
+        from promql_eval import Engine, build_lab_tsdb, catalog_history, start_eval_server
+        history = catalog_history(all_queries) + 3600
+        tsdb, eval_time = build_lab_tsdb(instances=args.fleet_size, cpus=args.cpus,
+                                         first_instance=instance_name, history=history)
+        _, prometheus_url = start_eval_server(Engine(tsdb))
+        args.delay = 0
+        print(f"Evaluating offline against {tsdb.series_count} synthetic series "
+              f"({history / 3600:.1f}h of history, evaluation time {eval_time:.0f})")
+    elif args.fixture:
+        from tsdb_fixture import FixtureError, FixturePrometheus, ensure_fixture, fixture_hours, fixture_params
+        params = fixture_params(instances=args.fleet_size, cpus=args.cpus, first_instance=instance_name,
+                                hours=fixture_hours(all_queries))
+        try:
+            manifest = ensure_fixture(args.fixture, params)
+            fixture_server = FixturePrometheus(args.fixture).start()
+        except FixtureError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        atexit.register(fixture_server.stop)
+        prometheus_url = fixture_server.url
+        eval_time = manifest['eval_time']
+        args.delay = 0
+        print(f"Running against fixture blocks in {args.fixture} at {prometheus_url} "
+              f"({manifest['series']} series, evaluation time {eval_time})")
+
+    # Initialize results log
+    with open(log_file, 'w') as f:
+        f.write(f"Query Test Results - {datetime.now()}\n\n")
+
+    checked_at = time.perf_counter()
+    invalid = [(query_info, error) for query_info, _, error in check_catalog(all_queries) if error]
+    checked_ms = (time.perf_counter() - checked_at) * 1000
+    if invalid:
+        print(f"❌ {len(invalid)} catalog queries are invalid and will be reported without querying "
+              f"(checked in {checked_ms:.0f} ms):")
+        for query_info, error in invalid:
+            print(f"   {query_info['name']}: {error}")
     else:
-        results["failed"] += 1
-    
-    # Small delay to avoid overwhelming the server
-    time.sleep(0.1)
-
-# Summary
-print("===== Test Summary =====")
-print(f"Total queries: {results['total']}")
-print(f"Passed: {results['passed']}")
-print(f"Failed: {results['failed']}")
-success_rate = round((results['passed'] / results['total']) * 100, 2)
-print(f"Success rate: {success_rate}%")
-
-# Log summary
-with open(log_file, 'a') as f:
-    f.write("===== Test Summary =====\n")
-    f.write(f"Total queries: {results['total']}\n")
-    f.write(f"Passed: {results['passed']}\n")
-    f.write(f"Failed: {results['failed']}\n")
-    f.write(f"Success rate: {success_rate}%\n")
-
-print(f"\nResults saved to: {log_file}")
+        print(f"✅ Catalog syntax and types checked in {checked_ms:.0f} ms")
+
+    check_prerequisites(prometheus_url, session)
+
+    # Queries run in batches: all at once, or in the order their data becomes ready
+    batches = [all_queries]
+    restamp = False
+    if args.wait_ready and (args.replay or args.offline or args.fixture):
+        print("ℹ️  --wait-ready has no effect with --replay, --offline or --fixture")
+    elif args.wait_ready:
+        # A session of its own, so the probes are not recorded in the cassette
+        probe = ReadinessProbe(prometheus_url, create_session(8), instance_name, args.full_history,
+                               instances=instances)
+        batches = probe.ready_batches(all_queries, timeout=args.ready_timeout)
+        batches = (batch for _, batch in announce_ready(batches, args.ready_timeout))
+        # Each batch is recorded at the time its data became ready; the cassette remembers the times
+        restamp = bool(args.record)
+
+    # Run tests for all queries
+    print("\n===== Testing All PromQL Queries =====\n")
+    if args.concurrency > 1:
+        print(f"Running with concurrency {args.concurrency}\n")
+
+    results = {
+        "passed": 0,
+        "failed": 0,
+        "total": len(all_queries) * (len(instances) if instances else 1)
+    }
+
+    outcomes = []
+    request_stats = {}
+    started = time.time()
+    with open(log_file, 'a') as log:
+        for batch in batches:
+            if restamp:
+                eval_time = round(time.time(), 3)
+            if instances:
+                batch_outcomes = run_multi_instance(batch, instances, prometheus_url, session,
+                                                    concurrency=args.concurrency, delay=args.delay,
+                                                    eval_time=eval_time, stats=request_stats,
+                                                    keep_series=args.show_series, timeout=args.timeout)
+            else:
+                batch_outcomes = run_queries(batch, prometheus_url, instance_name, session,
+                                             concurrency=args.concurrency, delay=args.delay, eval_time=eval_time,
+                                             keep_series=args.show_series, timeout=args.timeout)
+            for outcome in batch_outcomes:
+                outcomes.append(outcome)
+                print("\n".join(outcome['output']))
+                print("-" * 40 + "\n")
+
+                # Log the result
+                log.write(f"{outcome['name']} - {outcome['result']}\n")
+                log.write(f"Query: {outcome['query']}\n\n")
+
+                if is_failure(outcome['result']):
+                    results["failed"] += 1
+                else:
+                    results["passed"] += 1
+    elapsed = time.time() - started
+
+    print_most_expensive(outcomes)
+    write_metrics(outcomes)
+    print()
+
+    # Summary
+    print("===== Test Summary =====")
+    print(f"Total queries: {results['total']}")
+    print(f"Passed: {results['passed']}")
+    print(f"Failed: {results['failed']}")
+    success_rate = round((results['passed'] / results['total']) * 100, 2)
+    print(f"Success rate: {success_rate}%")
+    print(f"Elapsed: {elapsed:.2f}s")
+    if instances:
+        print(f"Instances: {len(instances)}, requests: {sum(request_stats.values())} "
+              f"(batched: {request_stats.get(BATCHED, 0)}, shared: {request_stats.get(SHARED, 0)}, "
+              f"per instance: {request_stats.get(PER_INSTANCE, 0)})")
+
+    # Log summary
+    with open(log_file, 'a') as f:
+        f.write("===== Test Summary =====\n")
+        f.write(f"Total queries: {results['total']}\n")
+        f.write(f"Passed: {results['passed']}\n")
+        f.write(f"Failed: {results['failed']}\n")
+        f.write(f"Success rate: {success_rate}%\n")
+
+    print(f"\nResults saved to: {log_file}")
+    print(f"Per-query metrics saved to: {metrics_jsonl_file}, {metrics_csv_file}")
+
+    if not args.no_history:
+        history = RunHistory(args.history)
+        mode = ('record' if args.record else 'replay' if args.replay else 'offline' if args.offline
+                else 'fixture' if args.fixture else 'live')
+        history.add_run('test_queries.py', [
+            {'name': o['name'], 'query': o['query'], 'catalog_query': o['catalog_query'], 'result': o['result'],
+             'latency_ms': o['metrics']['wall_ms'], 'series': o['metrics']['series']} for o in outcomes
+        ], mode=mode, prometheus_url=prometheus_url, build_info=fetch_build_info(prometheus_url, session),
+            run_time=started)
+        history.close()
+        print(f"Run added to history: {args.history}")
+
+    if args.record:
+        cassette.save(args.record)
+        print(f"Cassette saved to: {args.record}")
+
+if __name__ == "__main__":
+    main()
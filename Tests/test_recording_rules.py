@@ -2,12 +2,27 @@
 """
 A script to verify that Prometheus recording rules are working.
 Tests the recording rules used in the labs against a Prometheus instance.
+
+With --verify the rule and its alternative expression are both pulled over
+a query_range window and compared sample by sample, so a rule that exists
+but records the wrong thing is caught too.
 """
 
+import argparse
 import json
 import sys
+import time
 import requests
 from datetime import datetime
+from cassette import Cassette, start_replay_server
+from promql_parser import PromQLSyntaxError, parse_duration
+from run_history import DEFAULT_HISTORY, RunHistory
+from test_queries import fetch_build_info
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for --verify
+    np = None
 
 # Load config
 with open('config.json', 'r') as f:
@@ -16,6 +31,10 @@ with open('config.json', 'r') as f:
 PROMETHEUS_URL = config['prometheus_url']
 INSTANCE_NAME = config['instance_name']
 
+# Shared keep-alive session; main() pins EVAL_TIME when recording or replaying
+SESSION = requests.Session()
+EVAL_TIME = None
+
 # Recording rules to test
 RECORDING_RULES = [
     {
@@ -34,11 +53,11 @@ def query_prometheus(query):
     """Query Prometheus and return the result."""
     params = {
         'query': query,
-        'time': datetime.now().timestamp()
+        'time': EVAL_TIME if EVAL_TIME is not None else datetime.now().timestamp()
     }
     
     url = f"{PROMETHEUS_URL.rstrip('/')}/api/v1/query"
-    response = requests.get(url, params=params, timeout=10)
+    response = SESSION.get(url, params=params, timeout=10)
     
     if response.status_code != 200:
         print(f"Error querying Prometheus: {response.status_code} {response.text}")
@@ -46,6 +65,131 @@ def query_prometheus(query):
     
     return response.json()
 
+def query_range(query, start, end, step):
+    """Run a range query and return the result matrix, or None on failure."""
+    params = {'query': query, 'start': start, 'end': end, 'step': step}
+    url = f"{PROMETHEUS_URL.rstrip('/')}/api/v1/query_range"
+    response = SESSION.get(url, params=params, timeout=30)
+
+    if response.status_code != 200:
+        print(f"Error querying Prometheus: {response.status_code} {response.text}")
+        return None
+
+    data = response.json()
+    if data.get('status') != 'success':
+        return None
+    return data['data']['result']
+
+def series_key(metric):
+    """Label set of a series without its metric name, so rules and expressions line up"""
+    return tuple(sorted((k, v) for k, v in metric.items() if k != '__name__'))
+
+def flatten_matrix(result, series_ids, start, step):
+    """Turn a range result into flat (series id, step slot, value) arrays.
+
+    The only Python loop is over series; each series' samples are converted
+    in one NumPy call. Labels sets get ids from the shared series_ids dict.
+    """
+    ids, slots, values = [], [], []
+    for series in result:
+        samples = np.asarray(series['values'], dtype=object)
+        if samples.size == 0:
+            continue
+        series_id = series_ids.setdefault(series_key(series['metric']), len(series_ids))
+        timestamps = samples[:, 0].astype(np.float64)
+        slots.append(np.rint((timestamps - start) / step).astype(np.int64))
+        values.append(samples[:, 1].astype(np.float64))  # "NaN"/"+Inf" parse as floats
+        ids.append(np.full(len(timestamps), series_id, dtype=np.int64))
+    if not ids:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+    return np.concatenate(ids), np.concatenate(slots), np.concatenate(values)
+
+def compare_matrices(rule_result, alt_result, start, end, step, atol, rtol):
+    """Align both results by label set and timestamp and compare them.
+
+    Returns one report per label set of the alternative expression plus
+    the label sets that only the recording rule returned.
+    """
+    series_ids = {}
+    alt_ids, alt_slots, alt_values = flatten_matrix(alt_result, series_ids, start, step)
+    expected_series = len(series_ids)
+    rule_ids, rule_slots, rule_values = flatten_matrix(rule_result, series_ids, start, step)
+
+    # One integer key per (series, timestamp) makes alignment a sorted intersection
+    slots_per_series = int(round((end - start) / step)) + 1
+    _, alt_idx, rule_idx = np.intersect1d(alt_ids * slots_per_series + alt_slots,
+                                          rule_ids * slots_per_series + rule_slots,
+                                          assume_unique=True, return_indices=True)
+    ids = alt_ids[alt_idx]
+    expected = alt_values[alt_idx]
+    actual = rule_values[rule_idx]
+
+    error = np.abs(actual - expected)
+    both_nan = np.isnan(actual) & np.isnan(expected)
+    error[both_nan] = 0.0
+    error[np.isnan(error)] = np.inf  # NaN on one side only
+    mismatched = error > atol + rtol * np.abs(expected)
+
+    count = len(series_ids)
+    matched = np.bincount(ids, minlength=count)
+    mean_error = np.bincount(ids, weights=np.where(np.isfinite(error), error, 0.0), minlength=count)
+    mean_error = np.divide(mean_error, matched, out=np.zeros(count), where=matched > 0)
+    max_error = np.zeros(count)
+    np.maximum.at(max_error, ids, error)
+    failures = np.bincount(ids, weights=mismatched, minlength=count).astype(np.int64)
+    total = np.bincount(alt_ids, minlength=count)
+
+    labels = {series_id: key for key, series_id in series_ids.items()}
+    reports = [
+        {
+            'labels': dict(labels[i]),
+            'samples': int(total[i]),
+            'matched': int(matched[i]),
+            'mismatched': int(failures[i]),
+            'max_error': float(max_error[i]),
+            'mean_error': float(mean_error[i])
+        }
+        for i in range(expected_series)
+    ]
+    rule_only = [dict(labels[i]) for i in range(expected_series, count)]
+    return reports, rule_only
+
+def verify_recording_rule(rule, range_seconds, step, atol, rtol):
+    """Check that a recording rule and its alternative agree over a time range."""
+    print(f"\nVerifying rule: {rule['name']}")
+    end = EVAL_TIME if EVAL_TIME is not None else datetime.now().timestamp()
+    end = float(int(end // step) * step)  # Align to the step so both results share timestamps
+    start = end - range_seconds
+
+    alt_result = query_range(rule['alternative'], start, end, step)
+    rule_result = query_range(rule['query'], start, end, step)
+    if not alt_result:
+        print(f"❌ Alternative query returned no data: {rule['alternative']}")
+        return False
+    if not rule_result:
+        print(f"❌ Recording rule returned no data: {rule['query']}")
+        return False
+
+    reports, rule_only = compare_matrices(rule_result, alt_result, start, end, step, atol, rtol)
+
+    success = True
+    print(f"   {'Samples':>8} {'Matched':>8} {'Mismatch':>9} {'Max error':>12} {'Mean error':>12}  Series")
+    for report in reports:
+        labels = ', '.join(f'{k}="{v}"' for k, v in report['labels'].items()) or '{}'
+        print(f"   {report['samples']:>8} {report['matched']:>8} {report['mismatched']:>9} "
+              f"{report['max_error']:>12.4g} {report['mean_error']:>12.4g}  {{{labels}}}")
+        if report['matched'] == 0 or report['mismatched']:
+            success = False
+    if rule_only:
+        print(f"   ℹ️ {len(rule_only)} series only returned by the recording rule (not compared)")
+
+    if success:
+        print(f"✅ Rule matches its expression within atol={atol}, rtol={rtol}")
+    else:
+        print(f"❌ Rule and expression disagree (or never overlap) within atol={atol}, rtol={rtol}")
+    return success
+
 def test_recording_rule(rule):
     """Test a recording rule and its alternative query."""
     print(f"\nTesting rule: {rule['name']}")
@@ -72,13 +216,80 @@ def test_recording_rule(rule):
 
 def main():
     """Test all recording rules."""
+    global PROMETHEUS_URL, EVAL_TIME
+
+    parser = argparse.ArgumentParser(description='Verify the recording rules used in the labs')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='CASSETTE',
+                      help='Save every query response to a cassette file')
+    mode.add_argument('--replay', metavar='CASSETTE',
+                      help='Serve responses from a cassette instead of a live Prometheus')
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare each rule with its alternative expression over a time range '
+                             '(needs NumPy and a live Prometheus)')
+    parser.add_argument('--range', default='1h',
+                        help='Time range to compare in --verify mode, e.g. 30m or 6h (default: 1h)')
+    parser.add_argument('--step', type=float, default=60,
+                        help='Resolution of the comparison in seconds (default: 60)')
+    parser.add_argument('--atol', type=float, default=0.5,
+                        help='Absolute tolerance in --verify mode (default: 0.5)')
+    parser.add_argument('--rtol', type=float, default=0.01,
+                        help='Relative tolerance in --verify mode (default: 0.01)')
+    parser.add_argument('--history', default=DEFAULT_HISTORY, metavar='FILE',
+                        help=f'Add this run to a SQLite run history (default: {DEFAULT_HISTORY})')
+    parser.add_argument('--no-history', action='store_true', help='Do not add this run to the run history')
+    args = parser.parse_args()
+
+    if args.verify:
+        if np is None:
+            print("❌ --verify needs NumPy: pip install numpy")
+            return 1
+        try:
+            range_seconds = parse_duration(args.range) / 1000
+        except PromQLSyntaxError as e:
+            print(f"❌ {e}")
+            return 1
+        if args.replay:
+            print("❌ --verify uses range queries, which cassettes do not record")
+            return 1
+
+    cassette = None
+    if args.record:
+        cassette = Cassette(meta={'prometheus_url': PROMETHEUS_URL, 'instance_name': INSTANCE_NAME})
+        cassette.attach(SESSION)
+        EVAL_TIME = cassette.eval_time
+    elif args.replay:
+        cassette = Cassette.load(args.replay)
+        _, PROMETHEUS_URL = start_replay_server(cassette)
+        EVAL_TIME = cassette.eval_time
+
     print(f"Testing recording rules against: {PROMETHEUS_URL}")
     print(f"Using instance: {INSTANCE_NAME}")
     
     success = True
+    run_started = time.time()
+    outcomes = []
     for rule in RECORDING_RULES:
-        if not test_recording_rule(rule):
+        started = time.perf_counter()
+        if args.verify:
+            passed = verify_recording_rule(rule, range_seconds, args.step, args.atol, args.rtol)
+        else:
+            passed = test_recording_rule(rule)
+        outcomes.append({'name': rule['name'], 'query': rule['query'], 'result': 'PASS' if passed else 'FAIL',
+                         'latency_ms': round((time.perf_counter() - started) * 1000, 3)})
+        if not passed:
             success = False
+
+    if not args.no_history:
+        history = RunHistory(args.history)
+        mode = 'record' if args.record else 'replay' if args.replay else 'verify' if args.verify else 'live'
+        history.add_run('test_recording_rules.py', outcomes, mode=mode, prometheus_url=PROMETHEUS_URL,
+                        build_info=fetch_build_info(PROMETHEUS_URL, SESSION), run_time=run_started)
+        history.close()
+
+    if args.record:
+        cassette.save(args.record)
+        print(f"\nCassette saved to: {args.record}")
     
     if success:
         print("\n✅ All recording rules are working!")
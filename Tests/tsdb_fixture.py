@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Pre-built TSDB blocks so the catalog runs against a real Prometheus at once.
+
+Queries such as max_over_time(...[30m:1m]) or rate(...[5m] offset 5m) need
+real time to pass before a freshly started Prometheus can answer them.
+This script writes several hours of deterministic node_exporter-style data
+for every metric family the catalog uses (synthetic_fleet.py), plus the
+lab recording rule series computed by the in-process evaluator, as an
+OpenMetrics backfill file. `promtool tsdb create-blocks-from openmetrics`
+turns it into TSDB blocks, and a local Prometheus is started on them with
+no scrape jobs.
+
+The fixture window always ends at FIXTURE_END, so every build has the same
+samples; queries are pinned to that time with the `time` parameter and
+give the same values on every run.
+
+Usage:
+    python tsdb_fixture.py build [--dir DIR] [--instances N] [--cpus N] [--hours H] [--interval SECONDS]
+    python tsdb_fixture.py serve [--dir DIR]
+    python test_queries.py --fixture DIR
+
+Requires NumPy and the promtool and prometheus binaries (on PATH or given
+with --promtool / --prometheus).
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import requests
+from fake_exporter import write_backfill
+from promql_eval import TSDB, catalog_history, evaluate_recording_rules
+from synthetic_fleet import DEFAULT_INSTANCE, Fleet, MetricFamily
+
+DEFAULT_FIXTURE_DIR = 'fixture'
+FIXTURE_END = 1700092800           # 2023-11-16 00:00:00 UTC
+DEFAULT_HOURS = 6
+DEFAULT_INTERVAL = 15
+MANIFEST = 'fixture.json'
+STARTUP_TIMEOUT = 60               # Seconds to wait for Prometheus to load the blocks
+
+class FixtureError(RuntimeError):
+    """Raised when the fixture cannot be built or served."""
+
+def fixture_hours(queries=None):
+    """Hours of data to write: DEFAULT_HOURS, or more if the catalog looks further back"""
+    if queries is None:
+        return DEFAULT_HOURS
+    return max(DEFAULT_HOURS, math.ceil(catalog_history(queries) / 3600) + 1)
+
+def fixture_params(instances=1, cpus=4, seed=42, first_instance=DEFAULT_INSTANCE, hours=DEFAULT_HOURS,
+                   interval=DEFAULT_INTERVAL, end=FIXTURE_END):
+    """Everything the fixture's samples depend on; a fixture is rebuilt when these change"""
+    return {'instances': instances, 'cpus': cpus, 'seed': seed, 'first_instance': first_instance,
+            'hours': hours, 'interval': interval, 'end': end}
+
+def recorded_families(fleet, start, end, interval):
+    """The lab recording rule series as gauge families on the backfill's timestamp grid"""
+    tsdb = TSDB.from_fleet(fleet, start, end, interval)
+    families = []
+    for labels, values in evaluate_recording_rules(tsdb):
+        if not labels:
+            continue
+        keys = sorted({key for series in labels for key in series if key != '__name__'})
+        columns = {key: [series.get(key, '') for series in labels] for key in keys}
+        families.append(MetricFamily(labels[0]['__name__'], 'gauge', 'Lab recording rule, precomputed', columns,
+                                     lambda t, values=values: values))
+    return families
+
+def load_manifest(directory):
+    """The manifest of a built fixture, or None"""
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_fixture(directory, params, promtool='promtool', keep_openmetrics=False):
+    """Write the OpenMetrics backfill, build TSDB blocks from it and return the manifest"""
+    if shutil.which(promtool) is None:
+        raise FixtureError(f"{promtool} not found; install Prometheus or see tsdb_fixture.py --help")
+    os.makedirs(directory, exist_ok=True)
+    data_dir = os.path.join(directory, 'data')
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+
+    end = params['end']
+    start = end - params['hours'] * 3600
+    interval = params['interval']
+    fleet = Fleet(instances=params['instances'], cpus=params['cpus'], seed=params['seed'],
+                  first_instance=params['first_instance'])
+    om_path = os.path.join(directory, 'fixture.om')
+    started = time.perf_counter()
+    samples = write_backfill(fleet, om_path, start, end, interval, recorded_families(fleet, start, end, interval))
+    print(f"📝 Wrote {samples} samples ({fleet.series_count} series, {params['hours']}h) "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    completed = subprocess.run([promtool, 'tsdb', 'create-blocks-from', 'openmetrics', om_path, data_dir],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise FixtureError(f"promtool failed: {(completed.stderr or completed.stdout).strip()}")
+    print(f"🧱 Built TSDB blocks in {data_dir} in {time.perf_counter() - started:.1f}s")
+    if not keep_openmetrics:
+        os.remove(om_path)
+
+    manifest = dict(params, start=start, eval_time=end, samples=samples, series=fleet.series_count)
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def ensure_fixture(directory, params, promtool='promtool', rebuild=False):
+    """Reuse the fixture in `directory` if it was built with the same params, otherwise build it"""
+    manifest = load_manifest(directory)
+    if (not rebuild and manifest is not None and os.path.isdir(os.path.join(directory, 'data'))
+            and all(manifest.get(key) == value for key, value in params.items())):
+        return manifest
+    return build_fixture(directory, params, promtool)
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+class FixturePrometheus:
+    """A local Prometheus serving the fixture blocks, with no scrape jobs."""
+
+    def __init__(self, directory, prometheus='prometheus', host='127.0.0.1', port=None):
+        self.directory = directory
+        self.prometheus = prometheus
+        self.host = host
+        self.port = port
+        self.process = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        if shutil.which(self.prometheus) is None:
+            raise FixtureError(f"{self.prometheus} not found; install Prometheus or see tsdb_fixture.py --help")
+        if load_manifest(self.directory) is None:
+            raise FixtureError(f"No fixture in {self.directory}; run tsdb_fixture.py build first")
+        self.port = self.port or free_port(self.host)
+        config = os.path.join(self.directory, 'prometheus.yml')
+        with open(config, 'w') as f:
+            f.write("# Serves the fixture blocks only\nscrape_configs: []\n")
+        log_path = os.path.join(self.directory, 'prometheus.log')
+        with open(log_path, 'w') as log:
+            self.process = subprocess.Popen([
+                self.prometheus,
+                f'--config.file={config}',
+                f'--storage.tsdb.path={os.path.join(self.directory, "data")}',
+                # Retention counts back from the newest block, but keep the fixture safe regardless
+                '--storage.tsdb.retention.time=100y',
+                f'--web.listen-address={self.host}:{self.port}',
+            ], stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                with open(log_path) as log:
+                    tail = ''.join(log.readlines()[-5:])
+                raise FixtureError(f"Prometheus exited with code {self.process.returncode}:\n{tail}")
+            try:
+                if requests.get(f"{self.url}/-/ready", timeout=1).status_code == 200:
+                    return self
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise FixtureError(f"Prometheus was not ready after {STARTUP_TIMEOUT}s (see {log_path})")
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+def command_build(args):
+    from queries import all_queries
+    hours = args.hours if args.hours is not None else fixture_hours(all_queries)
+    params = fixture_params(instances=args.instances, cpus=args.cpus, seed=args.seed,
+                            first_instance=args.first_instance, hours=hours, interval=args.interval)
+    manifest = build_fixture(args.dir, params, args.promtool, args.keep_openmetrics)
+    print(f"✅ Fixture ready in {args.dir}: {manifest['start']} - {manifest['end']}, "
+          f"queries are pinned to time={manifest['eval_time']}")
+    return 0
+
+def command_serve(args):
+    server = FixturePrometheus(args.dir, args.prometheus, port=args.port).start()
+    manifest = load_manifest(args.dir)
+    print(f"🚀 Prometheus on the fixture at {server.url} (Ctrl+C to stop)")
+    print(f"   Query with time={manifest['eval_time']}, e.g. "
+          f"{server.url}/api/v1/query?query=up&time={manifest['eval_time']}")
+    try:
+        server.process.wait()
+    except KeyboardInterrupt:
+        print("\n⏹️  Stopped")
+    finally:
+        server.stop()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and serve pre-built TSDB blocks for the lab queries')
+    parser.add_argument('--dir', default=DEFAULT_FIXTURE_DIR,
+                        help=f'Fixture directory (default: {DEFAULT_FIXTURE_DIR})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Write the backfill and build TSDB blocks with promtool')
+    build.add_argument('--instances', type=int, default=1, help='Synthetic instances (default: 1)')
+    build.add_argument('--cpus', type=int, default=4, help='CPUs per instance (default: 4)')
+    build.add_argument('--seed', type=int, default=42, help='Random seed for the fleet (default: 42)')
+    build.add_argument('--first-instance', default=None,
+                       help='Name of the first instance (default: instance_name from config.json)')
+    build.add_argument('--hours', type=float, default=None,
+                       help=f'Hours of data (default: {DEFAULT_HOURS}, or what the catalog needs)')
+    build.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                       help=f'Sample interval in seconds (default: {DEFAULT_INTERVAL})')
+    build.add_argument('--promtool', default='promtool', help='promtool binary (default: promtool)')
+    build.add_argument('--keep-openmetrics', action='store_true', help='Keep the OpenMetrics file after building')
+    serve = commands.add_parser('serve', help='Start Prometheus on the fixture blocks')
+    serve.add_argument('--prometheus', default='prometheus', help='prometheus binary (default: prometheus)')
+    serve.add_argument('--port', type=int, default=None, help='Port to listen on (default: a free port)')
+    args = parser.parse_args()
+
+    if args.command == 'build' and args.first_instance is None:
+        from test_queries import load_config
+        args.first_instance = load_config()['instance_name']
+    try:
+        return {'build': command_build, 'serve': command_serve}[args.command](args)
+    except FixtureError as e:
+        print(f"❌ {e}")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())